@@ -1,9 +1,22 @@
 from django.contrib import admin
 
-from .models import Office, Person, Unit, Distance
+from . import jobs
+from .models import Office, Person, Unit, Distance, Challenge, Job
+
+
+class UnitAdmin(admin.ModelAdmin):
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        if obj.factor_changed:
+            # As in the unit_edit view, the logged distances are renormalized by a job
+            jobs.enqueue("rebuild_rollups", {"normalize": True}, user=request.user)
+            self.message_user(request, "Distances in this unit will be renormalized by a background job.")
+
 
 # Register your models here.
 admin.site.register(Office)
 admin.site.register(Person)
-admin.site.register(Unit)
+admin.site.register(Unit, UnitAdmin)
 admin.site.register(Distance)
+admin.site.register(Challenge)
+admin.site.register(Job)
@@ -0,0 +1,359 @@
+"""Read-only JSON API, version 1
+
+Distances, people, offices and units are listed with keyset pagination and can be
+fetched one at a time. Rows are read with .values() projections of just the requested
+fields, so no model instances are built. Every response carries an ETag made from the
+fragment cache version counters (see caching.py), so a conditional GET that nothing
+has changed since is answered with a 304 without querying the tables at all.
+Totals over time are served by distance_series, from the bucket cache in series.py.
+
+Clients authenticate with the site's session cookie or with HTTP Basic auth.
+"""
+import base64
+import binascii
+import datetime
+import hashlib
+from functools import wraps
+
+from django.contrib.auth import authenticate
+from django.core.exceptions import ValidationError
+from django.http import JsonResponse
+from django.utils import timezone
+from django.views.decorators.http import condition, require_GET
+
+from . import caching, series, stats
+from .models import Distance, Office, Person, Unit
+from .pagination import MAX_INTEGER, InvalidCursor, get_page_size, paginate_keyset
+from .views import parse_date_param, parse_id_param
+
+VERSION = 1
+
+# How far back a series goes when no date_from is given
+SERIES_DEFAULT_SPAN = {"day": 30, "week": 7 * 12, "month": 365}
+
+
+def _parse_id(value):
+    pk = parse_id_param(value)
+    if pk is None:
+        raise ValueError(f"Not an id: {value}")
+    return pk
+
+
+def _parse_date(value):
+    date = parse_date_param(value)
+    if date is None:
+        raise ValueError(f"Not a YYYY-MM-DD date: {value}")
+    return date
+
+
+class Resource:
+    """A model exposed by the API
+
+    Attributes:
+        model (Model): The model listed
+        fields (dict): Field names in the responses mapped to the lookups they are read from
+        ordering (list): Keyset pagination ordering, ending in a unique field
+        filters (dict): Query parameters mapped to (lookup, parser) pairs
+        dependencies (list): Other models whose changes alter the responses
+
+    """
+    def __init__(self, model, fields, ordering, filters=None, dependencies=()):
+        self.model = model
+        self.fields = fields
+        self.ordering = ordering
+        self.filters = filters or {}
+        self.dependencies = list(dependencies)
+
+
+DISTANCES = Resource(
+    Distance,
+    fields={
+        "id": "id",
+        "date": "date",
+        "person": "person_id",
+        "office": "person__location_id",
+        "distance": "distance",
+        "unit": "unit_id",
+        "unit_name": "unit__unit_of_measurement",
+        "normalized_distance": "normalized_distance",
+    },
+    ordering=["-date", "-id"],
+    filters={
+        "date_from": ("date__gte", _parse_date),
+        "date_to": ("date__lte", _parse_date),
+        "person": ("person_id", _parse_id),
+        "office": ("person__location_id", _parse_id),
+        "unit": ("unit_id", _parse_id),
+    },
+    dependencies=[Person, Unit],
+)
+
+PEOPLE = Resource(
+    Person,
+    fields={
+        "id": "id",
+        "first_name": "first_name",
+        "last_name": "last_name",
+        "email": "email",
+        "office": "location_id",
+    },
+    ordering=["id"],
+    filters={"office": ("location_id", _parse_id)},
+)
+
+OFFICES = Resource(
+    Office,
+    fields={"id": "id", "city": "city", "country": "country"},
+    ordering=["id"],
+    filters={"country": ("country__iexact", str)},
+)
+
+UNITS = Resource(
+    Unit,
+    fields={
+        "id": "id",
+        "unit_of_measurement": "unit_of_measurement",
+        "metres_per_unit": "metres_per_unit",
+        "is_steps": "is_steps",
+    },
+    ordering=["id"],
+)
+
+
+def _error(message, status=400):
+    return JsonResponse({"error": message}, status=status)
+
+
+def _respond(data):
+    return JsonResponse(data, json_dumps_params={"separators": (",", ":")})
+
+
+def _basic_auth(request):
+    """Returns the user named by an HTTP Basic Authorization header, or None"""
+    scheme, _, credentials = request.META.get("HTTP_AUTHORIZATION", "").partition(" ")
+    if scheme.lower() != "basic":
+        return None
+    try:
+        username, _, password = base64.b64decode(credentials).decode().partition(":")
+    except (binascii.Error, UnicodeDecodeError):
+        return None
+    return authenticate(request, username=username, password=password)
+
+
+def api_login_required(view):
+    """Like login_required, but answers anonymous requests with a 401 rather than a redirect"""
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            user = _basic_auth(request)
+            if user is None:
+                response = _error("Authentication required", status=401)
+                response["WWW-Authenticate"] = 'Basic realm="distance"'
+                return response
+            request.user = user
+        return view(request, *args, **kwargs)
+    return wrapper
+
+
+def _etag(resource, detail=False):
+    """
+    Makes an etag_func for condition(), from the request's URL and the versions of
+    everything the response shows
+    """
+    def etag(request, pk=None):
+        own = (resource.model, pk) if detail else resource.model
+        versions = caching.versions(own, *resource.dependencies)
+        key = f"{VERSION}:{request.get_full_path()}:{versions}"
+        return hashlib.md5(key.encode()).hexdigest()
+    return etag
+
+
+def _selected_fields(request, resource):
+    """Returns the fields requested in the comma separated 'fields' parameter, or all of them"""
+    if not request.GET.get("fields"):
+        return list(resource.fields)
+    fields = [field.strip() for field in request.GET["fields"].split(",") if field.strip()]
+    unknown = [field for field in fields if field not in resource.fields]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return fields
+
+
+def _project(rows, resource, fields):
+    return [{field: row[resource.fields[field]] for field in fields} for row in rows]
+
+
+def _list(request, resource):
+    """
+    Returns one page of a resource as JSON
+
+    Args:
+        request (HttpRequest): The HTTP request, with optional 'fields', filters,
+                               'page_size' and 'after' or 'before' cursors
+        resource (Resource): The resource to list
+
+    Returns:
+        JsonResponse: {"results": [...], "next": cursor, "previous": cursor}
+    """
+    try:
+        fields = _selected_fields(request, resource)
+        queryset = resource.model.objects.all()
+        for parameter, (lookup, parse) in resource.filters.items():
+            if request.GET.get(parameter):
+                queryset = queryset.filter(**{lookup: parse(request.GET[parameter])})
+
+        # The ordering fields are always read, they are needed for the cursors
+        lookups = {resource.fields[field] for field in fields}
+        lookups.update(field.lstrip("-") for field in resource.ordering)
+        page = paginate_keyset(
+            queryset.values(*lookups), resource.ordering, get_page_size(request),
+            after=request.GET.get("after"), before=request.GET.get("before"),
+        )
+    except InvalidCursor:
+        return _error("Invalid cursor")
+    except (ValueError, ValidationError) as error:
+        return _error(str(error))
+
+    return _respond({
+        "results": _project(page, resource, fields),
+        "next": page.next_cursor,
+        "previous": page.previous_cursor,
+    })
+
+
+def _detail(request, resource, pk):
+    try:
+        fields = _selected_fields(request, resource)
+    except ValueError as error:
+        return _error(str(error))
+    if pk > MAX_INTEGER:
+        return _error("Not found", status=404)
+    row = resource.model.objects.filter(pk=pk).values(*{resource.fields[field] for field in fields}).first()
+    if row is None:
+        return _error("Not found", status=404)
+    return _respond(_project([row], resource, fields)[0])
+
+
+@require_GET
+@api_login_required
+@condition(etag_func=_etag(DISTANCES))
+def distances(request):
+    """
+    Lists distances, newest first, optionally filtered by 'date_from', 'date_to',
+    'person', 'office' and 'unit'
+    """
+    return _list(request, DISTANCES)
+
+
+@require_GET
+@api_login_required
+@condition(etag_func=_etag(DISTANCES, detail=True))
+def distance(request, pk):
+    return _detail(request, DISTANCES, pk)
+
+
+@require_GET
+@api_login_required
+@condition(etag_func=_etag(PEOPLE))
+def people(request):
+    """Lists people, optionally filtered by 'office'"""
+    return _list(request, PEOPLE)
+
+
+@require_GET
+@api_login_required
+@condition(etag_func=_etag(PEOPLE, detail=True))
+def person(request, pk):
+    return _detail(request, PEOPLE, pk)
+
+
+@require_GET
+@api_login_required
+@condition(etag_func=_etag(OFFICES))
+def offices(request):
+    """Lists offices, optionally filtered by 'country'"""
+    return _list(request, OFFICES)
+
+
+@require_GET
+@api_login_required
+@condition(etag_func=_etag(OFFICES, detail=True))
+def office(request, pk):
+    return _detail(request, OFFICES, pk)
+
+
+@require_GET
+@api_login_required
+@condition(etag_func=_etag(UNITS))
+def units(request):
+    return _list(request, UNITS)
+
+
+@require_GET
+@api_login_required
+@condition(etag_func=_etag(UNITS, detail=True))
+def unit(request, pk):
+    return _detail(request, UNITS, pk)
+
+
+@require_GET
+@api_login_required
+def distance_series(request):
+    """
+    Returns the normalized distance, in metres, summed into day, week or month buckets
+
+    The 'interval' parameter chooses 'day' (the default), 'week' or 'month', 'group'
+    optionally splits each bucket by 'person' or 'office', and 'date_from' and 'date_to'
+    choose the range, defaulting to the 30 days, 12 weeks or 12 months up to today
+
+    Returns:
+        JsonResponse: {"interval": ..., "group": ..., "results": [{"bucket": ..., "total": ...}, ...]},
+                      with a "person" or "office" id in each result when grouped
+    """
+    interval = request.GET.get("interval", "day")
+    group = request.GET.get("group") or None
+    try:
+        date_to = _parse_date(request.GET["date_to"]) if request.GET.get("date_to") else timezone.localdate()
+        if request.GET.get("date_from"):
+            date_from = _parse_date(request.GET["date_from"])
+        else:
+            date_from = date_to - datetime.timedelta(days=SERIES_DEFAULT_SPAN.get(interval, 30) - 1)
+        rows = series.series(interval, date_from, date_to, group)
+    except OverflowError:
+        # The default span reaches back before 0001-01-01
+        return _error("date_to is too early for the default date_from")
+    except ValueError as error:
+        return _error(str(error))
+
+    results = []
+    for start, group_id, total in rows:
+        result = {"bucket": start, "total": total}
+        if group:
+            result[group] = group_id
+        results.append(result)
+    return _respond({"interval": interval, "group": group, "results": results})
+
+
+def _tree_node(node):
+    return {"total": node.total, "entries": node.entries}
+
+
+@require_GET
+@api_login_required
+def org_tree(request):
+    """
+    Returns the running total, in metres, of every country, city and office, read in a single query
+
+    Returns:
+        JsonResponse: {"results": [{"country": ..., "total": ..., "entries": ..., "cities": [{"city": ...,
+                      "total": ..., "entries": ..., "offices": [{"office": id, "total": ..., "entries": ...}]}]}]}
+    """
+    results = []
+    for country in stats.org_tree():
+        results.append({"country": country["node"].country, **_tree_node(country["node"]), "cities": [
+            {"city": city["node"].city, **_tree_node(city["node"]), "offices": [
+                {"office": office.office_id, **_tree_node(office)} for office in city["offices"]
+            ]}
+            for city in country["cities"]
+        ]})
+    return _respond({"results": results})
@@ -1,6 +1,13 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
 
 
 class DistanceConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'distance'
+
+    def ready(self):
+        # Keeps the rollup tables in step with every write
+        from . import signals  # noqa: F401
+        from .db import configure_sqlite
+        connection_created.connect(configure_sqlite, dispatch_uid="distance.configure_sqlite")
@@ -0,0 +1,122 @@
+"""Closing finished years
+
+Every year's challenge would otherwise keep all of its distances in the Distance table
+forever, so each query on the current year pays for all the years before it. Closing
+a year moves its distances, a batch at a time, into ArchivedDistance, which nothing
+reads on a request. The rollups are left alone: the archived distances still count
+towards everyone's totals, and DailyTotal keeps a compact per person, per day summary
+of them for the history pages. rollups.rebuild() recomputes from both tables.
+"""
+import datetime
+from decimal import Decimal
+
+from django.db import connection, transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from . import caching
+from .models import ArchivedDistance, ArchivedYear, Challenge, DailyTotal, Distance
+
+# Distances moved per transaction
+BATCH_SIZE = 1000
+
+# People listed on a past year's page
+HISTORY_PEOPLE = 100
+
+FIELDS = ["id", "date", "person_id", "distance", "unit_id", "normalized_distance", "fingerprint"]
+
+
+def year_dates(year):
+    """Returns the (first, last) day of a year's challenge, or of the calendar year if it had none"""
+    challenge = Challenge.objects.filter(year=year).values_list("start_date", "end_date").first()
+    return challenge or (datetime.date(year, 1, 1), datetime.date(year, 12, 31))
+
+
+def close_year(year, batch_size=BATCH_SIZE, today=None):
+    """
+    Moves a finished year's distances from the Distance table to ArchivedDistance
+
+    Closing a year again archives anything logged for it since it was closed
+
+    Args:
+        year (int): The year to close
+        batch_size (int): Distances moved per transaction
+        today (Date): The current date, defaults to today
+
+    Returns:
+        ArchivedYear: The closed year, with the number and total of the distances archived
+
+    Raises:
+        ValueError: If the year's challenge (or the year itself) has not finished
+    """
+    today = today or timezone.localdate()
+    start, end = year_dates(year)
+    if end >= today:
+        raise ValueError(f"{year} has not finished yet, it ends on {end}")
+
+    live = Distance.objects.filter(date__gte=start, date__lte=end).order_by("id")
+    moved, total = 0, Decimal(0)
+    while True:
+        with transaction.atomic():
+            rows = [dict(zip(FIELDS, row)) for row in live.values_list(*FIELDS)[:batch_size]]
+            if not rows:
+                break
+            ArchivedDistance.objects.bulk_create([ArchivedDistance(**row) for row in rows])
+            # A raw delete sends no signals, so the distances stay in the rollups
+            Distance.objects.filter(pk__in=[row["id"] for row in rows])._raw_delete(Distance.objects.db)
+        moved += len(rows)
+        total += sum(row["normalized_distance"] for row in rows)
+
+    closed, created = ArchivedYear.objects.get_or_create(
+        year=year, defaults={"start_date": start, "end_date": end, "distances": moved, "total": total}
+    )
+    if not created:
+        closed.start_date, closed.end_date = start, end
+        closed.distances += moved
+        closed.total += total
+        closed.save()
+    caching.bump(Distance)
+    return closed
+
+
+def vacuum():
+    """Returns the space freed by closing a year to the file system, on SQLite"""
+    if connection.vendor == "sqlite":
+        with connection.cursor() as cursor:
+            cursor.execute("VACUUM")
+
+
+def year_totals(year):
+    """
+    Returns the totals of a closed year's people and offices, from the daily rollups
+
+    Args:
+        year (ArchivedYear): The year
+
+    Returns:
+        dict: The HISTORY_PEOPLE people with the largest totals, as 'people' ({'person',
+              'first_name', 'last_name', 'kilometres', 'entries'}), and every office's totals
+              as 'offices' ({'office', 'city', 'kilometres', 'entries'})
+    """
+    days = DailyTotal.objects.filter(date__gte=year.start_date, date__lte=year.end_date)
+    totals = {"total": Sum("total"), "entries": Sum("entries")}
+    people = (
+        days.values("person", "person__first_name", "person__last_name")
+        .annotate(**totals)
+        .order_by("-total", "person")[:HISTORY_PEOPLE]
+    )
+    offices = days.values("person__location", "person__location__city").annotate(**totals).order_by("-total")
+    return {
+        "people": [
+            {"person": row["person"], "first_name": row["person__first_name"],
+             "last_name": row["person__last_name"], "kilometres": Decimal(row["total"]) / 1000,
+             "entries": row["entries"]}
+            for row in people
+        ],
+        "offices": [
+            {"office": row["person__location"], "city": row["person__location__city"],
+             "kilometres": Decimal(row["total"]) / 1000, "entries": row["entries"]}
+            for row in offices
+        ],
+    }
+
@@ -0,0 +1,57 @@
+"""Third party CSS and JavaScript
+
+Bootstrap is served from the site's own static files once `python manage.py
+vendor_bootstrap` has downloaded it into static/vendor/bootstrap, so pages load without
+a request to a CDN and it is cached like the site's own files. Until then, or when the
+DISTANCE_BOOTSTRAP_CDN setting is on, it is loaded from jsDelivr. Either way the browser
+checks it against the same subresource integrity hashes, which holds for the collected
+copies because CompressedManifestStorage copies vendor/ files unchanged.
+"""
+import base64
+import functools
+import hashlib
+
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.templatetags.static import static
+
+BOOTSTRAP_VERSION = "5.3.1"
+
+BOOTSTRAP_CDN = f"https://cdn.jsdelivr.net/npm/bootstrap@{BOOTSTRAP_VERSION}/dist/"
+
+BOOTSTRAP_DIR = "vendor/bootstrap/"
+
+# Files used by layout.html, relative to BOOTSTRAP_CDN and BOOTSTRAP_DIR, and their integrity hashes
+BOOTSTRAP_FILES = {
+    "css": ("css/bootstrap.min.css", "sha384-4bw+/aepP/YC94hEpVNVgiZdgIC5+VKNBQNGCHeKRQN+PtmoHDEXuppvnDJzQIu9"),
+    "js": ("js/bootstrap.bundle.min.js", "sha384-HwwvtgBNo3bZJJLYd8oVXjrBZt8cqVSpeBNS5n7C8IVInixGAoxmnlMuBnhbgrkm"),
+}
+
+# Source maps named by the files' sourceMappingURL comments, only fetched by browser developer tools
+BOOTSTRAP_MAPS = ["css/bootstrap.min.css.map", "js/bootstrap.bundle.min.js.map"]
+
+
+def integrity(content):
+    """Returns the sha384 subresource integrity hash of a file's content"""
+    return "sha384-" + base64.b64encode(hashlib.sha384(content).digest()).decode()
+
+
+@functools.lru_cache(maxsize=None)
+def vendored():
+    """Whether every Bootstrap file has been downloaded into the static files"""
+    return all(finders.find(BOOTSTRAP_DIR + path) for path, sri in BOOTSTRAP_FILES.values())
+
+
+def bootstrap():
+    """
+    Returns the URL and integrity hash of Bootstrap's CSS and JavaScript
+
+    Returns:
+        dict: {'url', 'integrity'} for 'css' and 'js'
+    """
+    cdn = getattr(settings, "DISTANCE_BOOTSTRAP_CDN", False) or not vendored()
+    return {
+        kind: {"url": BOOTSTRAP_CDN + path if cdn else static(BOOTSTRAP_DIR + path), "integrity": sri}
+        for kind, (path, sri) in BOOTSTRAP_FILES.items()
+    }
+
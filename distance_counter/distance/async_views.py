@@ -0,0 +1,188 @@
+"""Async versions of the read-heavy views, for running under ASGI
+
+They read with the async ORM, so under an ASGI server such as uvicorn a request
+waiting on the database doesn't hold a worker thread. Django 4.2 still loads the
+session user and renders templates synchronously, so those steps are handed to
+sync_to_async. Under WSGI they work too, but each request pays for an event loop,
+so the synchronous views in views.py remain the defaults at the usual URLs.
+"""
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.views import redirect_to_login
+from django.http import Http404
+from django.shortcuts import render
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+from . import caching, leaderboards
+from .models import Distance, Office, Person, Ranking
+from .pagination import InvalidCursor, apaginate_keyset, get_page_size
+from .stats import person_stats
+from .views import _search_page, parse_date_param, parse_id_param
+
+# Context processors read the session and messages, which are synchronous
+_render = sync_to_async(render)
+
+
+async def _is_authenticated(request):
+    # request.user is loaded lazily from the session, with blocking queries
+    return await sync_to_async(lambda: request.user.is_authenticated)()
+
+
+def async_login_required(view):
+    """login_required for async views, which Django 4.2's decorator doesn't support"""
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if not await _is_authenticated(request):
+            return redirect_to_login(request.get_full_path())
+        return await view(request, *args, **kwargs)
+    return wrapper
+
+
+async def index(request):
+    """
+    Async version of views.index
+
+    Args:
+        request (HttpRequest): The HTTP request object
+
+    Returns:
+        HttpResponse: The rendered index page.
+    """
+    if not await _is_authenticated(request):
+        return await _render(request, "distance/index.html")
+
+    distances = Distance.objects.select_related("person", "unit")
+    page_size = get_page_size(request)
+    try:
+        page = await apaginate_keyset(distances, ["-date", "-id"], page_size,
+                                      after=request.GET.get("after"), before=request.GET.get("before"))
+    except InvalidCursor:
+        page = await apaginate_keyset(distances, ["-date", "-id"], page_size)
+
+    return await _render(request, "distance/index.html", {
+        "distances": page,
+        "page_size": page_size,
+    })
+
+
+@async_login_required
+async def distance(request, distance_id):
+    """
+    Async version of views.distance
+
+    Args:
+        request (HttpRequest): The HTTP request object
+        distance_id (int): The ID of the distance record to display
+
+    Returns:
+        HttpResponse: The rendered distance detail page
+    """
+    try:
+        distance = await Distance.objects.select_related("person", "unit").aget(pk=distance_id)
+    except Distance.DoesNotExist:
+        raise Http404("No such distance")
+
+    return await _render(request, "distance/distances.html", {
+        "distance": distance
+    })
+
+
+@async_login_required
+async def people(request):
+    """
+    Async version of views.people
+
+    Args:
+        request (HttpRequest): The HTTP request object
+
+    Returns:
+        HttpResponse: The rendered people list page
+    """
+    if request.GET.get("q"):
+        # The full text search runs raw SQL through a synchronous cursor
+        people, page, has_next = await sync_to_async(_search_page)(request, 50)
+        return await _render(request, "distance/people.html", {
+            "table": render_to_string("distance/fragments/people_table.html", {"persons": people}),
+            "query": request.GET["q"],
+            "page": page,
+            "has_next": has_next,
+        })
+
+    async def render_table():
+        people = [person async for person in Person.objects.select_related("location")]
+        return render_to_string("distance/fragments/people_table.html", {"persons": people})
+
+    table = await caching.afragment("people", [Person, Office], render_table)
+    return await _render(request, "distance/people.html", {
+        "table": table
+    })
+
+
+@async_login_required
+async def person(request, person_id):
+    """
+    Async version of views.person
+
+    Args:
+        request (HttpRequest): The HTTP request object
+        person_id (int): The ID of the person record to display
+
+    Returns:
+        HttpResponse: The rendered person details page
+    """
+    async def render_details():
+        try:
+            person = await Person.objects.select_related("location").aget(pk=person_id)
+        except Person.DoesNotExist:
+            raise Http404("No such person")
+        return render_to_string("distance/fragments/person.html", {"person": person})
+
+    details = await caching.afragment("person", [(Person, person_id), Office], render_details, key=person_id)
+    return await _render(request, "distance/person.html", {
+        "details": details,
+        "person_id": person_id,
+        # Streaks and office ranks are read with raw SQL, which the async ORM can't run
+        "stats": await sync_to_async(person_stats)(person_id),
+    })
+
+
+@async_login_required
+async def leaderboard(request, board):
+    """
+    Async version of views.leaderboard
+
+    Args:
+        request (HttpRequest): The HTTP request object
+        board (str): Either 'people' or 'offices'
+
+    Returns:
+        HttpResponse: The rendered leaderboard page
+    """
+    if board not in (Ranking.PEOPLE, Ranking.OFFICES):
+        raise Http404("No such leaderboard")
+
+    period = request.GET.get("period", Ranking.OVERALL)
+    if period not in (Ranking.OVERALL, Ranking.MONTH, Ranking.WEEK):
+        period = Ranking.OVERALL
+    date = parse_date_param(request.GET.get("date"))
+    if date is None or not leaderboards.in_range(period, date):
+        date = timezone.localdate()
+    start = leaderboards.period_start(period, date)
+
+    subject_id = parse_id_param(request.GET.get("id"))
+    if subject_id is None and board == Ranking.PEOPLE and request.user.email:
+        subject_id = await Person.objects.filter(email__iexact=request.user.email).values_list("id", flat=True).afirst()
+
+    rankings = await leaderboards.atop(board, period, start, settings.DISTANCE_LEADERBOARD_SIZE)
+    mine = await leaderboards.aposition(board, period, subject_id, start) if subject_id is not None else None
+
+    return await _render(request, "distance/leaderboard.html", {
+        "board": board,
+        "period": period,
+        "period_start": start,
+        "rankings": rankings,
+        "mine": mine,
+    })
@@ -0,0 +1,135 @@
+"""Caching of rendered page fragments, invalidated by version counters
+
+Every model has a version counter in the cache, and so does every object of it.
+Fragment keys include the versions of everything the fragment shows, so when a
+signal bumps a counter after a save or delete (from the views or the admin) the
+stale fragments are simply never looked up again. Hits and misses are counted
+per fragment for the query stats page.
+"""
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.safestring import mark_safe
+
+_counts = {}
+_lock = threading.Lock()
+
+
+def get_cache():
+    """Returns the cache fragments are stored in, chosen by DISTANCE_FRAGMENT_CACHE"""
+    return caches[getattr(settings, "DISTANCE_FRAGMENT_CACHE", "default")]
+
+
+def _version_key(model, pk=None):
+    name = model._meta.label_lower
+    return f"distance:version:{name}" if pk is None else f"distance:version:{name}:{pk}"
+
+
+def increment(cache, key):
+    """Increments the version counter stored under key"""
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Not set yet (or evicted): start from the clock, see counters()
+        cache.set(key, time.time_ns(), None)
+
+
+def counters(cache, keys):
+    """
+    Returns a dict of the version counters stored under keys, setting any missing
+
+    A counter that was evicted could come back at a version it held before, whose
+    fragments may still be cached, were it started from 1 again. Missing counters
+    start from the clock instead, which is always past any version they reached
+    """
+    found = cache.get_many(keys)
+    missing = {key: time.time_ns() for key in keys if key not in found}
+    if missing:
+        cache.set_many(missing, None)
+        found.update(missing)
+    return found
+
+
+def bump(model, pk=None):
+    """Invalidates the fragments depending on a model (pk=None) or one of its objects"""
+    cache = get_cache()
+    increment(cache, _version_key(model))
+    if pk is not None:
+        increment(cache, _version_key(model, pk))
+
+
+def versions(*dependencies):
+    """
+    Returns the current version counters of the given dependencies
+
+    Args:
+        dependencies: Models, for fragments showing every object of a model, or
+                      (model, pk) pairs for fragments showing a single object
+    """
+    keys = [
+        _version_key(*dependency) if isinstance(dependency, tuple) else _version_key(dependency)
+        for dependency in dependencies
+    ]
+    found = counters(get_cache(), keys)
+    return [found[key] for key in keys]
+
+
+def fragment(name, dependencies, render, key=""):
+    """
+    Returns a cached fragment, rendering and storing it on a miss
+
+    Args:
+        name (str): Name of the fragment, used for the hit and miss counts
+        dependencies (list): What the fragment shows, see versions()
+        render (callable): Renders the fragment when it isn't cached
+        key (str): Anything else the fragment varies on, e.g. a page cursor
+
+    Returns:
+        SafeString: The rendered HTML
+    """
+    cache_key = _fragment_key(name, dependencies, key)
+    cache = get_cache()
+    html = cache.get(cache_key)
+    hit = html is not None
+    if not hit:
+        html = render()
+        cache.set(cache_key, html, getattr(settings, "DISTANCE_FRAGMENT_TIMEOUT", 3600))
+    _count(name, hit)
+    return mark_safe(html)
+
+
+async def afragment(name, dependencies, render, key=""):
+    """Async version of fragment(), where render is a coroutine function"""
+    cache_key = await sync_to_async(_fragment_key)(name, dependencies, key)
+    cache = get_cache()
+    html = await cache.aget(cache_key)
+    hit = html is not None
+    if not hit:
+        html = await render()
+        await cache.aset(cache_key, html, getattr(settings, "DISTANCE_FRAGMENT_TIMEOUT", 3600))
+    _count(name, hit)
+    return mark_safe(html)
+
+
+def _fragment_key(name, dependencies, key):
+    return f"distance:fragment:{name}:{key}:" + ".".join(str(v) for v in versions(*dependencies))
+
+
+def _count(name, hit):
+    with _lock:
+        counts = _counts.setdefault(name, [0, 0])
+        counts[0 if hit else 1] += 1
+
+
+def get_counts():
+    """Returns {fragment name: (hits, misses)} for this process"""
+    with _lock:
+        return {name: tuple(counts) for name, counts in sorted(_counts.items())}
+
+
+def reset_counts():
+    with _lock:
+        _counts.clear()
@@ -0,0 +1,29 @@
+from django.utils import timezone
+from django.utils.functional import SimpleLazyObject
+
+from . import assets
+from .models import Challenge
+
+
+def current_challenge():
+    """Returns the most recently started challenge, or None if none has started"""
+    return (
+        Challenge.objects.select_related("unit")
+        .filter(start_date__lte=timezone.localdate())
+        .order_by("-start_date")
+        .first()
+    )
+
+
+def challenge(request):
+    """
+    Adds the current challenge to every template, for the progress widget in layout.html
+
+    It is only looked up if a template uses it, with a single indexed query
+    """
+    return {"challenge": SimpleLazyObject(current_challenge)}
+
+
+def static_assets(request):
+    """Adds the URLs and integrity hashes of Bootstrap's files, for layout.html"""
+    return {"bootstrap": assets.bootstrap()}
@@ -0,0 +1,74 @@
+"""Streaming export of distances as CSV or JSON Lines
+
+Rows are read with a server-side iterator in chunks and encoded one at a time, so
+exporting any number of distances uses flat memory and the first bytes can be sent
+before the query has finished. The columns can be read back by importer.py.
+"""
+import csv
+import json
+
+from .models import Distance
+
+FORMATS = {
+    "csv": "text/csv",
+    "json": "application/x-ndjson",
+}
+
+COLUMNS = [
+    ("id", "id"),
+    ("date", "date"),
+    ("person_id", "person_id"),
+    ("person_email", "person__email"),
+    ("first_name", "person__first_name"),
+    ("last_name", "person__last_name"),
+    ("office", "person__location__city"),
+    ("country", "person__location__country"),
+    ("distance", "distance"),
+    ("unit", "unit__unit_of_measurement"),
+    ("normalized_distance", "normalized_distance"),
+]
+
+
+def export_rows(queryset=None, chunk_size=2000):
+    """
+    Yields a tuple of column values for each distance, joined to its person, office and unit
+
+    Args:
+        queryset (QuerySet): The distances to export, defaults to all of them
+        chunk_size (int): Number of rows fetched from the database at a time
+    """
+    if queryset is None:
+        queryset = Distance.objects.all()
+    fields = [field for name, field in COLUMNS]
+    return queryset.order_by("date", "id").values_list(*fields).iterator(chunk_size=chunk_size)
+
+
+class _Echo:
+    """A file-like object whose write returns the value written, for csv.writer"""
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows):
+    """Encodes rows as CSV lines, starting with a header"""
+    writer = csv.writer(_Echo())
+    yield writer.writerow([name for name, field in COLUMNS])
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def json_lines(rows):
+    """Encodes rows as JSON Lines, one object per distance"""
+    names = [name for name, field in COLUMNS]
+    for row in rows:
+        yield json.dumps(dict(zip(names, row)), default=str) + "\n"
+
+
+def encode(rows, format):
+    """Returns an iterator of text chunks for rows in the given format ('csv' or 'json')"""
+    if format == "csv":
+        return csv_lines(rows)
+    if format == "json":
+        return json_lines(rows)
+    raise ValueError(f"Unsupported export format: {format}")
@@ -1,7 +1,11 @@
+import uuid
+
 from django import forms
 from django.contrib.auth.models import User
 from django.contrib.auth.forms import UserCreationForm
-from .models import Distance, Office, Person, Unit
+from django.urls import reverse_lazy
+from .models import Challenge, Distance, Office, Person, Unit, fingerprint
+from .importer import FORMATS
 
 class RegisterForm(UserCreationForm):
     class Meta:
@@ -12,11 +16,132 @@ class LoginForm(forms.Form):
     username = forms.CharField(max_length=30)
     password = forms.CharField(max_length=40, widget=forms.PasswordInput)
 
+class PersonLookupWidget(forms.TextInput):
+    """
+    A typeahead for choosing a person, instead of a <select> listing everyone
+
+    Renders a hidden input holding the person's id and a text input whose suggestions
+    are fetched from the person_lookup view as the user types
+    """
+    template_name = 'distance/widgets/person_lookup.html'
+
+    class Media:
+        js = ['js/person_lookup.js']
+
+    def get_context(self, name, value, attrs):
+        context = super().get_context(name, value, attrs)
+        context['lookup_url'] = reverse_lazy('person_lookup')
+        person = Person.objects.filter(pk=value).first() if str(value or '').isdigit() else None
+        context['label'] = person_label(person) if person else ''
+        return context
+
+
+def person_label(person):
+    """The text shown for a person in the typeahead"""
+    return f"{person.first_name} {person.last_name} ({person.email})"
+
+
+class PersonField(forms.ModelChoiceField):
+    """
+    A ModelChoiceField that never loads the whole queryset
+
+    The submitted id is resolved with a single query by ModelChoiceField.to_python,
+    and the widget doesn't iterate the choices
+    """
+    widget = PersonLookupWidget
+
+
+# Longest idempotency key a client may send, batches add a row number to it
+IDEMPOTENCY_KEY_LENGTH = 40
+
+
+def show_duplicate_confirmation(form):
+    """Shows a form's allow_duplicate field, which stays hidden until a duplicate is found"""
+    form.fields['allow_duplicate'].widget = forms.CheckboxInput()
+
+
 class LogForm(forms.ModelForm):
+    """
+    A distance, rejected if exactly the same distance has already been logged unless
+    allow_duplicate is ticked. The hidden idempotency key is new each time the form is
+    shown, so submitting the same page twice only logs the distance once
+    """
+    person = PersonField(queryset=Person.objects.all())
+    allow_duplicate = forms.BooleanField(
+        required=False, widget=forms.HiddenInput, label="Log it again",
+        help_text="Tick to log a distance identical to one already logged",
+    )
+    idempotency_key = forms.CharField(required=False, max_length=IDEMPOTENCY_KEY_LENGTH, widget=forms.HiddenInput)
+
     class Meta:
         model = Distance
         fields = ['date', 'person', 'distance', 'unit']
-       
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if not self.is_bound:
+            self.initial['idempotency_key'] = uuid.uuid4().hex
+
+    def clean(self):
+        cleaned_data = super().clean()
+        values = [cleaned_data.get(field) for field in ('person', 'date', 'distance', 'unit')]
+        if None in values or cleaned_data.get('allow_duplicate'):
+            return cleaned_data
+        person, date, distance, unit = values
+        duplicates = Distance.objects.filter(fingerprint=fingerprint(person.pk, date, distance, unit.pk))
+        if duplicates.exclude(pk=self.instance.pk).exists():
+            show_duplicate_confirmation(self)
+            raise forms.ValidationError(
+                "This distance has already been logged for this person on this date", code='duplicate'
+            )
+        return cleaned_data
+
+
+class BatchLogForm(forms.Form):
+    """The person a batch of distances is logged for"""
+    person = PersonField(queryset=Person.objects.all())
+    allow_duplicate = forms.BooleanField(
+        required=False, widget=forms.HiddenInput, label="Log them again",
+        help_text="Tick to log distances identical to ones already logged",
+    )
+    idempotency_key = forms.CharField(required=False, max_length=IDEMPOTENCY_KEY_LENGTH, widget=forms.HiddenInput)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if not self.is_bound:
+            self.initial['idempotency_key'] = uuid.uuid4().hex
+
+
+class BatchEntryForm(forms.Form):
+    """
+    One dated distance in a batch
+
+    The units are looked up once for the whole formset and passed in, so neither
+    rendering nor validating each entry queries the unit table. Unlike a ModelForm,
+    there is no model validation re-checking that the unit exists
+    """
+    date = Distance._meta.get_field('date').formfield()
+    distance = Distance._meta.get_field('distance').formfield()
+
+    def __init__(self, *args, units, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        def unit(pk):
+            if int(pk) not in units:
+                raise ValueError(f"Unknown unit {pk}")
+            return units[int(pk)]
+
+        self.fields['unit'] = forms.TypedChoiceField(
+            choices=[('', '---------')] + [(unit.id, unit.unit_of_measurement) for unit in units.values()],
+            coerce=unit,
+        )
+
+
+# A week of entries, and at most a month in one go
+BatchEntryFormSet = forms.formset_factory(
+    BatchEntryForm, extra=6, min_num=1, validate_min=True, max_num=31, validate_max=True
+)
+
 
 class OfficeForm(forms.ModelForm):
     class Meta:
@@ -31,4 +156,20 @@ class PersonForm(forms.ModelForm):
 class UnitForm(forms.ModelForm):
     class Meta:
         model = Unit
-        fields = '__all__'
\ No newline at end of file
+        fields = '__all__'
+
+class ChallengeForm(forms.ModelForm):
+    class Meta:
+        model = Challenge
+        fields = '__all__'
+
+    def clean(self):
+        cleaned_data = super().clean()
+        start_date, end_date = cleaned_data.get('start_date'), cleaned_data.get('end_date')
+        if start_date and end_date and end_date < start_date:
+            self.add_error('end_date', "The challenge can't end before it starts")
+        return cleaned_data
+
+class ImportForm(forms.Form):
+    file = forms.FileField()
+    format = forms.ChoiceField(choices=[(format, format.upper()) for format in FORMATS])
\ No newline at end of file
@@ -0,0 +1,209 @@
+"""Bulk import of distances from CSV or JSON Lines files
+
+Files are read one row at a time and processed in chunks. The people, units and
+offices a chunk refers to are resolved with one query per chunk into lookup maps,
+so rows are validated without any per-row queries, and each chunk is inserted with
+a single bulk_create inside its own transaction. Invalid rows, and rows that duplicate
+a distance already logged, are reported with their line number and skipped without
+aborting the rest of the file, so importing the same file twice adds nothing.
+
+Each row needs a 'date' (YYYY-MM-DD), a 'distance' and a 'unit' (its name or id), and
+identifies the person by 'person_id' or by 'person_email', optionally narrowed down
+with 'office' (the office city) when several people share an email address.
+"""
+import csv
+import json
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+
+from django.db.models import Q
+from django.db.models.functions import Lower
+from django.utils.dateparse import parse_date
+
+from .models import Distance, Office, Person, Unit
+from .pagination import MAX_INTEGER
+
+FORMATS = ["csv", "json"]
+
+# Largest value that fits Distance.distance (max_digits=8, decimal_places=2)
+MAX_DISTANCE = Decimal("999999.99")
+
+
+class ImportResult:
+    """Outcome of an import
+
+    Attributes:
+        created (int): Number of distances created
+        errors (list): (line number, message) for each row that was skipped
+
+    """
+    def __init__(self):
+        self.created = 0
+        self.errors = []
+
+    def __str__(self):
+        return f"{self.created} distances imported, {len(self.errors)} rows skipped"
+
+
+def read_rows(stream, format="csv"):
+    """
+    Lazily parses an uploaded or opened file into rows
+
+    Args:
+        stream (file): A text file object, opened with newline=''
+        format (str): 'csv' for a CSV file with a header row, or 'json' for JSON Lines
+                      (one object per line)
+
+    Yields:
+        tuple: (line number, row dict), where the row dict is None if the line could not be parsed
+    """
+    if format == "csv":
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, {key.strip().lower(): (value or "").strip() for key, value in row.items() if key}
+    elif format == "json":
+        for line_num, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                yield line_num, None
+                continue
+            yield line_num, row if isinstance(row, dict) else None
+    else:
+        raise ValueError(f"Unsupported import format: {format}")
+
+
+class _Lookups:
+    """Maps from the references used in import rows to ids, built with one query each per chunk"""
+
+    def __init__(self, units, offices):
+        self.units = units
+        self.offices = offices
+        self.people_by_id = {}
+        self.people_by_email = {}
+
+    @classmethod
+    def for_import(cls):
+        units = {}
+        for unit in Unit.objects.all():
+            units[str(unit.id)] = unit
+            units[unit.unit_of_measurement.lower()] = unit
+        offices = {}
+        for office_id, city in Office.objects.values_list("id", "city"):
+            offices.setdefault(city.lower(), set()).add(office_id)
+        return cls(units, offices)
+
+    def load_people(self, rows):
+        ids = {str(row.get("person_id")) for _, row in rows if row and row.get("person_id")}
+        emails = {str(row.get("person_email")).lower() for _, row in rows if row and row.get("person_email")}
+        people = Person.objects.annotate(lower_email=Lower("email")).filter(
+            # Ids too large for the database can't match anyone, and would make the query overflow
+            Q(pk__in=[pk for pk in ids if pk.isdigit() and int(pk) <= MAX_INTEGER]) | Q(lower_email__in=emails)
+        )
+        self.people_by_id = {}
+        self.people_by_email = {}
+        for person in people.values("id", "email", "location_id"):
+            self.people_by_id[str(person["id"])] = person
+            self.people_by_email.setdefault(person["email"].lower(), []).append(person)
+
+
+def _clean(row, lookups):
+    """
+    Validates a row against the lookup maps
+
+    Returns:
+        Distance: The unsaved distance
+
+    Raises:
+        ValueError: With a message describing the first problem found
+    """
+    date = parse_date(str(row.get("date") or ""))
+    if date is None:
+        raise ValueError(f"Invalid date '{row.get('date', '')}', expected YYYY-MM-DD")
+
+    try:
+        value = Decimal(str(row.get("distance", "")))
+    except InvalidOperation:
+        raise ValueError(f"Invalid distance '{row.get('distance', '')}'")
+    if not value.is_finite() or value < 0 or value > MAX_DISTANCE or value != value.quantize(Decimal("0.01")):
+        raise ValueError(f"Distance '{value}' must be between 0 and {MAX_DISTANCE} with at most two decimal places")
+
+    unit = lookups.units.get(str(row.get("unit", "")).strip().lower())
+    if unit is None:
+        raise ValueError(f"Unknown unit '{row.get('unit', '')}'")
+
+    office = str(row.get("office") or "").strip().lower()
+    if office and office not in lookups.offices:
+        raise ValueError(f"Unknown office '{row.get('office')}'")
+
+    if row.get("person_id"):
+        person = lookups.people_by_id.get(str(row["person_id"]))
+        candidates = [person] if person else []
+    else:
+        candidates = lookups.people_by_email.get(str(row.get("person_email") or "").lower(), [])
+    if office:
+        candidates = [person for person in candidates if person["location_id"] in lookups.offices[office]]
+    if not candidates:
+        raise ValueError("Unknown person")
+    if len(candidates) > 1:
+        raise ValueError("More than one person matches, add an 'office' column to choose between them")
+
+    return Distance(date=date, person_id=candidates[0]["id"], distance=value, unit=unit)
+
+
+def import_distances(rows, chunk_size=1000, progress=None):
+    """
+    Validates and saves distances from parsed rows
+
+    Args:
+        rows (iterable): (line number, row dict) pairs, as produced by read_rows
+        chunk_size (int): Number of rows validated and inserted together
+        progress (callable): Called with the number of rows read so far after each chunk
+
+    Returns:
+        ImportResult: How many distances were created and which rows were skipped
+    """
+    result = ImportResult()
+    lookups = _Lookups.for_import()
+    rows = iter(rows)
+    read = 0
+
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        lookups.load_people(chunk)
+
+        cleaned = []
+        for line_num, row in chunk:
+            if row is None:
+                result.errors.append((line_num, "Could not parse row"))
+                continue
+            try:
+                cleaned.append((line_num, _clean(row, lookups)))
+            except ValueError as error:
+                result.errors.append((line_num, str(error)))
+
+        # Rows identical to a distance already logged, or to an earlier row, are skipped
+        for line_num, distance in cleaned:
+            distance.fingerprint = distance.make_fingerprint()
+        seen = Distance.objects.existing_fingerprints(distance.fingerprint for line_num, distance in cleaned)
+        distances = []
+        for line_num, distance in cleaned:
+            if distance.fingerprint in seen:
+                result.errors.append((line_num, "Duplicate of a distance already logged"))
+            else:
+                seen.add(distance.fingerprint)
+                distances.append(distance)
+
+        if distances:
+            Distance.objects.bulk_log(distances)
+            result.created += len(distances)
+        read += len(chunk)
+        if progress:
+            progress(read)
+
+    result.errors.sort()
+    return result
@@ -0,0 +1,385 @@
+"""Database backed queue for work too slow to run inside a request
+
+Views enqueue a Job naming a registered task and its JSON payload, and redirect to a
+page showing its progress. `python manage.py run_jobs` workers poll the Job table,
+claim the next job that is due and run it. No broker is needed, and any number of
+workers can share the queue: a job is claimed with an UPDATE that only matches while
+it is still queued, so two workers reaching for the same job never both run it.
+
+A task that raises is retried after an exponentially growing delay until it has been
+tried max_attempts times. While a job runs, its worker records a heartbeat on it every
+DISTANCE_JOB_HEARTBEAT seconds, and jobs left running by a worker that died are queued
+again once they have gone DISTANCE_JOB_TIMEOUT seconds without one.
+
+Files uploaded for a job, and files it produces, are kept in DISTANCE_JOB_DIR, and
+workers delete them DISTANCE_JOB_RETENTION seconds after they were written.
+"""
+import contextlib
+import datetime
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from . import exporter, leaderboards, rollups
+from .importer import import_distances, read_rows
+from .models import ArchivedDistance, Distance, Job
+
+logger = logging.getLogger(__name__)
+
+# Registered tasks, by name
+TASKS = {}
+
+# Seconds before the first retry of a failed job, doubled for each attempt after that
+RETRY_DELAY = 30
+
+# Most import problems kept in a job's result
+MAX_REPORTED_ERRORS = 200
+
+# Seconds between a worker's sweeps of DISTANCE_JOB_DIR for expired files
+EXPIRE_INTERVAL = 3600
+
+
+def task(name):
+    """
+    Registers a function as a task that jobs can run
+
+    The function is called with the job and the job's payload as keyword arguments,
+    and whatever it returns must be JSON serializable, it is saved as the job's result
+    """
+    def register(function):
+        TASKS[name] = function
+        return function
+    return register
+
+
+def enqueue(name, payload=None, user=None, max_attempts=3):
+    """
+    Queues a task to be run by a worker
+
+    Args:
+        name (str): The registered task to run
+        payload (dict): Keyword arguments for the task, must be JSON serializable
+        user (User): Who asked for the job
+        max_attempts (int): How many times the task is tried before the job fails
+
+    Returns:
+        Job: The queued job
+
+    Raises:
+        ValueError: If no task is registered with the name
+    """
+    if name not in TASKS:
+        raise ValueError(f"Unknown task: {name}")
+    return Job.objects.create(
+        task=name, payload=payload or {}, max_attempts=max_attempts,
+        created_by=user if user is not None and user.is_authenticated else None,
+    )
+
+
+def claim(worker):
+    """
+    Marks the next due job as running on this worker
+
+    Args:
+        worker (str): Name of the worker, saved on the job
+
+    Returns:
+        Job: The claimed job, or None if no job is due
+    """
+    now = timezone.now()
+    due = Job.objects.filter(status=Job.QUEUED, run_after__lte=now).order_by("run_after", "id")
+    for job_id in due.values_list("id", flat=True)[:10]:
+        # Only matches if no other worker claimed the job since it was read
+        claimed = Job.objects.filter(pk=job_id, status=Job.QUEUED).update(
+            status=Job.RUNNING, worker=worker, started_at=now, heartbeat_at=now, progress=0,
+            attempts=F("attempts") + 1,
+        )
+        if claimed:
+            return Job.objects.get(pk=job_id)
+    return None
+
+
+def report(job, done, total=None):
+    """
+    Saves how far a running job has got, shown on its progress page
+
+    Args:
+        job (Job): The running job
+        done (int): Units of work done so far
+        total (int): Units of work in the whole job, if it has changed
+    """
+    job.progress = done
+    fields = {"progress": done, "heartbeat_at": timezone.now()}
+    if total is not None:
+        job.progress_total = total
+        fields["progress_total"] = total
+    Job.objects.filter(pk=job.pk).update(**fields)
+
+
+@contextlib.contextmanager
+def heartbeat(job, interval=None):
+    """
+    Records a heartbeat on a running job every interval seconds from a background
+    thread, so requeue_stale() can tell a slow job from one whose worker has stopped
+
+    Args:
+        job (Job): The running job
+        interval (float): Seconds between heartbeats, defaults to DISTANCE_JOB_HEARTBEAT
+    """
+    interval = interval if interval is not None else settings.DISTANCE_JOB_HEARTBEAT
+    stop = threading.Event()
+
+    def beat():
+        try:
+            while not stop.wait(interval):
+                Job.objects.filter(pk=job.pk, status=Job.RUNNING).update(heartbeat_at=timezone.now())
+        finally:
+            # The thread has a database connection of its own
+            connection.close()
+
+    thread = threading.Thread(target=beat, name=f"job-{job.pk}-heartbeat", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def run(job):
+    """
+    Runs a claimed job's task and records its outcome
+
+    Failures are retried after RETRY_DELAY, doubled for every earlier attempt, until
+    the job has been tried max_attempts times
+
+    Args:
+        job (Job): A job returned by claim()
+
+    Returns:
+        Job: The job, with its new status
+    """
+    function = TASKS.get(job.task)
+    try:
+        if function is None:
+            raise ValueError(f"Unknown task: {job.task}")
+        with heartbeat(job):
+            result = function(job, **job.payload)
+    except Exception as error:
+        logger.exception("Job %s failed on attempt %s", job.pk, job.attempts)
+        job.error = f"{type(error).__name__}: {error}"
+        if function is not None and job.attempts < job.max_attempts:
+            job.status = Job.QUEUED
+            job.run_after = timezone.now() + datetime.timedelta(seconds=RETRY_DELAY * 2 ** (job.attempts - 1))
+        else:
+            job.status = Job.FAILED
+            job.finished_at = timezone.now()
+    else:
+        job.status = Job.SUCCEEDED
+        job.result = result
+        job.error = ""
+        job.finished_at = timezone.now()
+    job.save(update_fields=["status", "result", "error", "run_after", "finished_at"])
+    return job
+
+
+def requeue_stale(timeout=None):
+    """
+    Queues again the jobs whose worker has sent no heartbeat for longer than timeout,
+    which were left behind by a worker that stopped, or fails them if they have no
+    attempts left
+
+    Args:
+        timeout (int): Seconds a running job may go without a heartbeat, defaults to DISTANCE_JOB_TIMEOUT
+
+    Returns:
+        int: Number of jobs queued again or failed
+    """
+    timeout = timeout if timeout is not None else settings.DISTANCE_JOB_TIMEOUT
+    now = timezone.now()
+    cutoff = now - datetime.timedelta(seconds=timeout)
+    # Jobs claimed before heartbeats were recorded only have the time they were started
+    stale = Job.objects.filter(
+        Q(heartbeat_at__lt=cutoff) | Q(heartbeat_at__isnull=True, started_at__lt=cutoff), status=Job.RUNNING,
+    )
+    failed = stale.filter(attempts__gte=F("max_attempts")).update(
+        status=Job.FAILED, finished_at=now, error="The worker running the job stopped",
+    )
+    return failed + stale.update(status=Job.QUEUED, run_after=now)
+
+
+def expire_files(retention=None):
+    """
+    Deletes the files in DISTANCE_JOB_DIR written more than retention seconds ago, such
+    as exports and the uploads of imports that failed, unless a job waiting to run or
+    running still needs them
+
+    Args:
+        retention (int): Seconds files are kept for, defaults to DISTANCE_JOB_RETENTION
+
+    Returns:
+        int: Number of files deleted
+    """
+    retention = retention if retention is not None else settings.DISTANCE_JOB_RETENTION
+    if not os.path.isdir(settings.DISTANCE_JOB_DIR):
+        return 0
+    cutoff = time.time() - retention
+    unfinished = Job.objects.filter(status__in=[Job.QUEUED, Job.RUNNING]).values_list("payload", flat=True)
+    needed = {os.path.abspath(payload["path"]) for payload in unfinished if payload.get("path")}
+
+    deleted = 0
+    with os.scandir(settings.DISTANCE_JOB_DIR) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.stat().st_mtime < cutoff and os.path.abspath(entry.path) not in needed:
+                os.remove(entry.path)
+                deleted += 1
+    return deleted
+
+
+def work(worker, burst=False, poll=1.0, limit=None):
+    """
+    Runs jobs as they become due
+
+    Args:
+        worker (str): Name of the worker
+        burst (bool): Return once no job is due, rather than waiting for more
+        poll (float): Seconds to wait between looking for due jobs when the queue is empty
+        limit (int): Return after running this many jobs
+
+    Returns:
+        int: Number of jobs run
+    """
+    count = 0
+    expired_at = None
+    while limit is None or count < limit:
+        requeue_stale()
+        if expired_at is None or time.monotonic() - expired_at >= EXPIRE_INTERVAL:
+            expire_files()
+            expired_at = time.monotonic()
+        job = claim(worker)
+        if job is None:
+            if burst:
+                break
+            time.sleep(poll)
+            continue
+        logger.info("Running job %s (%s)", job.pk, job.task)
+        run(job)
+        count += 1
+    return count
+
+
+def job_path(suffix=""):
+    """Returns the path of a new, empty file in DISTANCE_JOB_DIR"""
+    os.makedirs(settings.DISTANCE_JOB_DIR, exist_ok=True)
+    handle, path = tempfile.mkstemp(suffix=suffix, dir=settings.DISTANCE_JOB_DIR)
+    os.close(handle)
+    return path
+
+
+def save_upload(upload, suffix=""):
+    """Copies an uploaded file into DISTANCE_JOB_DIR, so a worker can read it, and returns its path"""
+    path = job_path(suffix)
+    with open(path, "wb") as file:
+        for chunk in upload.chunks():
+            file.write(chunk)
+    return path
+
+
+@task("import_distances")
+def import_file(job, path, format="csv"):
+    """Imports distances from an uploaded file, reporting progress in rows"""
+    with open(path, encoding="utf-8-sig", newline="") as file:
+        report(job, 0, sum(1 for line in file if line.strip()) - (1 if format == "csv" else 0))
+    with open(path, encoding="utf-8-sig", newline="") as file:
+        result = import_distances(read_rows(file, format), progress=lambda read: report(job, read))
+    os.remove(path)
+    return {
+        "created": result.created,
+        "errors": result.errors[:MAX_REPORTED_ERRORS],
+        "error_count": len(result.errors),
+    }
+
+
+@task("export_distances")
+def export_file(job, format="csv", date_from=None, date_to=None):
+    """Writes distances to a file in DISTANCE_JOB_DIR, reporting progress in rows"""
+    distances = Distance.objects.all()
+    if date_from:
+        distances = distances.filter(date__gte=date_from)
+    if date_to:
+        distances = distances.filter(date__lte=date_to)
+    total = distances.count()
+    report(job, 0, total)
+
+    path = job_path(".jsonl" if format == "json" else ".csv")
+    with open(path, "w", encoding="utf-8", newline="") as file:
+        for line in exporter.encode(_counted(exporter.export_rows(distances), job, total), format):
+            file.write(line)
+    return {"path": path, "format": format, "rows": total}
+
+
+def _counted(rows, job, total, every=2000):
+    """Passes rows through, reporting progress every few thousand"""
+    for count, row in enumerate(rows, start=1):
+        if count % every == 0:
+            report(job, count)
+        yield row
+    report(job, total)
+
+
+@task("rebuild_rollups")
+def rebuild_rollups(job, normalize=False):
+    """Rebuilds the running totals, optionally renormalizing every distance first, then verifies them"""
+    steps = 3 if normalize else 2
+    report(job, 0, steps)
+    if normalize:
+        Distance.objects.all().normalize()
+        ArchivedDistance.objects.all().normalize()
+        report(job, 1)
+    rollups.rebuild()
+    report(job, steps - 1)
+    mismatches = rollups.verify()
+    report(job, steps)
+    return {"mismatches": mismatches[:MAX_REPORTED_ERRORS]}
+
+
+@task("refresh_leaderboards")
+def refresh_leaderboards(job, all=True, dates=None, boards=leaderboards.BOARDS):
+    """
+    Recomputes every leaderboard, or the boards containing the dates, or only the
+    current ones
+
+    Other refresh jobs still queued are folded into this one, since their boards
+    are refreshed from the same running totals
+    """
+    # Without dates only the current boards are refreshed
+    dates = set(dates or [timezone.localdate().isoformat()])
+    boards = set(boards)
+    queued = Job.objects.filter(task="refresh_leaderboards", status=Job.QUEUED).exclude(pk=job.pk)
+    with transaction.atomic():
+        merged = False
+        for other in queued.only("pk", "payload"):
+            # Only matches while the job is still queued, as in claim()
+            if Job.objects.filter(pk=other.pk, status=Job.QUEUED).update(
+                    status=Job.SUCCEEDED, finished_at=timezone.now(), result={"merged_into": job.pk}):
+                merged = True
+                all = all or other.payload.get("all", True)
+                dates.update(other.payload.get("dates", []))
+                boards.update(other.payload.get("boards", leaderboards.BOARDS))
+        if merged:
+            # Saved with the merge, so a retry after a failed refresh still covers the merged jobs
+            job.payload = {"all": all, "dates": sorted(dates), "boards": sorted(boards)}
+            Job.objects.filter(pk=job.pk).update(payload=job.payload)
+
+    if all:
+        leaderboards.refresh_all(sorted(boards))
+    else:
+        leaderboards.refresh_dates([datetime.date.fromisoformat(date) for date in dates], sorted(boards))
+    return {}
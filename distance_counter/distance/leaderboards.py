@@ -0,0 +1,229 @@
+"""Precomputed leaderboards
+
+Rankings are computed from the rollup tables rather than the Distance table and
+stored in Ranking, so serving a board never aggregates at request time.
+
+Refreshing a board recomputes everyone on it, so it is kept off the request path.
+The dates a transaction's writes touch are collected and, once it commits, the
+DISTANCE_LEADERBOARD_REFRESH setting decides what happens to them: with "job" (the
+default) a single background job refreshing their boards is queued, unless one
+already queued covers them, with "write" the boards are refreshed straight away,
+which only suits small installations, and with "schedule" nothing is done and the
+refresh_leaderboards management command has to be run periodically.
+"""
+import datetime
+import threading
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from .models import DailyTotal, Job, OfficeTotal, PersonTotal, RankedBoard, Ranking
+
+BOARDS = (Ranking.PEOPLE, Ranking.OFFICES)
+
+
+def period_start(period, date):
+    """
+    Returns the first day of the period containing date, or None for the overall board
+
+    Weeks start on a Monday
+    """
+    if period == Ranking.MONTH:
+        return date.replace(day=1)
+    if period == Ranking.WEEK:
+        return date - datetime.timedelta(days=date.weekday())
+    return None
+
+
+def period_end(period, start):
+    """Returns the day after the last day of the period beginning on start"""
+    if period == Ranking.MONTH:
+        return (start + datetime.timedelta(days=32)).replace(day=1)
+    if period == Ranking.WEEK:
+        return start + datetime.timedelta(days=7)
+    return None
+
+
+def in_range(period, date):
+    """Whether the period containing date ends on a date that can be represented, i.e. before 9999-12-31"""
+    try:
+        period_end(period, period_start(period, date))
+    except OverflowError:
+        return False
+    return True
+
+
+def _totals(board, period, start):
+    """Returns (subject_id, name, total) for everyone with a distance in the period"""
+    if period == Ranking.OVERALL:
+        if board == Ranking.PEOPLE:
+            rows = PersonTotal.objects.filter(entries__gt=0).values_list(
+                "person_id", "person__first_name", "person__last_name", "total")
+            return [(pk, f"{first} {last}", total) for pk, first, last, total in rows]
+        return list(OfficeTotal.objects.filter(entries__gt=0).values_list("office_id", "office__city", "total"))
+
+    days = DailyTotal.objects.filter(date__gte=start, date__lt=period_end(period, start))
+    if board == Ranking.PEOPLE:
+        rows = days.values_list("person_id", "person__first_name", "person__last_name").annotate(sum=Sum("total"))
+        return [(pk, f"{first} {last}", total) for pk, first, last, total in rows]
+    return list(days.values_list("person__location_id", "person__location__city").annotate(sum=Sum("total")))
+
+
+def refresh(board, period, start=None):
+    """
+    Recomputes one leaderboard
+
+    Args:
+        board (str): Ranking.PEOPLE or Ranking.OFFICES
+        period (str): Ranking.OVERALL, Ranking.MONTH or Ranking.WEEK
+        start (Date): First day of the month or week, ignored for the overall board
+    """
+    start = period_start(period, start) if start else None
+    totals = sorted(_totals(board, period, start), key=lambda row: (-row[2], row[1]))
+
+    rankings = []
+    previous = None
+    for position, (subject_id, name, total) in enumerate(totals, start=1):
+        # Equal totals share a rank, and the next rank skips past them (1, 1, 3)
+        rank = rankings[-1].rank if total == previous else position
+        previous = total
+        rankings.append(Ranking(board=board, period=period, period_start=start,
+                                subject_id=subject_id, name=name[:100], total=total, rank=rank))
+
+    with transaction.atomic():
+        Ranking.objects.filter(board=board, period=period, period_start=start).delete()
+        Ranking.objects.bulk_create(rankings, batch_size=1000)
+        # Marks the board as computed, even when nobody is on it
+        if not RankedBoard.objects.filter(board=board, period=period, period_start=start).update(
+                refreshed_at=timezone.now()):
+            RankedBoard.objects.create(board=board, period=period, period_start=start)
+
+
+def refresh_dates(dates, boards=BOARDS):
+    """Refreshes the overall boards and every month and week board containing one of dates"""
+    periods = {(Ranking.OVERALL, None)}
+    for date in dates:
+        periods.add((Ranking.MONTH, period_start(Ranking.MONTH, date)))
+        periods.add((Ranking.WEEK, period_start(Ranking.WEEK, date)))
+    for board in boards:
+        for period, start in periods:
+            refresh(board, period, start)
+
+
+def refresh_all(boards=BOARDS):
+    """Refreshes every board for every month and week that has a distance"""
+    refresh_dates(DailyTotal.objects.dates("date", "day"), boards)
+
+
+class _PendingRefresh:
+    """The dates and boards a transaction's writes touched, dealt with once it commits"""
+    def __init__(self):
+        self.dates = set()
+        self.boards = set()
+        self.done = False
+
+    def __call__(self):
+        # Registered once per write, but only the first call after the commit does anything
+        if self.done:
+            return
+        self.done = True
+        if getattr(_local, "pending", None) is self:
+            _local.pending = None
+        mode = getattr(settings, "DISTANCE_LEADERBOARD_REFRESH", "job")
+        if mode == "write":
+            refresh_dates(self.dates, sorted(self.boards))
+        elif mode == "job":
+            queue_refresh(self.dates, self.boards)
+
+
+# The pending refresh of each thread's current transaction
+_local = threading.local()
+
+
+def _pending():
+    """
+    Returns the current transaction's pending refresh, starting a new one if it has none
+
+    A pending refresh is kept until its callback runs. One left behind by a
+    transaction that rolled back is picked up by the next, which then refreshes a
+    few boards more than it needs to
+    """
+    pending = getattr(_local, "pending", None)
+    if pending is None or pending.done or not transaction.get_connection().in_atomic_block:
+        pending = _local.pending = _PendingRefresh()
+    return pending
+
+
+def changed(dates, boards=BOARDS):
+    """
+    Called after a write touching the given dates. The boards they affect are
+    refreshed, or a job is queued to, once the transaction commits, however many
+    writes the transaction made
+    """
+    if getattr(settings, "DISTANCE_LEADERBOARD_REFRESH", "job") == "schedule":
+        return
+    pending = _pending()
+    pending.dates.update(dates)
+    pending.boards.update(boards)
+    # Registered by every write, so the refresh still runs if the savepoint that
+    # first registered it was rolled back
+    transaction.on_commit(pending)
+
+
+def queue_refresh(dates, boards=BOARDS):
+    """
+    Queues a background job refreshing the boards containing the dates
+
+    Nothing is queued if a job still waiting to run already covers them, since it
+    reads the running totals when it runs, after this write has committed
+
+    Returns:
+        Job: The queued job, or None if one already covers the dates
+    """
+    from .jobs import enqueue
+
+    dates = {date.isoformat() for date in dates}
+    for payload in Job.objects.filter(task="refresh_leaderboards", status=Job.QUEUED).values_list("payload", flat=True):
+        if payload.get("all", True) or (dates <= set(payload.get("dates", [])) and set(boards) <= set(payload.get("boards", BOARDS))):
+            return None
+    return enqueue("refresh_leaderboards", {"all": False, "dates": sorted(dates), "boards": sorted(boards)})
+
+
+def top(board, period, start=None, size=10):
+    """
+    Returns the first size entries of a leaderboard
+
+    A board that has never been refreshed is computed first
+    """
+    start = period_start(period, start) if start else None
+    rankings = list(Ranking.objects.filter(board=board, period=period, period_start=start).order_by("rank", "name")[:size])
+    if not rankings and not RankedBoard.objects.filter(board=board, period=period, period_start=start).exists():
+        refresh(board, period, start)
+        rankings = list(Ranking.objects.filter(board=board, period=period, period_start=start).order_by("rank", "name")[:size])
+    return rankings
+
+
+def position(board, period, subject_id, start=None):
+    """Returns the Ranking of one person or office on a leaderboard, or None if they are not on it"""
+    start = period_start(period, start) if start else None
+    return Ranking.objects.filter(board=board, period=period, period_start=start, subject_id=subject_id).first()
+
+
+async def atop(board, period, start=None, size=10):
+    """Async version of top(), for the async views"""
+    start = period_start(period, start) if start else None
+    rankings = Ranking.objects.filter(board=board, period=period, period_start=start).order_by("rank", "name")[:size]
+    found = [ranking async for ranking in rankings]
+    if not found and not await RankedBoard.objects.filter(board=board, period=period, period_start=start).aexists():
+        await sync_to_async(refresh)(board, period, start)
+        found = [ranking async for ranking in rankings.all()]
+    return found
+
+
+async def aposition(board, period, subject_id, start=None):
+    """Async version of position()"""
+    start = period_start(period, start) if start else None
+    return await Ranking.objects.filter(board=board, period=period, period_start=start, subject_id=subject_id).afirst()
@@ -0,0 +1,138 @@
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+import django
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, setup_test_environment, teardown_test_environment
+from django.urls import reverse
+
+from distance import caching
+from distance.models import Distance, Office, Person, Unit
+
+
+def benchmark_urls():
+    """The list and detail pages to measure, as (name, url) pairs"""
+    distance = Distance.objects.order_by("id").first()
+    person = Person.objects.order_by("id").first()
+    office = Office.objects.order_by("id").first()
+    unit = Unit.objects.order_by("id").first()
+    return [
+        ("index", reverse("index")),
+        ("people", reverse("people")),
+        ("offices", reverse("offices")),
+        ("units", reverse("units")),
+        ("distance", reverse("distance", args=[distance.id])),
+        ("person", reverse("person", args=[person.id])),
+        ("office", reverse("office", args=[office.id])),
+        ("unit", reverse("unit", args=[unit.id])),
+        ("log", reverse("log")),
+        ("leaderboard_people", reverse("leaderboard", args=["people"])),
+        ("leaderboard_offices", reverse("leaderboard", args=["offices"])),
+    ]
+
+
+class Command(BaseCommand):
+    """
+    Measures latency, query count, response size and peak memory of every list
+    and detail view at several data sizes
+
+    Runs against a throwaway test database filled by generate_data, so the
+    configured database is never touched. The JSON report can be diffed between releases
+    """
+    help = "Benchmarks the list and detail views against generated data of several sizes"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", default="1000,10000,100000",
+                            help="Comma separated numbers of distances to benchmark with")
+        parser.add_argument("--repeat", type=int, default=5, help="Timed requests per view")
+        parser.add_argument("-o", "--output", help="File to write the JSON report to, defaults to stdout")
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options["sizes"].split(",")]
+        report = {
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "database": connection.vendor,
+            "repeat": options["repeat"],
+            "sizes": {},
+        }
+
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            for size in sizes:
+                self.stderr.write(f"Benchmarking with {size} distances")
+                report["sizes"][str(size)] = self.benchmark(size, options["repeat"])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as file:
+                file.write(output + "\n")
+        else:
+            self.stdout.write(output)
+
+    def benchmark(self, size, repeat):
+        # bulk_delete takes the rows out of the rollups at once rather than per row
+        Distance.objects.all().bulk_delete()
+        Person.objects.all().delete()
+        Office.objects.all().delete()
+        people = max(10, size // 50)
+        call_command("generate_data", distances=size, people=people, offices=max(2, people // 100),
+                     stdout=sys.stderr)
+
+        user, _ = User.objects.get_or_create(username="benchmark", defaults={"is_superuser": True})
+        client = Client()
+        client.force_login(user)
+
+        results = {}
+        for name, url in benchmark_urls():
+            client.get(url)  # warm up the leaderboards and the connection
+            # Cold requests render every fragment, warm ones are served from the fragment cache
+            results[name] = {
+                "cold": self.measure(client, url, repeat, cold=True),
+                "warm": self.measure(client, url, repeat, cold=False),
+            }
+            self.stderr.write(
+                f"  {name:<22} cold {results[name]['cold']['median_ms']:>9.2f}ms "
+                f"{results[name]['cold']['queries']:>6} queries, "
+                f"warm {results[name]['warm']['median_ms']:>9.2f}ms {results[name]['warm']['queries']:>6} queries"
+            )
+        return results
+
+    def measure(self, client, url, repeat, cold):
+        """Times a view, emptying the fragment cache before every request if cold is set"""
+        timings = []
+        for _ in range(repeat):
+            if cold:
+                caching.get_cache().clear()
+            start = time.perf_counter()
+            client.get(url)
+            timings.append((time.perf_counter() - start) * 1000)
+
+        if cold:
+            caching.get_cache().clear()
+        tracemalloc.start()
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(url)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        return {
+            "status": response.status_code,
+            "median_ms": round(statistics.median(timings), 2),
+            "min_ms": round(min(timings), 2),
+            "queries": len(queries),
+            "bytes": len(response.content),
+            "peak_memory_kb": round(peak / 1024, 1),
+        }
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from distance import archive
+
+
+class Command(BaseCommand):
+    """
+    Moves a finished year's distances out of the Distance table into ArchivedDistance
+
+    The archived distances still count towards the running totals and the history
+    pages, but no longer slow down queries on the current year
+    """
+    help = "Archives the distances of a finished challenge year"
+
+    def add_arguments(self, parser):
+        parser.add_argument("year", type=int, help="The year to close")
+        parser.add_argument("--batch-size", type=int, default=archive.BATCH_SIZE, help="Number of distances moved at a time")
+        parser.add_argument("--vacuum", action="store_true", help="Shrink the SQLite database file afterwards")
+
+    def handle(self, *args, **options):
+        try:
+            closed = archive.close_year(options["year"], batch_size=options["batch_size"])
+        except ValueError as error:
+            raise CommandError(error)
+        if options["vacuum"]:
+            archive.vacuum()
+        self.stdout.write(self.style.SUCCESS(
+            f"Archived {closed.year}: {closed.distances} distances from {closed.start_date} to {closed.end_date}"
+        ))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from distance.exporter import FORMATS, encode, export_rows
+
+
+class Command(BaseCommand):
+    """
+    Streams every distance, joined to its person, office and unit, to a file or stdout
+    """
+    help = "Exports distances as CSV or JSON Lines"
+
+    def add_arguments(self, parser):
+        parser.add_argument("-o", "--output", help="File to write, defaults to stdout")
+        parser.add_argument("--format", choices=list(FORMATS), default="csv")
+
+    def handle(self, *args, **options):
+        lines = encode(export_rows(), options["format"])
+        if options["output"]:
+            with open(options["output"], "w", encoding="utf-8", newline="") as output:
+                output.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending="")
@@ -0,0 +1,117 @@
+import datetime
+import random
+import time
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from distance import caching, leaderboards, rollups, search
+from distance.models import Distance, Office, Person, Unit, fingerprint
+
+CITIES = [
+    ("Cambridge", "UK"), ("Manchester", "UK"), ("Sheffield", "UK"), ("Austin", "USA"),
+    ("San Jose", "USA"), ("Bangalore", "India"), ("Shanghai", "China"), ("Nice", "France"),
+    ("Lund", "Sweden"), ("Trondheim", "Norway"), ("Hsinchu", "Taiwan"), ("Munich", "Germany"),
+]
+FIRST_NAMES = ["Alex", "Sam", "Jo", "Chris", "Priya", "Wei", "Maria", "Tom", "Aisha", "Lars", "Yuki", "Omar"]
+LAST_NAMES = ["Smith", "Jones", "Patel", "Chen", "Garcia", "Brown", "Nielsen", "Kim", "Okafor", "Rossi"]
+
+# Units and the weighting of how often each is used, with a sensible range of values
+UNITS = [
+    ("km", Decimal("1000"), False, 50, (1, 25)),
+    ("miles", Decimal("1609.344"), False, 30, (1, 15)),
+    ("steps", Decimal("1"), True, 20, (2000, 20000)),
+]
+
+
+class Command(BaseCommand):
+    """
+    Generates realistic synthetic offices, people and distances with bulk inserts
+
+    Distances are spread over a date range, weighted towards a subset of keen
+    people, and the rollups and leaderboards are rebuilt once at the end
+    """
+    help = "Fills the database with synthetic offices, people and distances"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--offices", type=int, default=12)
+        parser.add_argument("--people", type=int, default=1000)
+        parser.add_argument("--distances", type=int, default=100000)
+        parser.add_argument("--start", type=datetime.date.fromisoformat, default=datetime.date(2023, 1, 1),
+                            help="First date to log distances on (YYYY-MM-DD)")
+        parser.add_argument("--days", type=int, default=365, help="Number of days to spread distances over")
+        parser.add_argument("--batch-size", type=int, default=5000)
+        parser.add_argument("--seed", type=int, default=1)
+
+    def handle(self, *args, **options):
+        random.seed(options["seed"])
+        batch_size = options["batch_size"]
+        started = time.perf_counter()
+
+        offices = []
+        for n in range(options["offices"]):
+            city, country = CITIES[n % len(CITIES)]
+            if n >= len(CITIES):
+                city = f"{city} {n // len(CITIES) + 1}"
+            offices.append(Office(city=city, country=country))
+        offices = Office.objects.bulk_create(offices)
+
+        people = Person.objects.bulk_create(
+            (Person(
+                first_name=random.choice(FIRST_NAMES),
+                last_name=random.choice(LAST_NAMES),
+                email=f"person{n}@example.com",
+                location=random.choice(offices),
+            ) for n in range(options["people"])),
+            batch_size=batch_size,
+        )
+        person_ids = [person.id for person in people]
+
+        units = []
+        for name, factor, is_steps, weight, values in UNITS:
+            unit, _ = Unit.objects.get_or_create(
+                unit_of_measurement=name, defaults={"metres_per_unit": factor, "is_steps": is_steps}
+            )
+            units.append((unit.id, unit.factor, weight, values))
+        unit_weights = [weight for _, _, weight, _ in units]
+        # A few people log far more often than everyone else
+        person_weights = [random.paretovariate(1.5) for _ in person_ids]
+        cent = Decimal("0.01")
+
+        remaining = options["distances"]
+        while remaining > 0:
+            count = min(batch_size, remaining)
+            chosen_people = random.choices(person_ids, weights=person_weights, k=count)
+            chosen_units = random.choices(units, weights=unit_weights, k=count)
+            batch = []
+            for person_id, (unit_id, factor, _, (low, high)) in zip(chosen_people, chosen_units):
+                value = Decimal(random.uniform(low, high)).quantize(cent)
+                date = options["start"] + datetime.timedelta(days=random.randrange(options["days"]))
+                batch.append(Distance(
+                    date=date,
+                    person_id=person_id,
+                    distance=value,
+                    unit_id=unit_id,
+                    normalized_distance=(value * factor).quantize(cent),
+                    fingerprint=fingerprint(person_id, date, value, unit_id),
+                ))
+            with transaction.atomic():
+                Distance.objects.bulk_create(batch)
+            remaining -= count
+
+        # bulk_create sends no signals, so the derived tables are built once at the end
+        search.rebuild()
+        rollups.rebuild()
+        for model in (Office, Person, Unit, Distance):
+            caching.bump(model)
+        if settings.DISTANCE_LEADERBOARD_REFRESH != "write":
+            # rebuild only refreshes the leaderboards itself when they are refreshed on write,
+            # otherwise there would be nothing to show until a worker got to them
+            leaderboards.refresh_all()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Generated {len(offices)} offices, {len(people)} people and {options['distances']} distances "
+            f"in {time.perf_counter() - started:.1f}s"
+        ))
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from distance.importer import FORMATS, import_distances, read_rows
+
+
+class Command(BaseCommand):
+    """
+    Imports distances from a CSV or JSON Lines file
+
+    See distance/importer.py for the expected columns
+    """
+    help = "Bulk imports distances from a CSV or JSON Lines file"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="File to import")
+        parser.add_argument("--format", choices=FORMATS, help="File format, guessed from the extension by default")
+        parser.add_argument("--chunk-size", type=int, default=1000, help="Rows inserted per transaction")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        format = options["format"] or ("json" if path.endswith((".json", ".jsonl", ".ndjson")) else "csv")
+
+        try:
+            with open(path, encoding="utf-8-sig", newline="") as stream:
+                result = import_distances(read_rows(stream, format), chunk_size=options["chunk_size"])
+        except OSError as error:
+            raise CommandError(f"Could not read {path}: {error}")
+
+        for line_num, message in result.errors:
+            self.stderr.write(f"Line {line_num}: {message}")
+        self.stdout.write(self.style.SUCCESS(str(result)))
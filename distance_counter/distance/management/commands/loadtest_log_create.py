@@ -0,0 +1,119 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test import Client
+from django.test.utils import setup_test_environment
+from django.urls import reverse
+
+from distance.models import Office, Person, Unit
+
+PROFILES = ["development", "production"]
+
+
+class Command(BaseCommand):
+    """
+    Measures concurrent write throughput of the log_create view
+
+    With --compare, runs the load test once per database profile, each in a fresh
+    process against a new temporary SQLite file, and prints the results side by side.
+    Without it, runs against the database configured by DISTANCE_DB_PROFILE and
+    DISTANCE_DB_NAME, which must be a scratch database as test rows are added to it
+    """
+    help = "Load tests concurrent POSTs to log_create and reports requests per second"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threads", type=int, default=8, help="Number of concurrent clients")
+        parser.add_argument("--requests", type=int, default=50, help="Requests made by each client")
+        parser.add_argument("--compare", action="store_true",
+                            help="Run every database profile against a temporary database and compare them")
+        parser.add_argument("--json", action="store_true", help="Print the result as JSON")
+
+    def handle(self, *args, **options):
+        if options["compare"]:
+            return self.compare(options)
+
+        result = self.run(options["threads"], options["requests"])
+        if options["json"]:
+            self.stdout.write(json.dumps(result))
+        else:
+            self.report([result])
+
+    def compare(self, options):
+        results = []
+        for profile in PROFILES:
+            with tempfile.TemporaryDirectory() as directory:
+                env = dict(os.environ, DISTANCE_DB_PROFILE=profile,
+                           DISTANCE_DB_NAME=os.path.join(directory, "loadtest.sqlite3"))
+                subprocess.run([sys.executable, sys.argv[0], "migrate", "-v0"], env=env, check=True)
+                output = subprocess.run(
+                    [sys.executable, sys.argv[0], "loadtest_log_create", "--json",
+                     "--threads", str(options["threads"]), "--requests", str(options["requests"])],
+                    env=env, check=True, capture_output=True, text=True,
+                ).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+        self.report(results)
+
+    def report(self, results):
+        self.stdout.write(f"{'profile':<12} {'ok':>6} {'failed':>6} {'seconds':>8} {'req/s':>8}")
+        for result in results:
+            self.stdout.write(
+                f"{result['profile']:<12} {result['ok']:>6} {result['failed']:>6} "
+                f"{result['seconds']:>8.2f} {result['per_second']:>8.1f}"
+            )
+
+    def run(self, threads, requests):
+        if connection.vendor != "sqlite":
+            raise CommandError("The load test is for SQLite databases")
+        setup_test_environment()
+
+        user, _ = User.objects.get_or_create(username="loadtest")
+        office = Office.objects.create(city="Load Test", country="Load Test")
+        people = [
+            Person.objects.create(first_name="Load", last_name=f"Tester {n}",
+                                  email=f"loadtest{n}@example.com", location=office)
+            for n in range(threads)
+        ]
+        unit = Unit.objects.create(unit_of_measurement="km", metres_per_unit=1000)
+        connection.close()
+
+        counts = {"ok": 0, "failed": 0}
+        lock = threading.Lock()
+
+        def client(person):
+            browser = Client(raise_request_exception=False)
+            browser.force_login(user)
+            for n in range(requests):
+                # Every row differs in its distance, so none is rejected as a duplicate
+                response = browser.post(reverse("log_create"), {
+                    "date": f"2023-09-{n % 28 + 1:02d}", "person": person.id, "distance": f"{n + 1.5:.2f}", "unit": unit.id,
+                })
+                with lock:
+                    counts["ok" if response.status_code == 302 else "failed"] += 1
+            connections.close_all()
+
+        workers = [threading.Thread(target=client, args=(person,)) for person in people]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        seconds = time.perf_counter() - start
+
+        return {
+            "profile": settings.DATABASE_PROFILE,
+            "threads": threads,
+            "requests": threads * requests,
+            "ok": counts["ok"],
+            "failed": counts["failed"],
+            "seconds": seconds,
+            "per_second": counts["ok"] / seconds,
+        }
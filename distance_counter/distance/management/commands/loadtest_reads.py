@@ -0,0 +1,135 @@
+import asyncio
+import json
+import sys
+import threading
+import time
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+from django.test import AsyncClient, Client
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.urls import reverse
+
+from distance.models import Distance, Person
+
+# (label, client, whether to use the async views)
+PATHS = [
+    ("wsgi-sync", "wsgi", False),
+    ("asgi-sync", "asgi", False),
+    ("asgi-async", "asgi", True),
+]
+
+
+def read_urls(use_async):
+    """The read-heavy pages, at either the synchronous or the async views"""
+    prefix = "async_" if use_async else ""
+    distance = Distance.objects.order_by("id").first()
+    person = Person.objects.order_by("id").first()
+    return [
+        reverse(f"{prefix}index"),
+        reverse(f"{prefix}distance", args=[distance.id]),
+        reverse(f"{prefix}people"),
+        reverse(f"{prefix}person", args=[person.id]),
+        reverse(f"{prefix}leaderboard", args=["people"]),
+    ]
+
+
+class Command(BaseCommand):
+    """
+    Measures concurrent read throughput through the WSGI handler with the synchronous
+    views, and through the ASGI handler with the synchronous and the async views
+
+    WSGI clients each run in their own thread, like a threaded WSGI server, while ASGI
+    clients are tasks on one event loop, like a single uvicorn worker. Runs against a
+    throwaway test database filled by generate_data, so the configured database is never touched
+    """
+    help = "Load tests the read views under WSGI and ASGI and reports requests per second"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--concurrency", type=int, default=8, help="Number of concurrent clients")
+        parser.add_argument("--requests", type=int, default=50, help="Requests made by each client")
+        parser.add_argument("--distances", type=int, default=10000, help="Number of distances to generate")
+        parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            people = max(10, options["distances"] // 50)
+            call_command("generate_data", distances=options["distances"], people=people,
+                         offices=max(2, people // 100), stdout=sys.stderr)
+            user, _ = User.objects.get_or_create(username="loadtest")
+            results = [
+                self.run(label, interface, read_urls(use_async), user, options["concurrency"], options["requests"])
+                for label, interface, use_async in PATHS
+            ]
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        if options["json"]:
+            self.stdout.write(json.dumps(results))
+            return
+        self.stdout.write(f"{'path':<12} {'ok':>6} {'failed':>6} {'seconds':>8} {'req/s':>8}")
+        for result in results:
+            self.stdout.write(
+                f"{result['path']:<12} {result['ok']:>6} {result['failed']:>6} "
+                f"{result['seconds']:>8.2f} {result['per_second']:>8.1f}"
+            )
+
+    def run(self, label, interface, urls, user, concurrency, requests):
+        counts = {"ok": 0, "failed": 0}
+        lock = threading.Lock()
+
+        def record(response):
+            with lock:
+                counts["ok" if response.status_code == 200 else "failed"] += 1
+
+        client_class = Client if interface == "wsgi" else AsyncClient
+        clients = []
+        for _ in range(concurrency):
+            client = client_class(raise_request_exception=False)
+            client.force_login(user)
+            clients.append(client)
+        # Warm up the caches and the leaderboards
+        for url in urls:
+            if interface == "wsgi":
+                clients[0].get(url)
+            else:
+                asyncio.run(clients[0].get(url))
+
+        start = time.perf_counter()
+        if interface == "wsgi":
+            def worker(client):
+                for n in range(requests):
+                    record(client.get(urls[n % len(urls)]))
+                connections.close_all()
+
+            threads = [threading.Thread(target=worker, args=(client,)) for client in clients]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        else:
+            async def worker(client):
+                for n in range(requests):
+                    record(await client.get(urls[n % len(urls)]))
+
+            async def main():
+                await asyncio.gather(*(worker(client) for client in clients))
+
+            asyncio.run(main())
+        seconds = time.perf_counter() - start
+
+        self.stderr.write(f"  {label}: {counts['ok'] / seconds:.1f} requests/s")
+        return {
+            "path": label,
+            "concurrency": concurrency,
+            "requests": concurrency * requests,
+            "ok": counts["ok"],
+            "failed": counts["failed"],
+            "seconds": seconds,
+            "per_second": counts["ok"] / seconds,
+        }
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+
+from distance.models import Distance
+
+
+class Command(BaseCommand):
+    """
+    Deletes exact duplicate distances, keeping the first one logged
+
+    Distances are read once in fingerprint order, straight from the fingerprint index,
+    so duplicates arrive next to each other and are found in a single pass. The
+    duplicates are then deleted in batches and taken out of the running totals
+    """
+    help = "Finds distances logged more than once and keeps only the first of each"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Only report the duplicates")
+        parser.add_argument("--batch-size", type=int, default=500, help="Number of duplicates deleted at a time")
+
+    def handle(self, *args, **options):
+        duplicates = []
+        groups = 0
+        previous = None
+        rows = Distance.objects.order_by("fingerprint", "id").values_list("id", "fingerprint")
+        for pk, fingerprint in rows.iterator(chunk_size=5000):
+            if fingerprint == previous:
+                if not duplicates or duplicates[-1][1] != fingerprint:
+                    groups += 1
+                duplicates.append((pk, fingerprint))
+            previous = fingerprint
+
+        if options["dry_run"]:
+            self.stdout.write(f"{len(duplicates)} duplicates of {groups} distances would be deleted")
+            return
+
+        ids = [pk for pk, fingerprint in duplicates]
+        for start in range(0, len(ids), options["batch_size"]):
+            Distance.objects.filter(pk__in=ids[start:start + options["batch_size"]]).bulk_delete()
+        self.stdout.write(self.style.SUCCESS(f"Deleted {len(ids)} duplicates of {groups} distances"))
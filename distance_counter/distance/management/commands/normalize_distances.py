@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from distance import rollups
+from distance.models import ArchivedDistance, Distance
+
+
+class Command(BaseCommand):
+    """
+    Recalculates the normalized (metres) value of every distance
+
+    Run this after changing the DISTANCE_STRIDE_LENGTH setting, since distances
+    logged in steps are normalized using the stride length at the time they were saved
+    """
+    help = "Recalculates normalized_distance for every distance record"
+
+    def handle(self, *args, **options):
+        Distance.objects.all().normalize()
+        ArchivedDistance.objects.all().normalize()
+        rollups.rebuild()
+        self.stdout.write(self.style.SUCCESS(f"Normalized {Distance.objects.count()} distances"))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from distance import rollups
+
+
+class Command(BaseCommand):
+    """
+    Rebuilds the person, office and daily running totals from the Distance table
+    (and the distances of closed years), then verifies them against it
+    """
+    help = "Rebuilds the rollup tables from scratch and verifies them against the Distance table"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--check", action="store_true",
+            help="Only verify the existing rollups, without rebuilding them",
+        )
+
+    def handle(self, *args, **options):
+        if not options["check"]:
+            rollups.rebuild()
+            self.stdout.write("Rebuilt rollups")
+
+        mismatches = rollups.verify()
+        for mismatch in mismatches:
+            self.stderr.write(mismatch)
+        if mismatches:
+            raise CommandError(f"{len(mismatches)} rollup rows do not match the Distance table")
+        self.stdout.write(self.style.SUCCESS("Rollups match the Distance table"))
@@ -0,0 +1,27 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+
+from distance import leaderboards
+
+
+class Command(BaseCommand):
+    """
+    Recomputes the precomputed leaderboards
+
+    Schedule this (e.g. from cron) when DISTANCE_LEADERBOARD_REFRESH is "schedule"
+    """
+    help = "Refreshes the overall, current month and current week leaderboards"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--all", action="store_true",
+            help="Refresh the boards for every month and week that has a distance",
+        )
+
+    def handle(self, *args, **options):
+        if options["all"]:
+            leaderboards.refresh_all()
+        else:
+            leaderboards.refresh_dates([datetime.date.today()])
+        self.stdout.write(self.style.SUCCESS("Leaderboards refreshed"))
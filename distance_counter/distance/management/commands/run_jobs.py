@@ -0,0 +1,33 @@
+import os
+import socket
+
+from django.core.management.base import BaseCommand
+
+from distance import jobs
+
+
+class Command(BaseCommand):
+    """
+    Runs queued background jobs, see distance/jobs.py
+
+    Keep at least one worker running alongside the web server (e.g. under systemd or
+    supervisor). Several workers can run at once, on one machine or many sharing the database
+    """
+    help = "Runs queued background jobs until stopped"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--burst", action="store_true",
+            help="Exit once no job is due, rather than waiting for more",
+        )
+        parser.add_argument("--poll", type=float, default=1.0, help="Seconds between checks of an empty queue")
+        parser.add_argument("--limit", type=int, help="Exit after running this many jobs")
+        parser.add_argument("--name", default=f"{socket.gethostname()}:{os.getpid()}", help="Name of this worker")
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"Worker {options['name']} waiting for jobs")
+        try:
+            count = jobs.work(options["name"], burst=options["burst"], poll=options["poll"], limit=options["limit"])
+        except KeyboardInterrupt:
+            return
+        self.stdout.write(self.style.SUCCESS(f"Ran {count} jobs"))
@@ -0,0 +1,41 @@
+import os
+import urllib.request
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from distance import assets
+
+
+class Command(BaseCommand):
+    """
+    Downloads the Bootstrap files used by layout.html into the static files
+
+    Each file is checked against the integrity hash layout.html has always used
+    before it is saved, and their source maps are saved alongside them. Run
+    collectstatic afterwards to serve them
+    """
+    help = f"Downloads Bootstrap {assets.BOOTSTRAP_VERSION} into static/{assets.BOOTSTRAP_DIR}"
+
+    def handle(self, *args, **options):
+        target = os.path.join(settings.STATICFILES_DIRS[0], assets.BOOTSTRAP_DIR)
+        files = [(path, sri) for path, sri in assets.BOOTSTRAP_FILES.values()]
+        # The source maps have no integrity hash, browsers don't check them
+        files += [(path, None) for path in assets.BOOTSTRAP_MAPS]
+        for path, sri in files:
+            url = assets.BOOTSTRAP_CDN + path
+            try:
+                with urllib.request.urlopen(url, timeout=30) as response:
+                    content = response.read()
+            except OSError as error:
+                raise CommandError(f"Could not download {url}: {error}")
+            if sri is not None and assets.integrity(content) != sri:
+                raise CommandError(f"{url} does not match its integrity hash {sri}")
+
+            destination = os.path.join(target, path)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            with open(destination, "wb") as file:
+                file.write(content)
+            self.stdout.write(f"Saved {destination}")
+        assets.vendored.cache_clear()
+        self.stdout.write(self.style.SUCCESS("Run `python manage.py collectstatic` to serve the downloaded files"))
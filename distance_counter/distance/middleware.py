@@ -0,0 +1,268 @@
+"""Per-request query count and latency instrumentation
+
+Enabled with the DISTANCE_QUERY_STATS setting. Each response gets a Server-Timing
+header with its SQL, template rendering and total time, and the numbers are
+aggregated per view into an in-process histogram shown on the query stats page.
+Requests making more than DISTANCE_QUERY_BUDGET queries are logged as warnings.
+
+StaticFilesMiddleware serves the files collected into STATIC_ROOT, with far future
+cache headers for the hashed copies and their precompressed variants.
+"""
+import bisect
+import logging
+import mimetypes
+import os
+import threading
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.db import connections
+from django.http import FileResponse, HttpResponseNotModified
+from django.template.backends.django import Template
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+BUCKETS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, float("inf")]
+
+_render_time = ContextVar("render_time", default=None)
+
+
+class ViewStats:
+    """Aggregated measurements for one view
+
+    Attributes:
+        requests (int): Number of requests measured
+        queries (int): Total number of SQL queries
+        max_queries (int): Most queries made by a single request
+        sql_ms (float): Total time spent in SQL
+        render_ms (float): Total time spent rendering templates
+        total_ms (float): Total time spent handling the requests
+        bytes (int): Total size of the response bodies
+        histogram (list): Count of requests in each of BUCKETS by total time
+
+    """
+    def __init__(self):
+        self.requests = 0
+        self.queries = 0
+        self.max_queries = 0
+        self.sql_ms = 0.0
+        self.render_ms = 0.0
+        self.total_ms = 0.0
+        self.bytes = 0
+        self.histogram = [0] * len(BUCKETS)
+
+    def add(self, queries, sql_ms, render_ms, total_ms, size):
+        self.requests += 1
+        self.queries += queries
+        self.max_queries = max(self.max_queries, queries)
+        self.sql_ms += sql_ms
+        self.render_ms += render_ms
+        self.total_ms += total_ms
+        self.bytes += size
+        self.histogram[bisect.bisect_left(BUCKETS, total_ms)] += 1
+
+
+_stats = {}
+_lock = threading.Lock()
+
+
+def get_stats():
+    """Returns a copy of the collected stats, as {view name: ViewStats}"""
+    with _lock:
+        return dict(sorted(_stats.items()))
+
+
+def reset_stats():
+    with _lock:
+        _stats.clear()
+
+
+def _record(view, queries, sql_ms, render_ms, total_ms, size):
+    with _lock:
+        _stats.setdefault(view, ViewStats()).add(queries, sql_ms, render_ms, total_ms, size)
+
+
+class _QueryTimer:
+    """A database execute wrapper counting queries and the time spent running them"""
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - start
+            self.queries += 1
+
+
+_original_render = Template.render
+
+
+def _timed_render(self, *args, **kwargs):
+    elapsed = _render_time.get()
+    if elapsed is None:
+        return _original_render(self, *args, **kwargs)
+    start = time.perf_counter()
+    try:
+        return _original_render(self, *args, **kwargs)
+    finally:
+        # Only the backend Template is timed, so {% include %} and {% extends %} aren't counted twice
+        elapsed[0] += time.perf_counter() - start
+
+
+class QueryStatsMiddleware:
+    """
+    Measures each request's SQL queries, render time, total time and response size
+
+    Not used unless the DISTANCE_QUERY_STATS setting is True
+    """
+    def __init__(self, get_response):
+        if not getattr(settings, "DISTANCE_QUERY_STATS", False):
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.budget = getattr(settings, "DISTANCE_QUERY_BUDGET", 50)
+        Template.render = _timed_render
+
+    def __call__(self, request):
+        timer = _QueryTimer()
+        render_time = [0.0]
+        token = _render_time.set(render_time)
+        start = time.perf_counter()
+        try:
+            with connections["default"].execute_wrapper(timer):
+                response = self.get_response(request)
+        finally:
+            _render_time.reset(token)
+        total_ms = (time.perf_counter() - start) * 1000
+
+        sql_ms = timer.seconds * 1000
+        render_ms = render_time[0] * 1000
+        size = 0 if response.streaming else len(response.content)
+        match = request.resolver_match
+        view = match.view_name if match else request.path
+
+        _record(view, timer.queries, sql_ms, render_ms, total_ms, size)
+        response["Server-Timing"] = ", ".join([
+            f'db;dur={sql_ms:.2f};desc="{timer.queries} queries"',
+            f"render;dur={render_ms:.2f}",
+            f"total;dur={total_ms:.2f}",
+        ])
+
+        if timer.queries > self.budget:
+            logger.warning(
+                "%s %s made %d queries, over the budget of %d (%.1fms in SQL, %.1fms total)",
+                request.method, request.path, timer.queries, self.budget, sql_ms, total_ms,
+            )
+        return response
+
+
+# Cache-Control for files whose names contain a hash of their content
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+# Precompressed copies saved by distance.storage, best first
+ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+
+
+class StaticFile:
+    """A collected static file and its precompressed copies
+
+    Attributes:
+        path (str): Where the file is
+        content_type (str): Its MIME type
+        variants (dict): (path, ETag) by content coding, '' being the file itself
+        cache_control (str): Cache-Control header to send with it
+
+    """
+    def __init__(self, path, cache_control):
+        self.path = path
+        self.content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        self.cache_control = cache_control
+        self.variants = {}
+        for encoding, suffix in [("", "")] + ENCODINGS:
+            if os.path.exists(path + suffix):
+                stat = os.stat(path + suffix)
+                self.variants[encoding] = (path + suffix, f'"{stat.st_size:x}-{int(stat.st_mtime):x}{suffix}"')
+
+    def encoding(self, accept_encoding):
+        """Returns the best content coding the browser accepts that a copy is saved in"""
+        accepted = set()
+        for coding in accept_encoding.split(","):
+            name, _, params = coding.partition(";")
+            weight = params.strip()
+            try:
+                quality = float(weight[2:]) if weight.startswith("q=") else 1
+            except ValueError:
+                quality = 0
+            if quality > 0:
+                accepted.add(name.strip().lower())
+        return next((encoding for encoding, suffix in ENCODINGS
+                     if encoding in self.variants and encoding in accepted), "")
+
+    def respond(self, request):
+        encoding = self.encoding(request.headers.get("Accept-Encoding", ""))
+        path, etag = self.variants[encoding]
+        if etag in request.headers.get("If-None-Match", ""):
+            response = HttpResponseNotModified()
+        else:
+            response = FileResponse(open(path, "rb"), content_type=self.content_type)
+            # FileResponse names the file for downloads, which a stylesheet doesn't need
+            del response["Content-Disposition"]
+            if encoding:
+                response["Content-Encoding"] = encoding
+        response["ETag"] = etag
+        response["Cache-Control"] = self.cache_control
+        if len(self.variants) > 1:
+            response["Vary"] = "Accept-Encoding"
+        return response
+
+
+class StaticFilesMiddleware:
+    """
+    Serves the files collected into STATIC_ROOT by `python manage.py collectstatic`,
+    so the site needs no separate web server for them
+
+    The hashed copies are sent with far future, immutable cache headers, so a browser
+    only ever fetches each version of a file once, and the other names are cached for
+    DISTANCE_STATIC_MAX_AGE seconds. Files are sent brotli or gzip compressed, from
+    the copies saved by distance.storage, when the browser accepts it.
+
+    STATIC_ROOT is read once when the server starts. Not used unless it exists and
+    STATIC_URL is on this site
+    """
+    def __init__(self, get_response):
+        root, prefix = settings.STATIC_ROOT, settings.STATIC_URL
+        if not root or not os.path.isdir(root) or "://" in prefix or prefix.startswith("//"):
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.prefix = prefix
+        self.files = self.scan(root)
+
+    def scan(self, root):
+        """Returns a StaticFile for every file under root, by its path relative to root"""
+        hashed = set(getattr(staticfiles_storage, "hashed_files", {}).values())
+        max_age = f"public, max-age={getattr(settings, 'DISTANCE_STATIC_MAX_AGE', 60)}"
+        suffixes = tuple(suffix for encoding, suffix in ENCODINGS)
+        files = {}
+        for directory, subdirectories, filenames in os.walk(root):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                name = os.path.relpath(path, root).replace(os.sep, "/")
+                if filename.endswith(suffixes) and os.path.exists(path[:path.rindex(".")]):
+                    # A compressed copy, served in place of the file itself
+                    continue
+                files[name] = StaticFile(path, IMMUTABLE if name in hashed else max_age)
+        return files
+
+    def __call__(self, request):
+        if request.method in ("GET", "HEAD") and request.path.startswith(self.prefix):
+            static = self.files.get(request.path[len(self.prefix):])
+            if static is not None:
+                return static.respond(request)
+        return self.get_response(request)
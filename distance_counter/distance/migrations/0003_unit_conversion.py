@@ -0,0 +1,66 @@
+# Generated by Django 4.2.3 on 2026-10-18 12:31
+
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F
+from django.db.models.functions import Round
+
+
+# Conversion factors for the unit names already in use before units had a factor
+KNOWN_UNITS = {
+    "m": Decimal("1"),
+    "metres": Decimal("1"),
+    "meters": Decimal("1"),
+    "km": Decimal("1000"),
+    "kilometres": Decimal("1000"),
+    "kilometers": Decimal("1000"),
+    "mi": Decimal("1609.344"),
+    "mile": Decimal("1609.344"),
+    "miles": Decimal("1609.344"),
+    "yards": Decimal("0.9144"),
+}
+
+
+def convert_existing_units(apps, schema_editor):
+    Unit = apps.get_model("distance", "Unit")
+    Distance = apps.get_model("distance", "Distance")
+    stride = Decimal(str(settings.DISTANCE_STRIDE_LENGTH))
+
+    for unit in Unit.objects.all():
+        name = unit.unit_of_measurement.strip().lower()
+        if name in ("step", "steps"):
+            unit.is_steps = True
+            factor = stride
+        else:
+            unit.metres_per_unit = KNOWN_UNITS.get(name, Decimal("1"))
+            factor = unit.metres_per_unit
+        unit.save()
+        Distance.objects.filter(unit=unit).update(normalized_distance=Round(F("distance") * factor, 2))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('distance', '0002_rename_location_office_city_office_country'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='distance',
+            name='normalized_distance',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=14),
+        ),
+        migrations.AddField(
+            model_name='unit',
+            name='is_steps',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='unit',
+            name='metres_per_unit',
+            field=models.DecimalField(decimal_places=4, default=1, max_digits=12),
+        ),
+        migrations.RunPython(convert_existing_units, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,73 @@
+# Generated by Django 4.2.3 on 2026-10-18 12:33
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Count, Sum
+
+
+def build_rollups(apps, schema_editor):
+    Distance = apps.get_model("distance", "Distance")
+    PersonTotal = apps.get_model("distance", "PersonTotal")
+    OfficeTotal = apps.get_model("distance", "OfficeTotal")
+    DailyTotal = apps.get_model("distance", "DailyTotal")
+    totals = {"total": Sum("normalized_distance"), "entries": Count("id")}
+
+    PersonTotal.objects.bulk_create(
+        PersonTotal(person_id=row["person"], total=row["total"], entries=row["entries"])
+        for row in Distance.objects.values("person").annotate(**totals)
+    )
+    OfficeTotal.objects.bulk_create(
+        OfficeTotal(office_id=row["person__location"], total=row["total"], entries=row["entries"])
+        for row in Distance.objects.values("person__location").annotate(**totals)
+    )
+    DailyTotal.objects.bulk_create(
+        (DailyTotal(person_id=row["person"], date=row["date"], total=row["total"], entries=row["entries"])
+         for row in Distance.objects.values("person", "date").annotate(**totals)),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('distance', '0003_unit_conversion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PersonTotal',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('total', models.DecimalField(decimal_places=2, default=0, max_digits=16)),
+                ('entries', models.PositiveIntegerField(default=0)),
+                ('person', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='rollup', to='distance.person')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='OfficeTotal',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('total', models.DecimalField(decimal_places=2, default=0, max_digits=16)),
+                ('entries', models.PositiveIntegerField(default=0)),
+                ('office', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='rollup', to='distance.office')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DailyTotal',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('total', models.DecimalField(decimal_places=2, default=0, max_digits=16)),
+                ('entries', models.PositiveIntegerField(default=0)),
+                ('person', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='distance.person')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['date'], name='dailytotal_date_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='dailytotal',
+            constraint=models.UniqueConstraint(fields=('person', 'date'), name='unique_daily_total'),
+        ),
+        migrations.RunPython(build_rollups, migrations.RunPython.noop),
+    ]
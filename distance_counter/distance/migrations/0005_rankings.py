@@ -0,0 +1,33 @@
+# Generated by Django 4.2.3 on 2026-10-18 12:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('distance', '0004_rollups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Ranking',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('board', models.CharField(choices=[('people', 'People'), ('offices', 'Offices')], max_length=10)),
+                ('period', models.CharField(choices=[('overall', 'Overall'), ('month', 'Month'), ('week', 'Week')], max_length=10)),
+                ('period_start', models.DateField(blank=True, null=True)),
+                ('subject_id', models.PositiveBigIntegerField()),
+                ('name', models.CharField(max_length=100)),
+                ('total', models.DecimalField(decimal_places=2, max_digits=16)),
+                ('rank', models.PositiveIntegerField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['board', 'period', 'period_start', 'rank'], name='ranking_position_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='ranking',
+            constraint=models.UniqueConstraint(fields=('board', 'period', 'period_start', 'subject_id'), name='unique_ranking'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.3 on 2026-10-18 12:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('distance', '0005_rankings'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='distance',
+            index=models.Index(fields=['date', 'id'], name='distance_date_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='distance',
+            index=models.Index(fields=['person', 'date'], name='distance_person_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='distance',
+            index=models.Index(fields=['unit', 'date'], name='distance_unit_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='person',
+            index=models.Index(fields=['location', 'last_name', 'first_name'], name='person_location_name_idx'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    # FTS5 is SQLite specific, other databases fall back to LIKE queries in search.py
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    schema_editor.execute(
+        "CREATE VIRTUAL TABLE distance_person_search USING fts5("
+        "first_name, last_name, email, office, prefix='1 2 3')"
+    )
+    schema_editor.execute(
+        "INSERT INTO distance_person_search (rowid, first_name, last_name, email, office) "
+        "SELECT person.id, person.first_name, person.last_name, person.email, office.city || ' ' || office.country "
+        "FROM distance_person person INNER JOIN distance_office office ON office.id = person.location_id"
+    )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == "sqlite":
+        schema_editor.execute("DROP TABLE IF EXISTS distance_person_search")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('distance', '0006_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
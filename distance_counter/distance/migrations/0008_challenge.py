@@ -0,0 +1,29 @@
+# Generated by Django 4.2.3 on 2026-10-18 13:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('distance', '0007_person_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Challenge',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.PositiveIntegerField(unique=True)),
+                ('target', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('start_date', models.DateField()),
+                ('end_date', models.DateField()),
+                ('total', models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=16)),
+                ('unit', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='distance.unit')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['start_date'], name='challenge_start_idx')],
+            },
+        ),
+    ]
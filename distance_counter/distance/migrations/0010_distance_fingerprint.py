@@ -0,0 +1,50 @@
+# Generated by Django 4.2.3 on 2026-10-18 13:12
+
+import hashlib
+from decimal import Decimal
+
+from django.db import migrations, models
+
+
+def fingerprint(person_id, date, distance, unit_id):
+    # A copy of distance.models.fingerprint as it was when this migration was written,
+    # so later changes to the model module can't change or break the migration
+    value = Decimal(str(distance)).quantize(Decimal("0.01"))
+    return hashlib.sha1(f"{person_id}:{date}:{value}:{unit_id}".encode()).hexdigest()
+
+
+def fingerprint_existing_distances(apps, schema_editor):
+    Distance = apps.get_model("distance", "Distance")
+    batch = []
+    for distance in Distance.objects.only("person_id", "date", "distance", "unit_id").iterator(chunk_size=2000):
+        distance.fingerprint = fingerprint(distance.person_id, distance.date, distance.distance, distance.unit_id)
+        batch.append(distance)
+        if len(batch) == 2000:
+            Distance.objects.bulk_update(batch, ["fingerprint"])
+            batch = []
+    Distance.objects.bulk_update(batch, ["fingerprint"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('distance', '0009_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='distance',
+            name='fingerprint',
+            field=models.CharField(default='', editable=False, max_length=40),
+        ),
+        migrations.AddField(
+            model_name='distance',
+            name='idempotency_key',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True, unique=True),
+        ),
+        migrations.RunPython(fingerprint_existing_distances, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='distance',
+            index=models.Index(fields=['fingerprint'], name='distance_fingerprint_idx'),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 4.2.3 on 2026-10-18 13:25
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def build_tree(apps, schema_editor):
+    OfficeTotal = apps.get_model("distance", "OfficeTotal")
+    OrgTotal = apps.get_model("distance", "OrgTotal")
+    nodes = {}
+    for total in OfficeTotal.objects.filter(entries__gt=0).select_related("office"):
+        office = total.office
+        for depth, city, office_id in [(0, "", None), (1, office.city, None), (2, office.city, office.id)]:
+            node = nodes.setdefault((depth, office.country, city, office_id), [0, 0])
+            node[0] += total.total
+            node[1] += total.entries
+    OrgTotal.objects.bulk_create(
+        OrgTotal(depth=depth, country=country, city=city, office_id=office_id, total=total, entries=entries)
+        for (depth, country, city, office_id), (total, entries) in nodes.items()
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('distance', '0010_distance_fingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrgTotal',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveSmallIntegerField(choices=[(0, 'Country'), (1, 'City'), (2, 'Office')])),
+                ('country', models.CharField(max_length=100)),
+                ('city', models.CharField(blank=True, max_length=100)),
+                ('total', models.DecimalField(decimal_places=2, default=0, max_digits=16)),
+                ('entries', models.PositiveIntegerField(default=0)),
+                ('office', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='tree_total', to='distance.office')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['depth', 'country', 'city'], name='orgtotal_node_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='orgtotal',
+            constraint=models.UniqueConstraint(condition=models.Q(('office__isnull', True)), fields=('depth', 'country', 'city'), name='orgtotal_region_unique'),
+        ),
+        migrations.RunPython(build_tree, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 4.2.3 on 2026-10-18 13:29
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('distance', '0011_org_total'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedYear',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.PositiveIntegerField(unique=True)),
+                ('start_date', models.DateField()),
+                ('end_date', models.DateField()),
+                ('distances', models.PositiveIntegerField(default=0)),
+                ('total', models.DecimalField(decimal_places=2, default=0, max_digits=16)),
+                ('archived_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ArchivedDistance',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('distance', models.DecimalField(decimal_places=2, max_digits=8)),
+                ('normalized_distance', models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=14)),
+                ('fingerprint', models.CharField(default='', editable=False, max_length=40)),
+                ('person', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='distance.person')),
+                ('unit', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='distance.unit')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['person', 'date'], name='archived_person_date_idx'), models.Index(fields=['date'], name='archived_date_idx')],
+            },
+        ),
+    ]
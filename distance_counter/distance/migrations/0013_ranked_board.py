@@ -0,0 +1,26 @@
+# Generated by Django 4.2.3 on 2026-10-18 13:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('distance', '0012_archive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RankedBoard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('board', models.CharField(choices=[('people', 'People'), ('offices', 'Offices')], max_length=10)),
+                ('period', models.CharField(choices=[('overall', 'Overall'), ('month', 'Month'), ('week', 'Week')], max_length=10)),
+                ('period_start', models.DateField(blank=True, null=True)),
+                ('refreshed_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['board', 'period', 'period_start'], name='rankedboard_idx')],
+            },
+        ),
+    ]
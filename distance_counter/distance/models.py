@@ -1,4 +1,15 @@
-from django.db import models
+import datetime
+import hashlib
+import math
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import F
+from django.db.models.functions import Round
+from django.utils import timezone
+
+from . import caching
 
 # Create your models here.
 
@@ -18,6 +29,13 @@ class Office(models.Model):
     city = models.CharField(max_length=100)
     country = models.CharField(max_length=100)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember where the office is so the organisation tree can follow a rename
+        instance._loaded_place = (instance.__dict__.get("country"), instance.__dict__.get("city"))
+        return instance
+
     def __str__(self):
         return f"{self.city}"
 
@@ -42,26 +60,146 @@ class Person(models.Model):
     email = models.EmailField(max_length=100)
     location = models.ForeignKey(Office, on_delete=models.CASCADE)
 
+    class Meta:
+        indexes = [
+            # Listing the members of an office in name order
+            models.Index(fields=["location", "last_name", "first_name"], name="person_location_name_idx"),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the office so the rollups can follow a person who moves
+        instance._loaded_location_id = instance.__dict__.get("location_id")
+        return instance
+
     def __str__(self):
         return f"{self.first_name}, {self.last_name}"
 
 class Unit(models.Model):
     """Units of measurement
 
-    Stores information about a unit of measurement
+    Stores information about a unit of measurement and how to convert it to
+    metres, the canonical unit every distance is normalized to
 
     Attributes:
         unit_of_measurement (str): Name/symbol representing the unit of measurement
+        metres_per_unit (Decimal): How many metres one of this unit is worth
+        is_steps (bool): Whether this unit counts steps, in which case the
+                         DISTANCE_STRIDE_LENGTH setting is used instead of metres_per_unit
 
     Methods:
         __str__: Returns a string representation of the unit
+        to_metres: Converts a value in this unit to metres
+        save: Saves the unit, setting factor_changed if its conversion to metres changed
 
     """
     unit_of_measurement = models.CharField(max_length=10)
+    metres_per_unit = models.DecimalField(max_digits=12, decimal_places=4, default=1)
+    is_steps = models.BooleanField(default=False)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_factor = instance.factor if "metres_per_unit" in field_names else None
+        return instance
 
     def __str__(self):
         return f"{self.unit_of_measurement}"
 
+    @property
+    def factor(self):
+        """The number of metres in one of this unit"""
+        if self.is_steps:
+            return Decimal(str(settings.DISTANCE_STRIDE_LENGTH))
+        return Decimal(str(self.metres_per_unit))
+
+    def to_metres(self, value):
+        return (Decimal(str(value)) * self.factor).quantize(Decimal("0.01"))
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # Distances already logged in this unit need renormalizing if the conversion changed.
+        # That rewrites them all and rebuilds the rollups, so it is left to whoever saved the
+        # unit to queue a rebuild_rollups job rather than done here
+        self.factor_changed = getattr(self, "_loaded_factor", None) not in (None, self.factor)
+        self._loaded_factor = self.factor
+
+def fingerprint(person_id, date, distance, unit_id):
+    """
+    Returns a hash identifying a distance by what was logged, so exact duplicates
+    (the same person, date, distance and unit) share a fingerprint
+    """
+    value = Decimal(str(distance)).quantize(Decimal("0.01"))
+    return hashlib.sha1(f"{person_id}:{date}:{value}:{unit_id}".encode()).hexdigest()
+
+
+class NormalizingQuerySet(models.QuerySet):
+    def normalize(self):
+        """
+        Recalculates normalized_distance for every distance in the queryset,
+        using one UPDATE per unit rather than saving each row
+        """
+        for unit in Unit.objects.filter(pk__in=self.values("unit")):
+            self.filter(unit=unit).update(
+                normalized_distance=Round(F("distance") * unit.factor, 2)
+            )
+        caching.bump(self.model)
+
+
+class DistanceQuerySet(NormalizingQuerySet):
+    def bulk_log(self, distances, batch_size=1000):
+        """
+        Inserts many distances at once and adds them to the running totals
+
+        bulk_create skips save() and the model signals, so this normalizes and
+        fingerprints each distance and updates the rollups for the whole batch in one
+        go. Each distance's unit must already be loaded to avoid a query per row
+
+        Args:
+            distances (list): Unsaved Distance instances
+            batch_size (int): Number of rows per INSERT statement
+
+        Returns:
+            list: The created distances
+        """
+        from .rollups import distances_created
+        for distance in distances:
+            distance.normalize()
+            distance.fingerprint = distance.make_fingerprint()
+        with transaction.atomic(using=self.db):
+            created = self.bulk_create(distances, batch_size=batch_size)
+            distances_created(created)
+        caching.bump(Distance)
+        return created
+
+    def bulk_delete(self):
+        """
+        Deletes every distance in the queryset and takes them out of the running totals
+
+        Like bulk_log, the rows are removed with a single DELETE and the rollups are
+        updated once, rather than deleting and sending signals for each row
+
+        Returns:
+            int: The number of distances deleted
+        """
+        from .rollups import distances_deleted
+        with transaction.atomic(using=self.db):
+            rows = list(self.values_list("pk", "person_id", "date", "normalized_distance"))
+            # Nothing refers to a distance, so there is nothing to cascade to
+            deleted = self.model.objects.filter(pk__in=[row[0] for row in rows])._raw_delete(self.db)
+            distances_deleted([row[1:] for row in rows])
+        caching.bump(Distance)
+        return deleted
+
+    def existing_fingerprints(self, fingerprints):
+        """Returns which of the fingerprints already belong to a distance, with one query per 500"""
+        fingerprints = list(set(fingerprints))
+        found = set()
+        for start in range(0, len(fingerprints), 500):
+            found.update(self.filter(fingerprint__in=fingerprints[start:start + 500]).values_list("fingerprint", flat=True))
+        return found
+
 class Distance(models.Model):
     """Creates Distances
 
@@ -74,16 +212,480 @@ class Distance(models.Model):
         distance (Decimal): The recorded distance value
         unit (Unit): The unit of measurement used for the distance (foreign key)
 
+        normalized_distance (Decimal): The distance converted to metres, set on save so totals
+                                       can be summed in SQL across units
+        fingerprint (str): Hash of the person, date, distance and unit, set on save and
+                           indexed so exact duplicates can be found with one lookup
+        idempotency_key (str): Key sent with the request that logged the distance, so
+                               a resubmitted form doesn't log it twice
+
     Methods:
         __str__: Returns a string representation of the distance entry in the format
                   "Date: Last Name, First Name"
+        normalize: Sets normalized_distance from the distance and unit
+        make_fingerprint: Returns the fingerprint of the distance's current values
 
     """
     date = models.DateField()
     person = models.ForeignKey(Person, on_delete=models.CASCADE)
     distance = models.DecimalField(max_digits=8, decimal_places=2)
     unit = models.ForeignKey(Unit, on_delete=models.CASCADE)
+    normalized_distance = models.DecimalField(max_digits=14, decimal_places=2, default=0, editable=False)
+    fingerprint = models.CharField(max_length=40, default="", editable=False)
+    idempotency_key = models.CharField(max_length=64, null=True, blank=True, unique=True, editable=False)
+
+    objects = DistanceQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # The newest first feed and date range filters
+            models.Index(fields=["date", "id"], name="distance_date_id_idx"),
+            # A person's history, and their distances within a date range
+            models.Index(fields=["person", "date"], name="distance_person_date_idx"),
+            # Distances in a unit, e.g. when renormalizing it
+            models.Index(fields=["unit", "date"], name="distance_unit_date_idx"),
+            # Finding exact duplicates
+            models.Index(fields=["fingerprint"], name="distance_fingerprint_idx"),
+        ]
 
     def __str__(self):
         return f"{self.date}: {self.person.last_name}, {self.person.first_name}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember what was counted in the rollups so edits can be reversed out of them
+        instance._loaded = (
+            instance.__dict__.get("person_id"),
+            instance.__dict__.get("date"),
+            instance.__dict__.get("normalized_distance"),
+        )
+        return instance
+
+    def normalize(self):
+        self.normalized_distance = self.unit.to_metres(self.distance)
+
+    def make_fingerprint(self):
+        return fingerprint(self.person_id, self.date, self.distance, self.unit_id)
+
+    def save(self, *args, **kwargs):
+        self.normalize()
+        self.fingerprint = self.make_fingerprint()
+        # Saved atomically with the rollup update made by the post_save signal
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+        self._loaded = (self.person_id, self.date, self.normalized_distance)
+
+
+class ArchivedDistance(models.Model):
+    """A distance from a year that has been closed
+
+    Closing a finished year moves its distances out of the Distance table, see
+    archive.py, so the live table and its indexes only hold the current challenge.
+    They keep their id and still count towards the rollups, which hold the per
+    person and per day summaries shown for past years
+
+    Attributes:
+        date (Date): Date the distance was recorded
+        person (Person): The person who recorded the distance (foreign key)
+        distance (Decimal): The recorded distance value
+        unit (Unit): The unit of measurement used for the distance (foreign key)
+        normalized_distance (Decimal): The distance converted to metres
+        fingerprint (str): Hash of the person, date, distance and unit
+
+    """
+    date = models.DateField()
+    person = models.ForeignKey(Person, on_delete=models.CASCADE)
+    distance = models.DecimalField(max_digits=8, decimal_places=2)
+    unit = models.ForeignKey(Unit, on_delete=models.CASCADE)
+    normalized_distance = models.DecimalField(max_digits=14, decimal_places=2, default=0, editable=False)
+    fingerprint = models.CharField(max_length=40, default="", editable=False)
+
+    objects = NormalizingQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["person", "date"], name="archived_person_date_idx"),
+            models.Index(fields=["date"], name="archived_date_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.date}: {self.person_id} (archived)"
+
+
+class ArchivedYear(models.Model):
+    """A year whose distances have been moved to ArchivedDistance
+
+    Attributes:
+        year (int): The year that was closed
+        start_date (Date): First day archived, the start of the year's challenge or 1 January
+        end_date (Date): Last day archived, the end of the year's challenge or 31 December
+        distances (int): Number of distances archived
+        total (Decimal): Sum of their normalized distances, in metres
+        archived_at (DateTime): When the year was last closed
+
+    """
+    year = models.PositiveIntegerField(unique=True)
+    start_date = models.DateField()
+    end_date = models.DateField()
+    distances = models.PositiveIntegerField(default=0)
+    total = models.DecimalField(max_digits=16, decimal_places=2, default=0)
+    archived_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.year} (archived)"
+
+    @property
+    def kilometres(self):
+        return self.total / 1000
+
+
+class PersonTotal(models.Model):
+    """Running total for a person
+
+    Maintained incrementally whenever a distance is written, see rollups.py
+
+    Attributes:
+        person (Person): The person the total belongs to
+        total (Decimal): Sum of the person's normalized distances in metres
+        entries (int): Number of distances the person has logged
+
+    """
+    person = models.OneToOneField(Person, on_delete=models.CASCADE, related_name="rollup")
+    total = models.DecimalField(max_digits=16, decimal_places=2, default=0)
+    entries = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.person}: {self.total}m"
+
+    @property
+    def kilometres(self):
+        return self.total / 1000
+
+class OfficeTotal(models.Model):
+    """Running total for an office
+
+    Maintained incrementally whenever a distance is written, see rollups.py
+
+    Attributes:
+        office (Office): The office the total belongs to
+        total (Decimal): Sum of the normalized distances of everyone in the office, in metres
+        entries (int): Number of distances logged by people in the office
+
+    """
+    office = models.OneToOneField(Office, on_delete=models.CASCADE, related_name="rollup")
+    total = models.DecimalField(max_digits=16, decimal_places=2, default=0)
+    entries = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.office}: {self.total}m"
+
+class OrgTotal(models.Model):
+    """Running total for a node of the organisation tree
+
+    The tree has a node for every country, every city within it and every office
+    within that, each holding the sum of the nodes below it, so the totals of every
+    node can be read with a single query. People are the leaves, see PersonTotal.
+    Maintained incrementally whenever a distance is written, see rollups.py
+
+    Attributes:
+        depth (int): COUNTRY, CITY or OFFICE
+        country (str): The country the node is in
+        city (str): The city the node is in, empty for a country
+        office (Office): The office, for office nodes only
+        total (Decimal): Sum of the normalized distances of everyone below the node, in metres
+        entries (int): Number of distances logged by people below the node
+
+    """
+    COUNTRY = 0
+    CITY = 1
+    OFFICE = 2
+    DEPTHS = [(COUNTRY, "Country"), (CITY, "City"), (OFFICE, "Office")]
+
+    depth = models.PositiveSmallIntegerField(choices=DEPTHS)
+    country = models.CharField(max_length=100)
+    city = models.CharField(max_length=100, blank=True)
+    office = models.OneToOneField(Office, null=True, blank=True, on_delete=models.CASCADE, related_name="tree_total")
+    total = models.DecimalField(max_digits=16, decimal_places=2, default=0)
+    entries = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["depth", "country", "city"], condition=models.Q(office__isnull=True),
+                name="orgtotal_region_unique",
+            ),
+        ]
+        indexes = [
+            # Reading a node and its children, e.g. a country and its cities
+            models.Index(fields=["depth", "country", "city"], name="orgtotal_node_idx"),
+        ]
+
+    def __str__(self):
+        name = self.office or self.city or self.country
+        return f"{name}: {self.total}m"
+
+    @property
+    def kilometres(self):
+        return self.total / 1000
+
+class DailyTotal(models.Model):
+    """Running total for a person on a single day
+
+    Maintained incrementally whenever a distance is written, see rollups.py.
+    Company wide daily totals are a sum of these rows for the date
+
+    Attributes:
+        person (Person): The person the total belongs to
+        date (Date): The day the distances were logged for
+        total (Decimal): Sum of the person's normalized distances that day, in metres
+        entries (int): Number of distances the person logged that day
+
+    """
+    person = models.ForeignKey(Person, on_delete=models.CASCADE)
+    date = models.DateField()
+    total = models.DecimalField(max_digits=16, decimal_places=2, default=0)
+    entries = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["person", "date"], name="unique_daily_total"),
+        ]
+        indexes = [
+            models.Index(fields=["date"], name="dailytotal_date_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.date}: {self.person}: {self.total}m"
+
+class Ranking(models.Model):
+    """Precomputed leaderboard position
+
+    One row per person or office on each leaderboard, refreshed by leaderboards.py
+    so that the top of a board, or any one entrant's rank, is a single indexed lookup
+
+    Attributes:
+        board (str): Whether people or offices are being ranked
+        period (str): Whether the board covers all time, a month or a week
+        period_start (Date): First day of the month or week, empty for the overall board
+        subject_id (int): The id of the ranked Person or Office
+        name (str): Display name of the ranked Person or Office
+        total (Decimal): Normalized distance for the period, in metres
+        rank (int): Position on the board, tied totals share a rank
+
+    """
+    PEOPLE = "people"
+    OFFICES = "offices"
+    BOARDS = [(PEOPLE, "People"), (OFFICES, "Offices")]
+
+    OVERALL = "overall"
+    MONTH = "month"
+    WEEK = "week"
+    PERIODS = [(OVERALL, "Overall"), (MONTH, "Month"), (WEEK, "Week")]
+
+    board = models.CharField(max_length=10, choices=BOARDS)
+    period = models.CharField(max_length=10, choices=PERIODS)
+    period_start = models.DateField(null=True, blank=True)
+    subject_id = models.PositiveBigIntegerField()
+    name = models.CharField(max_length=100)
+    total = models.DecimalField(max_digits=16, decimal_places=2)
+    rank = models.PositiveIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["board", "period", "period_start", "subject_id"], name="unique_ranking"),
+        ]
+        indexes = [
+            models.Index(fields=["board", "period", "period_start", "rank"], name="ranking_position_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.board} {self.period} {self.period_start or ''}: {self.rank}. {self.name}"
+
+    @property
+    def kilometres(self):
+        return self.total / 1000
+
+class RankedBoard(models.Model):
+    """Records that a leaderboard has been computed, even if nobody was on it
+
+    Lets leaderboards.top() tell a board with no entrants from one that has
+    never been refreshed, so an empty board isn't recomputed on every read
+
+    Attributes:
+        board (str): Whether people or offices are ranked
+        period (str): Whether the board covers all time, a month or a week
+        period_start (Date): First day of the month or week, empty for the overall board
+        refreshed_at (DateTime): When the board was last computed
+
+    """
+    board = models.CharField(max_length=10, choices=Ranking.BOARDS)
+    period = models.CharField(max_length=10, choices=Ranking.PERIODS)
+    period_start = models.DateField(null=True, blank=True)
+    refreshed_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["board", "period", "period_start"], name="rankedboard_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.board} {self.period} {self.period_start or ''}"
+
+class Challenge(models.Model):
+    """A company wide distance target
+
+    The running total is maintained incrementally by rollups.py as distances are
+    written, so showing progress is a single indexed lookup
+
+    Attributes:
+        year (int): The year the challenge is for
+        target (Decimal): The distance to cover, in unit
+        unit (Unit): The unit the target is set and shown in
+        start_date (Date): First day distances count towards the target
+        end_date (Date): Last day distances count towards the target
+        total (Decimal): Sum of the normalized distances logged between the dates, in metres
+
+    Methods:
+        __str__: Returns a string representation of the challenge
+        projected_completion: Estimates when the target will be reached at the current pace
+
+    """
+    year = models.PositiveIntegerField(unique=True)
+    target = models.DecimalField(max_digits=12, decimal_places=2)
+    unit = models.ForeignKey(Unit, on_delete=models.CASCADE)
+    start_date = models.DateField()
+    end_date = models.DateField()
+    total = models.DecimalField(max_digits=16, decimal_places=2, default=0, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["start_date"], name="challenge_start_idx"),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_dates = (instance.__dict__.get("start_date"), instance.__dict__.get("end_date"))
+        return instance
+
+    def __str__(self):
+        return f"{self.year} challenge: {self.target} {self.unit}"
+
+    def save(self, *args, **kwargs):
+        # A new challenge, or one whose dates moved, starts from the distances already logged
+        if getattr(self, "_loaded_dates", None) != (self.start_date, self.end_date):
+            self.total = DailyTotal.objects.filter(
+                date__gte=self.start_date, date__lte=self.end_date
+            ).aggregate(total=models.Sum("total"))["total"] or 0
+        super().save(*args, **kwargs)
+        self._loaded_dates = (self.start_date, self.end_date)
+
+    @property
+    def target_metres(self):
+        return self.unit.to_metres(self.target)
+
+    @property
+    def total_in_unit(self):
+        """The total so far, in the challenge's unit"""
+        return (Decimal(str(self.total)) / self.unit.factor).quantize(Decimal("0.01"))
+
+    @property
+    def percentage(self):
+        """How much of the target has been covered, capped at 100"""
+        if not self.target_metres:
+            return Decimal(100)
+        return min(Decimal(100), (Decimal(str(self.total)) * 100 / self.target_metres).quantize(Decimal("0.1")))
+
+    def projected_completion(self, today=None):
+        """
+        Estimates when the target will be reached, at the average daily pace so far
+
+        Args:
+            today (Date): The date to project from, defaults to the current date
+
+        Returns:
+            Date: The projected completion date, or None if the target has already been
+                  reached or nothing has been logged yet
+        """
+        today = today or timezone.localdate()
+        total = Decimal(str(self.total))
+        if total <= 0 or total >= self.target_metres or today < self.start_date:
+            return None
+        days = (min(today, self.end_date) - self.start_date).days + 1
+        remaining_days = math.ceil((self.target_metres - total) * days / total)
+        return min(today, self.end_date) + datetime.timedelta(days=remaining_days)
+
+class Job(models.Model):
+    """A queued piece of background work
+
+    Jobs are enqueued by views and run by `python manage.py run_jobs` workers, see
+    jobs.py, so slow work like imports and rebuilding the rollups never runs inside
+    a request
+
+    Attributes:
+        task (str): Name of the registered task to run
+        payload (dict): Arguments passed to the task, as JSON
+        status (str): Whether the job is queued, running, succeeded or failed
+        attempts (int): How many times the job has been started
+        max_attempts (int): How many times the job is tried before it is marked failed
+        run_after (DateTime): The job is not started before this time, used to delay retries
+        progress (int): Units of work done so far, out of progress_total
+        progress_total (int): Units of work in the job, 0 when not known
+        result (dict): What the task returned, as JSON
+        error (str): The last error raised by the task
+        worker (str): Name of the worker that last claimed the job
+        created_by (User): Who enqueued the job
+        created_at (DateTime): When the job was enqueued
+        started_at (DateTime): When the job was last started
+        heartbeat_at (DateTime): When the worker running the job last showed it was still alive
+        finished_at (DateTime): When the job succeeded or finally failed
+
+    Methods:
+        __str__: Returns a string representation of the job
+
+    """
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    STATUSES = [(QUEUED, "Queued"), (RUNNING, "Running"), (SUCCEEDED, "Succeeded"), (FAILED, "Failed")]
+
+    task = models.CharField(max_length=50)
+    payload = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=10, choices=STATUSES, default=QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    run_after = models.DateTimeField(default=timezone.now)
+    progress = models.PositiveIntegerField(default=0)
+    progress_total = models.PositiveIntegerField(default=0)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    worker = models.CharField(max_length=100, blank=True)
+    created_by = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Workers look for the next queued job that is due
+            models.Index(fields=["status", "run_after"], name="job_queue_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.task} #{self.pk} ({self.status})"
+
+    @property
+    def finished(self):
+        return self.status in (self.SUCCEEDED, self.FAILED)
+
+    @property
+    def percentage(self):
+        """How much of the job is done, or None when its size is not known"""
+        if self.status == self.SUCCEEDED:
+            return 100
+        if not self.progress_total:
+            return None
+        return min(100, self.progress * 100 // self.progress_total)
@@ -0,0 +1,227 @@
+import base64
+import json
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db.models import Q
+
+# Range of the integers a cursor may hold, the range of a 64 bit database integer
+MIN_INTEGER, MAX_INTEGER = -2 ** 63, 2 ** 63 - 1
+
+
+class InvalidCursor(ValueError):
+    """Raised when a pagination cursor cannot be decoded"""
+
+
+class KeysetPage:
+    """A single page of results from a keyset paginated queryset
+
+    Attributes:
+        object_list (list): The records on this page
+        next_cursor (str): Cursor for the page after this one, or None
+        previous_cursor (str): Cursor for the page before this one, or None
+
+    """
+    def __init__(self, object_list, next_cursor, previous_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+
+def encode_cursor(values):
+    """
+    Encodes a list of ordering values into an opaque, URL safe cursor
+
+    Args:
+        values (list): The ordering field values of a record
+
+    Returns:
+        str: The encoded cursor
+    """
+    raw = json.dumps([str(value) if not isinstance(value, int) else value for value in values])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def _clean(field, value):
+    """Converts a cursor value to the field's type, raising InvalidCursor if it isn't one"""
+    try:
+        value = field.to_python(value)
+    except (ValidationError, ValueError, TypeError, OverflowError) as error:
+        raise InvalidCursor(f"Invalid cursor value: {value!r}") from error
+    if isinstance(value, int) and not MIN_INTEGER <= value <= MAX_INTEGER:
+        raise InvalidCursor(f"Invalid cursor value: {value!r}")
+    return value
+
+
+def _field(model, name):
+    """Returns the model field an ordering name refers to, following relations, or None"""
+    field = None
+    for part in name.lstrip("-").split("__"):
+        if field is not None:
+            model = field.related_model
+        if model is None:
+            return None
+        try:
+            field = model._meta.get_field(part)
+        except FieldDoesNotExist:
+            return None
+    if field.is_relation and field.target_field is not None:
+        field = field.target_field
+    return field
+
+
+def decode_cursor(cursor, length, fields=None):
+    """
+    Decodes a cursor created by encode_cursor
+
+    Args:
+        cursor (str): The encoded cursor
+        length (int): The number of ordering fields the cursor should contain
+        fields (list): The model fields the values are for, to check each value is
+                       valid for its field and convert it, e.g. to a date
+
+    Returns:
+        list: The ordering field values stored in the cursor
+
+    Raises:
+        InvalidCursor: If the cursor is malformed, or a value isn't valid for its field
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+    except (ValueError, UnicodeError) as error:
+        raise InvalidCursor(f"Invalid cursor: {cursor}") from error
+    if not isinstance(values, list) or len(values) != length:
+        raise InvalidCursor(f"Invalid cursor: {cursor}")
+    if fields is not None:
+        values = [value if field is None else _clean(field, value) for field, value in zip(fields, values)]
+    return values
+
+
+def get_page_size(request, default=None):
+    """
+    Reads the requested page size from the query string, clamped to the configured maximum
+
+    Args:
+        request (HttpRequest): The HTTP request object
+        default (int): Page size to use when none is requested, defaults to DISTANCE_PAGE_SIZE
+
+    Returns:
+        int: The page size to use
+    """
+    if default is None:
+        default = getattr(settings, "DISTANCE_PAGE_SIZE", 50)
+    maximum = getattr(settings, "DISTANCE_MAX_PAGE_SIZE", 500)
+    try:
+        page_size = int(request.GET.get("page_size", default))
+    except ValueError:
+        page_size = default
+    return max(1, min(page_size, maximum))
+
+
+def _seek(ordering, values, forwards):
+    """
+    Builds the filter selecting every record strictly after (or before) the cursor values
+
+    For ordering (a, b) this is: a > x OR (a = x AND b > y), with the comparison
+    flipped for descending orderings and when seeking backwards
+    """
+    condition = Q()
+    for i, field in enumerate(ordering):
+        descending = field.startswith("-")
+        name = field.lstrip("-")
+        lookup = "lt" if descending == forwards else "gt"
+        term = Q(**{f"{name}__{lookup}": values[i]})
+        for previous, value in zip(ordering[:i], values[:i]):
+            term &= Q(**{previous.lstrip("-"): value})
+        condition |= term
+    return condition
+
+
+def _reverse(ordering):
+    return [field[1:] if field.startswith("-") else f"-{field}" for field in ordering]
+
+
+def _keyset_query(queryset, ordering, page_size, after, before):
+    """Returns the slice of queryset to fetch for a page, one record longer to tell if there are more"""
+    fields = [_field(queryset.model, name) for name in ordering]
+    if after is not None:
+        queryset = queryset.filter(_seek(ordering, decode_cursor(after, len(ordering), fields), True))
+    elif before is not None:
+        queryset = queryset.filter(_seek(ordering, decode_cursor(before, len(ordering), fields), False))
+        return queryset.order_by(*_reverse(ordering))[:page_size + 1]
+    return queryset.order_by(*ordering)[:page_size + 1]
+
+
+def _keyset_page(records, ordering, page_size, after, before):
+    """Builds the KeysetPage from the records fetched by the _keyset_query slice"""
+    names = [field.lstrip("-") for field in ordering]
+    forwards = before is None
+
+    has_more = len(records) > page_size
+    records = records[:page_size]
+    if not forwards:
+        records.reverse()
+
+    def cursor_for(record):
+        return encode_cursor([_value(record, name) for name in names])
+
+    next_cursor = previous_cursor = None
+    if records:
+        if (forwards and has_more) or (not forwards):
+            next_cursor = cursor_for(records[-1])
+        if (forwards and after is not None) or (not forwards and has_more):
+            previous_cursor = cursor_for(records[0])
+
+    return KeysetPage(records, next_cursor, previous_cursor)
+
+
+def paginate_keyset(queryset, ordering, page_size, after=None, before=None):
+    """
+    Returns one page of a queryset using keyset (seek) pagination
+
+    Unlike OFFSET pagination, each page is fetched by seeking from the last seen
+    ordering values, so the cost of a page does not grow the deeper you page.
+    The ordering must end in a unique field (usually id) so that the cursors are stable
+
+    Args:
+        queryset (QuerySet): The records to paginate
+        ordering (list): Field names to order by, e.g. ['-date', '-id']
+        page_size (int): The number of records per page
+        after (str): Cursor of the last record on the previous page
+        before (str): Cursor of the first record on the next page
+
+    Returns:
+        KeysetPage: The requested page of records
+
+    Raises:
+        InvalidCursor: If either cursor is malformed or holds values that aren't valid for the ordering fields
+    """
+    records = list(_keyset_query(queryset, ordering, page_size, after, before))
+    return _keyset_page(records, ordering, page_size, after, before)
+
+
+async def apaginate_keyset(queryset, ordering, page_size, after=None, before=None):
+    """Async version of paginate_keyset(), fetching the page with the async ORM"""
+    records = [record async for record in _keyset_query(queryset, ordering, page_size, after, before)]
+    return _keyset_page(records, ordering, page_size, after, before)
+
+
+def _value(record, name):
+    if isinstance(record, dict):
+        return record[name]
+    return getattr(record, name)
@@ -0,0 +1,361 @@
+"""Incrementally maintained running totals
+
+Every write to a Distance adjusts the PersonTotal, OfficeTotal, DailyTotal, OrgTotal
+and Challenge totals it contributes to, so totals can be read with a single indexed lookup
+instead of summing the whole Distance table. rebuild() and verify() recompute them
+from scratch, from both the Distance table and the distances of closed years in
+ArchivedDistance, which still count towards the totals.
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Q, QuerySet, Sum
+
+from . import leaderboards, series, stats
+from .models import ArchivedDistance, Challenge, DailyTotal, Distance, Office, OfficeTotal, OrgTotal, Person, PersonTotal, Ranking, Unit
+
+
+def _bump(model, lookup, amount, entries):
+    """
+    Adds amount and entries to the rollup row matching lookup, creating it if needed
+
+    Rows are only created for positive changes, so removing a distance whose person
+    or office is being deleted in the same cascade never resurrects its rollup
+    """
+    updated = model.objects.filter(**lookup).update(
+        total=F("total") + amount, entries=F("entries") + entries
+    )
+    if updated or entries <= 0:
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(total=amount, entries=entries, **lookup)
+    except IntegrityError:
+        # Another request created the row first
+        model.objects.filter(**lookup).update(
+            total=F("total") + amount, entries=F("entries") + entries
+        )
+
+
+def _offices(person_ids):
+    """Returns {person_id: (office_id, country, city)} for the people"""
+    rows = Person.objects.filter(pk__in=person_ids).values_list(
+        "id", "location_id", "location__country", "location__city"
+    )
+    return {person_id: (office_id, country, city) for person_id, office_id, country, city in rows}
+
+
+def _tree_nodes(office_id, country, city):
+    """Returns the lookups of the organisation tree nodes an office's total counts towards"""
+    return [
+        {"depth": OrgTotal.COUNTRY, "country": country, "city": ""},
+        {"depth": OrgTotal.CITY, "country": country, "city": city},
+        {"depth": OrgTotal.OFFICE, "country": country, "city": city, "office_id": office_id},
+    ]
+
+
+def _bump_tree(offices, places):
+    """
+    Adds the offices' changes to their nodes of the organisation tree
+
+    Args:
+        offices (dict): [amount, entries] by office id
+        places (dict): (country, city) by office id
+    """
+    nodes = defaultdict(lambda: [Decimal(0), 0])
+    for office_id, (amount, entries) in offices.items():
+        for lookup in _tree_nodes(office_id, *places[office_id]):
+            node = nodes[tuple(lookup.items())]
+            node[0] += amount
+            node[1] += entries
+    for lookup, (amount, entries) in nodes.items():
+        if amount or entries:
+            _bump(OrgTotal, dict(lookup), amount, entries)
+
+
+def _bump_challenges(daily):
+    """Adds the changes to the totals of the challenges whose dates they fall between"""
+    dates = [date for person_id, date in daily]
+    challenges = Challenge.objects.filter(
+        start_date__lte=max(dates), end_date__gte=min(dates)
+    ).values_list("id", "start_date", "end_date")
+    for challenge_id, start, end in challenges:
+        amount = sum(amount for (person_id, date), (amount, entries) in daily.items() if start <= date <= end)
+        if amount:
+            Challenge.objects.filter(pk=challenge_id).update(total=F("total") + amount)
+
+
+def apply(changes):
+    """
+    Applies a batch of changes to the rollups
+
+    Changes for the same person and day are combined first, so the number of
+    queries depends on how many rows are touched rather than how many distances changed
+
+    Args:
+        changes (list): (person_id, date, amount, entries) tuples, where removals have
+                        a negative amount and entries
+    """
+    to_date = DailyTotal._meta.get_field("date").to_python
+    daily = defaultdict(lambda: [Decimal(0), 0])
+    for person_id, date, amount, entries in changes:
+        date = to_date(date)
+        daily[(person_id, date)][0] += Decimal(amount)
+        daily[(person_id, date)][1] += entries
+
+    people = defaultdict(lambda: [Decimal(0), 0])
+    for (person_id, date), (amount, entries) in daily.items():
+        people[person_id][0] += amount
+        people[person_id][1] += entries
+
+    offices = defaultdict(lambda: [Decimal(0), 0])
+    places = {}
+    for person_id, (office_id, country, city) in _offices(people).items():
+        offices[office_id][0] += people[person_id][0]
+        offices[office_id][1] += people[person_id][1]
+        places[office_id] = (country, city)
+
+    with transaction.atomic():
+        for (person_id, date), (amount, entries) in daily.items():
+            if amount or entries:
+                _bump(DailyTotal, {"person_id": person_id, "date": date}, amount, entries)
+        for person_id, (amount, entries) in people.items():
+            if amount or entries:
+                _bump(PersonTotal, {"person_id": person_id}, amount, entries)
+        for office_id, (amount, entries) in offices.items():
+            if amount or entries:
+                _bump(OfficeTotal, {"office_id": office_id}, amount, entries)
+        _bump_tree(offices, places)
+        DailyTotal.objects.filter(
+            person_id__in=people, entries=0
+        ).delete()
+        if daily:
+            _bump_challenges(daily)
+
+    dates = {date for person_id, date in daily}
+    leaderboards.changed(dates)
+    series.changed(dates)
+    stats.changed(people)
+
+
+def distance_saved(distance):
+    """
+    Moves a saved distance's contribution from its previous values to its current ones
+
+    Handles edits that change the person, date or unit of a record as well as new records
+    """
+    changes = [(distance.person_id, distance.date, distance.normalized_distance, 1)]
+    loaded = getattr(distance, "_loaded", None)
+    if loaded is not None and loaded[0] is not None:
+        person_id, date, amount = loaded
+        changes.append((person_id, date, -amount, -1))
+    apply(changes)
+
+
+def distance_deleted(distance):
+    """Removes a deleted distance's contribution from the rollups"""
+    person_id, date, amount = getattr(distance, "_loaded", None) or (
+        distance.person_id, distance.date, distance.normalized_distance
+    )
+    apply([(person_id, date, -amount, -1)])
+
+
+def distances_created(distances):
+    """Adds distances that were inserted with bulk_create, which sends no signals"""
+    apply([(d.person_id, d.date, d.normalized_distance, 1) for d in distances])
+
+
+def distances_deleted(rows):
+    """Removes distances that were deleted with a raw DELETE, given as (person_id, date, normalized_distance) rows"""
+    apply([(person_id, date, -amount, -1) for person_id, date, amount in rows])
+
+
+def _remove(removed, model, pks):
+    """Takes the distances of the people, offices or units out of the rollups, skipping any already taken out"""
+    pks = set(pks) - removed[model]
+    removed[model].update(pks)
+    if model is Office:
+        pks = set(Person.objects.filter(location_id__in=pks).values_list("pk", flat=True)) - removed[Person]
+        model = Person
+        removed[Person].update(pks)
+    if not pks:
+        return
+    if model is Person:
+        lookup = Q(person_id__in=pks) & ~Q(unit_id__in=removed[Unit])
+    else:
+        lookup = Q(unit_id__in=pks) & ~Q(person_id__in=removed[Person])
+
+    changes = []
+    for distances in (Distance, ArchivedDistance):
+        rows = (
+            distances.objects.filter(lookup).values("person_id", "date")
+            .annotate(total=Sum("normalized_distance"), entries=Count("id")).order_by()
+        )
+        changes.extend((row["person_id"], row["date"], -row["total"], -row["entries"]) for row in rows)
+    if changes:
+        apply(changes)
+
+
+def cascade_deleting(origin, instance):
+    """
+    Takes the distances a delete of people, offices or units will cascade to out of
+    the rollups before they are deleted, summed by person and day like bulk_delete
+
+    Called from pre_delete. The first call for a delete takes out everything delete()
+    was called on at once, rather than one instance at a time, and cascade_deleted()
+    then tells the cascaded distances' post_delete signals to leave the rollups alone
+
+    Args:
+        origin (Model or QuerySet): What delete() was called on
+        instance (Model): The Person, Office or Unit about to be deleted
+    """
+    origin = instance if origin is None else origin
+    removed = getattr(origin, "_removed_from_rollups", None)
+    if removed is None:
+        removed = origin._removed_from_rollups = {Office: set(), Person: set(), Unit: set()}
+        if isinstance(origin, QuerySet) and origin.model in removed:
+            _remove(removed, origin.model, origin.values_list("pk", flat=True))
+        elif not isinstance(origin, QuerySet) and origin._meta.concrete_model in removed:
+            _remove(removed, origin._meta.concrete_model, [origin.pk])
+    _remove(removed, instance._meta.concrete_model, [instance.pk])
+
+
+def cascade_deleted(origin, distance):
+    """Whether a deleted distance was already taken out of the rollups by cascade_deleting()"""
+    removed = getattr(origin, "_removed_from_rollups", None)
+    return removed is not None and (distance.person_id in removed[Person] or distance.unit_id in removed[Unit])
+
+
+def person_moved(person, old_office_id):
+    """Moves a person's running total from their previous office to their current one"""
+    rollup = PersonTotal.objects.filter(person=person).first()
+    if rollup is None or not rollup.entries:
+        return
+    places = {office_id: (country, city) for office_id, country, city in
+              Office.objects.filter(pk__in=[old_office_id, person.location_id]).values_list("id", "country", "city")}
+    with transaction.atomic():
+        _bump(OfficeTotal, {"office_id": old_office_id}, -rollup.total, -rollup.entries)
+        _bump(OfficeTotal, {"office_id": person.location_id}, rollup.total, rollup.entries)
+        moves = {old_office_id: [-rollup.total, -rollup.entries], person.location_id: [rollup.total, rollup.entries]}
+        _bump_tree({office_id: move for office_id, move in moves.items() if office_id in places}, places)
+
+    dates = set(DailyTotal.objects.filter(person=person).dates("date", "day"))
+    leaderboards.changed(dates, boards=[Ranking.OFFICES])
+    series.changed(dates)
+
+
+def office_moved(office, old_country, old_city):
+    """Moves an office's running total to the country and city it was renamed to"""
+    node = OrgTotal.objects.filter(office=office).first()
+    with transaction.atomic():
+        if node is not None and node.entries:
+            old = _tree_nodes(office.id, old_country, old_city)[:2]
+            new = _tree_nodes(office.id, office.country, office.city)[:2]
+            for lookup in old:
+                _bump(OrgTotal, lookup, -node.total, -node.entries)
+            for lookup in new:
+                _bump(OrgTotal, lookup, node.total, node.entries)
+        OrgTotal.objects.filter(office=office).update(country=office.country, city=office.city)
+
+
+def _tree(offices):
+    """Sums office totals, given as {(office_id, country, city): (total, entries)}, up the organisation tree"""
+    nodes = defaultdict(lambda: [Decimal(0), 0])
+    for (office_id, country, city), (total, entries) in offices.items():
+        for lookup in _tree_nodes(office_id, country, city):
+            node = nodes[(lookup["depth"], country, lookup["city"], lookup.get("office_id"))]
+            node[0] += total
+            node[1] += entries
+    return {key: tuple(value) for key, value in nodes.items()}
+
+
+def _grouped(*fields):
+    """Sums the live and archived distances, returning {values of fields: (total, entries)}"""
+    grouped = defaultdict(lambda: [Decimal(0), 0])
+    for model in (Distance, ArchivedDistance):
+        rows = model.objects.values_list(*fields).annotate(total=Sum("normalized_distance"), entries=Count("id"))
+        for *key, total, entries in rows.order_by():
+            grouped[tuple(key)][0] += total
+            grouped[tuple(key)][1] += entries
+    return {key: tuple(value) for key, value in grouped.items()}
+
+
+def _expected():
+    """Recomputes every rollup from the Distance and ArchivedDistance tables"""
+    offices = _grouped("person__location", "person__location__country", "person__location__city")
+    return {
+        PersonTotal: _grouped("person"),
+        OfficeTotal: {(office_id,): totals for (office_id, country, city), totals in offices.items()},
+        DailyTotal: _grouped("person", "date"),
+        OrgTotal: _tree(offices),
+    }
+
+
+KEYS = {
+    PersonTotal: ("person_id",),
+    OfficeTotal: ("office_id",),
+    DailyTotal: ("person_id", "date"),
+    OrgTotal: ("depth", "country", "city", "office_id"),
+}
+
+
+def _challenge_totals():
+    """Recomputes every challenge's total from the Distance and ArchivedDistance tables"""
+    return {
+        challenge_id: sum(
+            model.objects.filter(date__gte=start, date__lte=end).aggregate(
+                total=Sum("normalized_distance"))["total"] or Decimal(0)
+            for model in (Distance, ArchivedDistance)
+        )
+        for challenge_id, start, end in Challenge.objects.values_list("id", "start_date", "end_date")
+    }
+
+
+def rebuild():
+    """Discards and recomputes every rollup from the Distance and ArchivedDistance tables"""
+    expected = _expected()
+    with transaction.atomic():
+        for model, rows in expected.items():
+            model.objects.all().delete()
+            model.objects.bulk_create(
+                [model(total=total, entries=entries, **dict(zip(KEYS[model], key)))
+                 for key, (total, entries) in rows.items()],
+                batch_size=1000,
+            )
+        for challenge_id, total in _challenge_totals().items():
+            Challenge.objects.filter(pk=challenge_id).update(total=total)
+
+    leaderboards.changed(DailyTotal.objects.dates("date", "day"))
+    series.invalidate_all()
+    stats.invalidate_all()
+
+
+def verify():
+    """
+    Compares the stored rollups with totals recomputed from the Distance and ArchivedDistance tables
+
+    Returns:
+        list: A description of every mismatch, empty if the rollups are correct
+    """
+    mismatches = []
+    cent = Decimal("0.01")
+    for model, rows in _expected().items():
+        stored = {
+            tuple(values[:-2]): (values[-2], values[-1])
+            for values in model.objects.filter(entries__gt=0).values_list(*KEYS[model], "total", "entries")
+        }
+        for key in rows.keys() | stored.keys():
+            want_total, want_entries = rows.get(key, (Decimal(0), 0))
+            have_total, have_entries = stored.get(key, (Decimal(0), 0))
+            if (Decimal(have_total).quantize(cent) != Decimal(want_total).quantize(cent)
+                    or have_entries != want_entries):
+                mismatches.append(
+                    f"{model.__name__} {key}: stored {have_total} ({have_entries} entries), "
+                    f"expected {want_total} ({want_entries} entries)"
+                )
+    stored = dict(Challenge.objects.values_list("id", "total"))
+    for challenge_id, want_total in _challenge_totals().items():
+        if Decimal(stored[challenge_id]).quantize(cent) != Decimal(want_total).quantize(cent):
+            mismatches.append(f"Challenge {challenge_id}: stored {stored[challenge_id]}, expected {want_total}")
+    return mismatches
@@ -0,0 +1,124 @@
+"""Full text search over people
+
+On SQLite, people are indexed in an FTS5 virtual table (distance_person_search, created
+by migration 0007) by first name, last name, email and office. The index is kept in step
+with Person and Office writes by signals, and queries are prefix matches ranked by bm25,
+so lookups stay fast however many people there are. Other databases fall back to
+case-insensitive LIKE matching.
+"""
+import re
+
+from django.db import connection
+from django.db.models import Q
+
+from .models import Person
+
+TABLE = "distance_person_search"
+
+_INDEX_SQL = f"""
+    INSERT INTO {TABLE} (rowid, first_name, last_name, email, office)
+    SELECT person.id, person.first_name, person.last_name, person.email, office.city || ' ' || office.country
+    FROM distance_person person
+    INNER JOIN distance_office office ON office.id = person.location_id
+"""
+
+
+def enabled():
+    return connection.vendor == "sqlite"
+
+
+def index_person(person_id):
+    """Adds or refreshes one person in the search index"""
+    if not enabled():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {TABLE} WHERE rowid = %s", [person_id])
+        cursor.execute(f"{_INDEX_SQL} WHERE person.id = %s", [person_id])
+
+
+def unindex_person(person_id):
+    """Removes a deleted person from the search index"""
+    if not enabled():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {TABLE} WHERE rowid = %s", [person_id])
+
+
+def index_office(office_id):
+    """Refreshes everyone in an office, after the office is renamed"""
+    if not enabled():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"DELETE FROM {TABLE} WHERE rowid IN (SELECT id FROM distance_person WHERE location_id = %s)",
+            [office_id],
+        )
+        cursor.execute(f"{_INDEX_SQL} WHERE person.location_id = %s", [office_id])
+
+
+def rebuild():
+    """Discards and rebuilds the whole search index"""
+    if not enabled():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {TABLE}")
+        cursor.execute(_INDEX_SQL)
+
+
+def _match_expression(terms):
+    # Every term must match the start of a word, e.g. 'hel lov' -> "hel"* "lov"*
+    return " ".join(f'"{term}"*' for term in terms)
+
+
+def _like(terms):
+    # Without FTS5, every term has to match the start of one of the indexed columns
+    people = Person.objects.select_related("location")
+    for term in terms:
+        people = people.filter(
+            Q(first_name__istartswith=term) | Q(last_name__istartswith=term)
+            | Q(email__istartswith=term) | Q(location__city__istartswith=term)
+        )
+    return people
+
+
+def search_people(query, limit=20, offset=0):
+    """
+    Finds people whose names, email or office start with every word in query
+
+    Args:
+        query (str): The search text
+        limit (int): Maximum number of people to return
+        offset (int): Number of matches to skip, for paging through results
+
+    Returns:
+        list: Matching Person instances, with their office loaded, best matches first
+    """
+    terms = re.findall(r"\w+", query.lower())
+    if not terms:
+        return []
+
+    if not enabled():
+        return list(_like(terms).order_by("last_name", "first_name", "id")[offset:offset + limit])
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT rowid FROM {TABLE} WHERE {TABLE} MATCH %s ORDER BY bm25({TABLE}), rowid LIMIT %s OFFSET %s",
+            [_match_expression(terms), limit, offset],
+        )
+        ids = [row[0] for row in cursor.fetchall()]
+    people = Person.objects.select_related("location").in_bulk(ids)
+    return [people[pk] for pk in ids if pk in people]
+
+
+def count_people(query):
+    """Returns how many people search_people() finds for query"""
+    terms = re.findall(r"\w+", query.lower())
+    if not terms:
+        return 0
+
+    if not enabled():
+        return _like(terms).count()
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT COUNT(*) FROM {TABLE} WHERE {TABLE} MATCH %s", [_match_expression(terms)])
+        return cursor.fetchone()[0]
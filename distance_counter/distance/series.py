@@ -0,0 +1,164 @@
+"""Normalized distance totals over time, summed into day, week or month buckets
+
+Buckets are summed in SQL from DailyTotal, which already holds one row per person
+per day, and the totals of each bucket are cached separately. Writes invalidate just
+the buckets containing the dates they touched, once their transaction commits, so
+charting a year after a new distance is logged recomputes one day, week and month
+rather than the whole year.
+"""
+import datetime
+from collections import defaultdict
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Sum
+from django.db.models.functions import TruncDay, TruncMonth, TruncWeek
+
+from .caching import counters, get_cache, increment
+from .leaderboards import period_end, period_start
+from .models import DailyTotal
+
+INTERVALS = {"day": TruncDay, "week": TruncWeek, "month": TruncMonth}
+
+# What a series can be grouped by, and the DailyTotal lookup it is grouped on
+GROUPS = {"person": "person_id", "office": "person__location_id"}
+
+# Most buckets returned by one series
+MAX_BUCKETS = 400
+
+_GENERATION_KEY = "distance:series:generation"
+_CENT = Decimal("0.01")
+
+
+def bucket_start(interval, date):
+    """Returns the first day of the bucket containing date, weeks start on a Monday"""
+    return date if interval == "day" else period_start(interval, date)
+
+
+def bucket_end(interval, start):
+    """Returns the day after the last day of the bucket beginning on start"""
+    return start + datetime.timedelta(days=1) if interval == "day" else period_end(interval, start)
+
+
+def buckets(interval, date_from, date_to, limit=MAX_BUCKETS):
+    """
+    Returns the start of every bucket from the one containing date_from to the one containing date_to
+
+    Raises:
+        ValueError: If there are more than limit buckets, or the last one ends after the
+                    largest date that can be represented
+    """
+    starts = []
+    start = bucket_start(interval, date_from)
+    while start <= date_to:
+        # Stops as soon as the range is too long, rather than after listing all of it
+        if len(starts) == limit:
+            raise ValueError(f"A series can have at most {limit} buckets")
+        starts.append(start)
+        try:
+            start = bucket_end(interval, start)
+        except OverflowError:
+            raise ValueError(f"The {interval} starting {start} ends after the last supported date")
+    return starts
+
+
+def _generation(cache):
+    return counters(cache, [_GENERATION_KEY])[_GENERATION_KEY]
+
+
+def _key(generation, interval, group, start):
+    return f"distance:series:{generation}:{interval}:{group or 'all'}:{start.isoformat()}"
+
+
+def _compute(interval, group, start, end):
+    """
+    Sums DailyTotal into buckets between start (inclusive) and end (exclusive)
+
+    Returns:
+        dict: {bucket start: {group id, or None when not grouped: total}}
+    """
+    fields = ["bucket", GROUPS[group]] if group else ["bucket"]
+    rows = (
+        DailyTotal.objects.filter(date__gte=start, date__lt=end)
+        .annotate(bucket=INTERVALS[interval]("date"))
+        .values(*fields)
+        .annotate(sum=Sum("total"))
+        .order_by()
+    )
+    to_date = DailyTotal._meta.get_field("date").to_python
+    totals = defaultdict(dict)
+    for row in rows:
+        totals[to_date(row["bucket"])][row[GROUPS[group]] if group else None] = Decimal(row["sum"]).quantize(_CENT)
+    return totals
+
+
+def series(interval, date_from, date_to, group=None):
+    """
+    Returns the normalized distance logged in each bucket from date_from to date_to
+
+    Buckets are always whole, so a weekly series starting on a Wednesday includes
+    that week's Monday and Tuesday. Cached buckets are reused, and the missing ones
+    are computed with a single query
+
+    Args:
+        interval (str): 'day', 'week' or 'month'
+        date_from (Date): A day in the first bucket
+        date_to (Date): A day in the last bucket
+        group (str): None for a single total per bucket, or 'person' or 'office'
+                     for a total per person or office in each bucket
+
+    Returns:
+        list: (bucket start, person or office id, total in metres) tuples in date order.
+              Ungrouped series have a row for every bucket, with None as the id, and
+              grouped series only have rows for those with distances in the bucket
+
+    Raises:
+        ValueError: If the interval or group is unknown, or there are too many buckets
+    """
+    if interval not in INTERVALS:
+        raise ValueError(f"Unknown interval: {interval}")
+    if group is not None and group not in GROUPS:
+        raise ValueError(f"Unknown group: {group}")
+    starts = buckets(interval, date_from, date_to)
+
+    cache = get_cache()
+    generation = _generation(cache)
+    keys = {start: _key(generation, interval, group, start) for start in starts}
+    found = cache.get_many(list(keys.values()))
+
+    missing = [start for start in starts if keys[start] not in found]
+    if missing:
+        computed = _compute(interval, group, missing[0], bucket_end(interval, missing[-1]))
+        fresh = {keys[start]: computed.get(start, {}) for start in missing}
+        cache.set_many(fresh, getattr(settings, "DISTANCE_FRAGMENT_TIMEOUT", 3600))
+        found.update(fresh)
+
+    rows = []
+    for start in starts:
+        totals = found[keys[start]]
+        if group is None:
+            rows.append((start, None, totals.get(None, Decimal("0.00"))))
+        else:
+            rows.extend((start, group_id, total) for group_id, total in sorted(totals.items()))
+    return rows
+
+
+def changed(dates):
+    """Called after a write touching the given dates, invalidates their buckets once the transaction commits"""
+    dates = set(dates)
+    transaction.on_commit(lambda: _invalidate(dates))
+
+
+def _invalidate(dates):
+    cache = get_cache()
+    generation = _generation(cache)
+    cache.delete_many([
+        _key(generation, interval, group, bucket_start(interval, date))
+        for date in dates for interval in INTERVALS for group in [None, *GROUPS]
+    ])
+
+
+def invalidate_all():
+    """Discards every cached bucket once the transaction commits, after the rollups are rebuilt"""
+    transaction.on_commit(lambda: increment(get_cache(), _GENERATION_KEY))
@@ -0,0 +1,66 @@
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from . import caching, rollups, search
+from .models import ArchivedDistance, Distance, Office, Person, Unit
+
+
+@receiver(post_save, sender=Distance)
+def distance_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        rollups.distance_saved(instance)
+
+
+@receiver(post_delete, sender=Distance)
+@receiver(post_delete, sender=ArchivedDistance)
+def distance_deleted(sender, instance, origin=None, **kwargs):
+    # Archived distances are only deleted along with their person or unit, and distances
+    # deleted along with them were already taken out of the rollups by cascade_deleting
+    if not rollups.cascade_deleted(origin, instance):
+        rollups.distance_deleted(instance)
+
+
+@receiver(pre_delete, sender=Office)
+@receiver(pre_delete, sender=Person)
+@receiver(pre_delete, sender=Unit)
+def cascade_deleting(sender, instance, origin=None, **kwargs):
+    rollups.cascade_deleting(origin, instance)
+
+
+@receiver(post_save, sender=Person)
+def person_saved(sender, instance, created, raw=False, **kwargs):
+    old_location_id = getattr(instance, "_loaded_location_id", None)
+    if not raw and not created and old_location_id not in (None, instance.location_id):
+        rollups.person_moved(instance, old_location_id)
+    instance._loaded_location_id = instance.location_id
+    if not raw:
+        search.index_person(instance.id)
+
+
+@receiver(post_delete, sender=Person)
+def person_deleted(sender, instance, **kwargs):
+    search.unindex_person(instance.id)
+
+
+@receiver(post_save, sender=Office)
+def office_saved(sender, instance, created, raw=False, **kwargs):
+    # A new office has nobody in it yet, a renamed one changes how its people are found
+    if not raw and not created:
+        search.index_office(instance.id)
+    old_place = getattr(instance, "_loaded_place", (None, None))
+    if not raw and not created and None not in old_place and old_place != (instance.country, instance.city):
+        rollups.office_moved(instance, *old_place)
+    instance._loaded_place = (instance.country, instance.city)
+
+
+@receiver(post_save, sender=Office)
+@receiver(post_save, sender=Person)
+@receiver(post_save, sender=Unit)
+@receiver(post_save, sender=Distance)
+@receiver(post_delete, sender=Office)
+@receiver(post_delete, sender=Person)
+@receiver(post_delete, sender=Unit)
+@receiver(post_delete, sender=Distance)
+def invalidate_fragments(sender, instance, **kwargs):
+    # Covers the views, the admin and cascading deletes alike
+    caching.bump(sender, instance.pk)
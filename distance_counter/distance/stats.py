@@ -0,0 +1,334 @@
+"""Statistics for the person and office pages
+
+Everything is read from the person's rows in the rollups rather than their distances:
+their total from PersonTotal, and their weekly trend, best day and streaks from
+DailyTotal, which has one row per day they logged anything. Streaks are found in SQL
+with the gaps and islands technique: numbering the days in date order with ROW_NUMBER()
+and subtracting that from the date gives the same value for every day in an unbroken run.
+
+The statistics are cached per person and discarded, once the transaction commits,
+whenever a write touches that person's rollups. Ranks change whenever anyone logs
+a distance, so they are looked up on each request instead, from the precomputed
+leaderboards and with a RANK() window over the people in the person's office.
+
+Office statistics are a single grouped aggregate over the office's people joined to
+their PersonTotal, so they cost the same however many distances or other offices
+there are, and are read on each request.
+
+The organisation tree (countries, their cities and the offices in those) is read from
+OrgTotal, which holds every node's total, so the whole tree, or any node with its
+children, is a single indexed query.
+"""
+import datetime
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import ExtractYear, TruncWeek
+from django.utils import timezone
+
+from . import leaderboards
+from .caching import counters, get_cache, increment
+from .models import DailyTotal, OrgTotal, Person, PersonTotal, Ranking
+
+# Weeks shown in the weekly trend, including the current one
+TREND_WEEKS = 8
+
+# People listed as an office's top contributors
+TOP_CONTRIBUTORS = 5
+
+_GENERATION_KEY = "distance:stats:generation"
+
+
+def _version_key(person_id):
+    return f"distance:stats:version:{person_id}"
+
+
+def _key(cache, person_id, today):
+    """
+    The cache key for a person's statistics on a date, which changes whenever their
+    version counter is bumped or the rollups are rebuilt
+    """
+    found = counters(cache, [_GENERATION_KEY, _version_key(person_id)])
+    generation = found[_GENERATION_KEY]
+    version = found[_version_key(person_id)]
+    # The weekly trend and current streak move on with the date
+    return f"distance:stats:{generation}:{person_id}:{version}:{today.isoformat()}"
+
+
+def _island():
+    """The SQL for a day's island: its date less its position, as a number of days"""
+    if connection.vendor == "sqlite":
+        return "julianday(date) - ROW_NUMBER() OVER (ORDER BY date)"
+    return "date - CAST(ROW_NUMBER() OVER (ORDER BY date) AS INTEGER)"
+
+
+def _streak(person_id, order):
+    """
+    Returns a run of consecutive days with a distance, as (days, first day, last day)
+
+    Args:
+        person_id (int): The person
+        order (str): Which run to return, 'days DESC' for the longest or 'last DESC' for the latest
+    """
+    sql = f"""
+        SELECT COUNT(*) AS days, MIN(date) AS first, MAX(date) AS last
+        FROM (
+            SELECT date, {_island()} AS island
+            FROM {DailyTotal._meta.db_table}
+            WHERE person_id = %s
+        ) days
+        GROUP BY island
+        ORDER BY {order}, last DESC
+        LIMIT 1
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [person_id])
+        row = cursor.fetchone()
+    if row is None:
+        return None
+    to_date = DailyTotal._meta.get_field("date").to_python
+    return row[0], to_date(row[1]), to_date(row[2])
+
+
+def _weeks(person_id, today):
+    """Returns (week start, total) for each of the last TREND_WEEKS weeks, including empty ones"""
+    this_week = leaderboards.period_start(Ranking.WEEK, today)
+    first = this_week - datetime.timedelta(weeks=TREND_WEEKS - 1)
+    rows = (
+        DailyTotal.objects.filter(person_id=person_id, date__gte=first)
+        .annotate(week=TruncWeek("date"))
+        .values("week")
+        .annotate(sum=Sum("total"))
+        .order_by()
+    )
+    to_date = DailyTotal._meta.get_field("date").to_python
+    totals = {to_date(row["week"]): Decimal(row["sum"]).quantize(Decimal("0.01")) for row in rows}
+    starts = [first + datetime.timedelta(weeks=n) for n in range(TREND_WEEKS)]
+    return [(start, totals.get(start, Decimal("0.00"))) for start in starts]
+
+
+def _years(person_id):
+    """Returns (year, total) for each year the person logged a distance in, newest first"""
+    rows = (
+        DailyTotal.objects.filter(person_id=person_id)
+        .annotate(year=ExtractYear("date"))
+        .values("year")
+        .annotate(sum=Sum("total"))
+        .order_by("-year")
+    )
+    return [(row["year"], row["sum"]) for row in rows]
+
+
+def _compute(person_id, today):
+    rollup = PersonTotal.objects.filter(person_id=person_id).values("total", "entries").first()
+    best = DailyTotal.objects.filter(person_id=person_id).order_by("-total", "date").values("date", "total").first()
+    return {
+        "total": rollup["total"] if rollup else Decimal(0),
+        "entries": rollup["entries"] if rollup else 0,
+        "days": DailyTotal.objects.filter(person_id=person_id).count(),
+        "best_day": best,
+        "weeks": _weeks(person_id, today),
+        "longest_streak": _streak(person_id, "days DESC"),
+        "latest_streak": _streak(person_id, "last DESC"),
+        "years": _years(person_id),
+    }
+
+
+def office_rank(person_id):
+    """
+    Returns the person's (rank, number of people ranked) among the people in their
+    office with a distance, or None if they have not logged one
+    """
+    totals, people = PersonTotal._meta.db_table, Person._meta.db_table
+    sql = f"""
+        SELECT standing, ranked
+        FROM (
+            SELECT totals.person_id,
+                   RANK() OVER (ORDER BY totals.total DESC) AS standing,
+                   COUNT(*) OVER () AS ranked
+            FROM {totals} totals
+            JOIN {people} people ON people.id = totals.person_id
+            WHERE totals.entries > 0
+              AND people.location_id = (SELECT location_id FROM {people} WHERE id = %s)
+        ) office
+        WHERE person_id = %s
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [person_id, person_id])
+        return cursor.fetchone()
+
+
+def _kilometres(metres):
+    return (Decimal(metres) / 1000).quantize(Decimal("0.01"))
+
+
+def person_stats(person_id, today=None):
+    """
+    Returns a person's statistics, from the cache when nothing they logged has changed
+
+    Args:
+        person_id (int): The person
+        today (Date): The date the trend and current streak run up to, defaults to today
+
+    Returns:
+        dict: 'kilometres' and 'entries' in total, 'days' with a distance, 'best_day'
+              ({'date', 'kilometres'} or None), 'weeks' ({'start', 'kilometres', 'width'} for each
+              of the last TREND_WEEKS weeks, width being a percentage of the best of them), 'trend'
+              (percentage change on the week before, or None), 'longest_streak' ((days, first day,
+              last day) or None), 'current_streak' (days, counting a run that ended yesterday),
+              'years' ({'year', 'kilometres'} for each year with a distance, newest first,
+              including years that have been archived),
+              and the live 'rank' and 'month_rank' (Ranking or None) and 'office_rank'
+              ((rank, people ranked) or None)
+    """
+    today = today or timezone.localdate()
+    cache = get_cache()
+    key = _key(cache, person_id, today)
+    cached = cache.get(key)
+    if cached is None:
+        cached = _compute(person_id, today)
+        cache.set(key, cached, getattr(settings, "DISTANCE_FRAGMENT_TIMEOUT", 3600))
+
+    latest = cached["latest_streak"]
+    best = cached["best_day"]
+    most = max(total for start, total in cached["weeks"]) or 1
+    (_, previous), (_, current) = cached["weeks"][-2:]
+    return {
+        "kilometres": _kilometres(cached["total"]),
+        "entries": cached["entries"],
+        "days": cached["days"],
+        "best_day": best and {"date": best["date"], "kilometres": _kilometres(best["total"])},
+        "weeks": [
+            {"start": start, "kilometres": _kilometres(total), "width": int(total * 100 / most)}
+            for start, total in cached["weeks"]
+        ],
+        "trend": ((current - previous) * 100 / previous).quantize(Decimal("1")) if previous else None,
+        "longest_streak": cached["longest_streak"],
+        "current_streak": latest[0] if latest and latest[2] >= today - datetime.timedelta(days=1) else 0,
+        "years": [{"year": year, "kilometres": _kilometres(total)} for year, total in cached["years"]],
+        "rank": leaderboards.position(Ranking.PEOPLE, Ranking.OVERALL, person_id),
+        "month_rank": leaderboards.position(Ranking.PEOPLE, Ranking.MONTH, person_id, today),
+        "office_rank": office_rank(person_id),
+    }
+
+
+def office_stats(office_id):
+    """
+    Returns an office's statistics
+
+    Args:
+        office_id (int): The office
+
+    Returns:
+        dict: 'members' in the office, how many are 'active' (have logged a distance),
+              their 'entries' and 'kilometres' in total, 'per_capita' and 'per_active'
+              kilometres, the office's 'rank' (Ranking or None) and the 'top' contributors
+              (PersonTotals, with their person)
+    """
+    summary = Person.objects.filter(location_id=office_id).aggregate(
+        members=Count("id"),
+        active=Count("rollup", filter=Q(rollup__entries__gt=0)),
+        entries=Sum("rollup__entries"),
+        total=Sum("rollup__total"),
+    )
+    total = Decimal(summary["total"] or 0)
+    top = (
+        PersonTotal.objects.filter(person__location_id=office_id, entries__gt=0)
+        .select_related("person")
+        .order_by("-total", "person_id")[:TOP_CONTRIBUTORS]
+    )
+    return {
+        "members": summary["members"],
+        "active": summary["active"],
+        "entries": summary["entries"] or 0,
+        "kilometres": _kilometres(total),
+        "per_capita": _kilometres(total / summary["members"]) if summary["members"] else None,
+        "per_active": _kilometres(total / summary["active"]) if summary["active"] else None,
+        "rank": leaderboards.position(Ranking.OFFICES, Ranking.OVERALL, office_id),
+        "top": list(top),
+    }
+
+
+def org_tree():
+    """
+    Returns every node of the organisation tree that has a distance, in a single query
+
+    Returns:
+        list: A dict for each country, in name order, with its 'node' (OrgTotal) and its
+              'cities', each a dict with its 'node' and its 'offices' (OrgTotals, with their office)
+    """
+    nodes = (
+        OrgTotal.objects.filter(entries__gt=0)
+        .select_related("office")
+        .order_by("country", "city", "depth", "office_id")
+    )
+    countries = []
+    for node in nodes:
+        if node.depth == OrgTotal.COUNTRY:
+            countries.append({"node": node, "cities": []})
+        elif node.depth == OrgTotal.CITY:
+            countries[-1]["cities"].append({"node": node, "offices": []})
+        else:
+            countries[-1]["cities"][-1]["offices"].append(node)
+    return countries
+
+
+def org_node(country=None, city=None):
+    """
+    Returns a node of the organisation tree and its children, largest total first, in a single query
+
+    Args:
+        country (str): The country to drill down into, or None for the whole organisation
+        city (str): The city within the country to drill down into
+
+    Returns:
+        dict: The node's 'depth' (None for the whole organisation), 'kilometres' and 'entries',
+              and its 'children' ({'node': OrgTotal with its office, 'share': percentage of the
+              node's total}), or None if the node has no distances
+    """
+    if country is None:
+        depths, lookup = [OrgTotal.COUNTRY], {}
+    elif city is None:
+        depths, lookup = [OrgTotal.COUNTRY, OrgTotal.CITY], {"country": country}
+    else:
+        depths, lookup = [OrgTotal.CITY, OrgTotal.OFFICE], {"country": country, "city": city}
+    nodes = list(
+        OrgTotal.objects.filter(depth__in=depths, entries__gt=0, **lookup)
+        .select_related("office")
+        .order_by("-total", "country", "city", "office_id")
+    )
+    children = [node for node in nodes if node.depth == depths[-1]]
+    if country is None:
+        total, entries, depth = sum(node.total for node in children), sum(node.entries for node in children), None
+    else:
+        parent = next((node for node in nodes if node.depth == depths[0]), None)
+        if parent is None:
+            return None
+        total, entries, depth = parent.total, parent.entries, parent.depth
+    return {
+        "depth": depth,
+        "kilometres": _kilometres(total),
+        "entries": entries,
+        "children": [
+            {"node": node, "share": (node.total * 100 / total).quantize(Decimal("1")) if total else 0}
+            for node in children
+        ],
+    }
+
+
+def changed(person_ids):
+    """Called after a write touching the people's rollups, discards their statistics once the transaction commits"""
+    person_ids = set(person_ids)
+
+    def bump():
+        cache = get_cache()
+        for person_id in person_ids:
+            increment(cache, _version_key(person_id))
+    transaction.on_commit(bump)
+
+
+def invalidate_all():
+    """Discards everyone's statistics once the transaction commits, after the rollups are rebuilt"""
+    transaction.on_commit(lambda: increment(get_cache(), _GENERATION_KEY))
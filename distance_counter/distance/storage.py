@@ -0,0 +1,90 @@
+"""Static file storage for `python manage.py collectstatic`
+
+Files are collected under names containing a hash of their content, recorded in a
+manifest, so {% static %} URLs change whenever a file does and browsers can cache
+them forever. Every text file is also saved gzipped, and brotli compressed if the
+optional brotli package is installed, so StaticFilesMiddleware can send the
+smallest copy a browser accepts without compressing anything on a request.
+"""
+import gzip
+import os
+
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage, StaticFilesStorage
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Extensions of the files worth compressing, images and fonts already are
+COMPRESSIBLE = {".css", ".js", ".map", ".svg", ".txt", ".json", ".html", ".xml", ".ico"}
+
+# Files smaller than this, in bytes, are not worth a second request header
+MIN_SIZE = 256
+
+# Third party files are hashed but their content is left alone, so they still match
+# their subresource integrity hashes
+UNPROCESSED = ("vendor/",)
+
+
+def compress(path):
+    """
+    Saves gzip and brotli compressed copies of a file next to it, as path.gz and path.br
+
+    Copies no smaller than the file are not kept
+
+    Returns:
+        list: The paths of the copies saved
+    """
+    with open(path, "rb") as file:
+        content = file.read()
+    if len(content) < MIN_SIZE:
+        return []
+    encoders = [(".gz", lambda data: gzip.compress(data, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        encoders.append((".br", lambda data: brotli.compress(data)))
+
+    saved = []
+    for suffix, encode in encoders:
+        compressed = encode(content)
+        if len(compressed) < len(content):
+            with open(path + suffix, "wb") as file:
+                file.write(compressed)
+            saved.append(path + suffix)
+    return saved
+
+
+class CompressedManifestStorage(ManifestStaticFilesStorage):
+    """
+    Manifest storage that also saves compressed copies of the files it collects
+
+    Until collectstatic has been run, e.g. in the tests or straight from a checkout,
+    URLs fall back to the files' plain names instead of raising an error. URLs in
+    files under UNPROCESSED, such as Bootstrap's sourceMappingURL comments, are not
+    rewritten
+    """
+    manifest_strict = False
+
+    def url_converter(self, name, hashed_files, template=None):
+        if name.startswith(UNPROCESSED):
+            return lambda matchobj: matchobj.group(0)
+        return super().url_converter(name, hashed_files, template)
+
+    def post_process(self, paths, dry_run=False, **options):
+        names = set(paths)
+        for name, hashed_name, processed in super().post_process(paths, dry_run, **options):
+            if hashed_name and not isinstance(processed, Exception):
+                names.add(hashed_name)
+            yield name, hashed_name, processed
+        if dry_run:
+            return
+        for name in names:
+            if os.path.splitext(name)[1].lower() in COMPRESSIBLE and self.exists(name):
+                compress(self.path(name))
+
+    def url(self, name, force=False):
+        try:
+            return super().url(name, force)
+        except ValueError:
+            # Not collected yet, so there is no hashed copy to point to
+            return StaticFilesStorage.url(self, name)
@@ -1,7 +1,35 @@
-from django.test import TestCase
+import base64
+import datetime
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import time
+from decimal import Decimal
+from io import StringIO
+from unittest import skipUnless
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Sum
+from django.test import AsyncClient, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth.models import User
 from django.urls import reverse
-from .models import Distance, Person, Office, Unit
+from django.utils import timezone
+from . import archive, assets, caching, jobs, leaderboards, rollups, series
+from .db import configure_sqlite
+from .importer import import_distances, read_rows
+from .middleware import get_stats, reset_stats
+from .pagination import encode_cursor
+from .models import ArchivedDistance, Challenge, DailyTotal, Distance, Job, Person, Office, OfficeTotal, OrgTotal, PersonTotal, Ranking, Unit
+from .stats import office_stats, org_node, org_tree, person_stats
 
 class IndexViewTestCase(TestCase):
     def setUp(self):
@@ -51,6 +79,65 @@ class IndexViewTestCase(TestCase):
         self.assertIn("Sept. 15, 2023", str(response.content))
         self.assertIn("Sept. 16, 2023", str(response.content))
 
+class IndexPaginationTestCase(TestCase):
+    def setUp(self):
+        # Creates a user and more distances than fit on one page
+
+        office = Office.objects.create(city="Leeds", country="UK")
+        self.person = Person.objects.create(
+            first_name="Bart",
+            last_name="Simpson",
+            email="bart@example.com",
+            location=office
+        )
+        self.unit = Unit.objects.create(unit_of_measurement="km")
+
+        for day in range(1, 8):
+            Distance.objects.create(date=f"2023-10-0{day}", person=self.person, distance=day, unit=self.unit)
+        # Two records on the same date to check the id tie-breaker
+        Distance.objects.create(date="2023-10-07", person=self.person, distance=99, unit=self.unit)
+
+        self.user = User.objects.create_user(username='user', password='password')
+        self.client.login(username='user', password='password')
+
+    def test_pages_cover_every_record_once(self):
+        seen = []
+        response = self.client.get(reverse('index'), {'page_size': 3})
+        while True:
+            page = response.context['distances']
+            seen.extend(distance.id for distance in page)
+            if not page.has_next:
+                break
+            response = self.client.get(reverse('index'), {'page_size': 3, 'after': page.next_cursor})
+
+        expected = list(Distance.objects.order_by('-date', '-id').values_list('id', flat=True))
+        self.assertEqual(seen, expected)
+
+    def test_previous_cursor_returns_to_earlier_page(self):
+        first = self.client.get(reverse('index'), {'page_size': 3}).context['distances']
+        second = self.client.get(reverse('index'), {'page_size': 3, 'after': first.next_cursor}).context['distances']
+        self.assertFalse(first.has_previous)
+        self.assertTrue(second.has_previous)
+
+        back = self.client.get(reverse('index'), {'page_size': 3, 'before': second.previous_cursor}).context['distances']
+        self.assertEqual([d.id for d in back], [d.id for d in first])
+
+    def test_query_count_is_independent_of_page_size(self):
+        # session, user, a single joined query for the page, and the challenge widget
+        with self.assertNumQueries(4):
+            self.client.get(reverse('index'), {'page_size': 8})
+
+    def test_invalid_cursor_shows_first_page(self):
+        response = self.client.get(reverse('index'), {'after': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['distances']), 8)
+
+    def test_cursor_with_invalid_values_shows_first_page(self):
+        for values in [["garbage", 1], ["2023-09-15", "one"], ["2023-09-15", 10 ** 20]]:
+            response = self.client.get(reverse('index'), {'before': encode_cursor(values)})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.context['distances']), 8)
+
 class DistanceViewTestCase(TestCase):
     def setUp(self):
 
@@ -324,4 +411,1754 @@ class OfficeViewTestCase(TestCase):
         response = self.client.get(reverse('delete_office', args=[self.office.id]))
 
         # Check if the response redirects the user due to the Office no longer existing
-        self.assertEqual(response.status_code, 302)
\ No newline at end of file
+        self.assertEqual(response.status_code, 302)
+
+class UnitConversionTestCase(TestCase):
+    def setUp(self):
+
+        office = Office.objects.create(city="Cambridge", country="UK")
+        self.person = Person.objects.create(
+            first_name="Lisa",
+            last_name="Simpson",
+            email="lisa@example.com",
+            location=office
+        )
+        self.miles = Unit.objects.create(unit_of_measurement="miles", metres_per_unit="1609.344")
+        self.steps = Unit.objects.create(unit_of_measurement="steps", is_steps=True)
+
+    @override_settings(DISTANCE_STRIDE_LENGTH=0.8)
+    def test_distance_is_normalized_on_save(self):
+        walk = Distance.objects.create(date="2023-09-15", person=self.person, distance=2, unit=self.miles)
+        steps = Distance.objects.create(date="2023-09-15", person=self.person, distance=1000, unit=self.steps)
+
+        self.assertEqual(walk.normalized_distance, Decimal("3218.69"))
+        self.assertEqual(steps.normalized_distance, Decimal("800.00"))
+
+        # Mixed units can now be summed in a single query
+        total = Distance.objects.aggregate(total=Sum("normalized_distance"))["total"]
+        self.assertEqual(total, Decimal("4018.69"))
+
+    def test_changing_unit_factor_queues_renormalizing_job(self):
+        Distance.objects.create(date="2023-09-15", person=self.person, distance=3, unit=self.miles)
+        user = User.objects.create_user(username='user', password='password')
+        self.client.force_login(user)
+
+        response = self.client.post(reverse('unit_edit', args=[self.miles.pk]), {
+            'unit_of_measurement': 'miles', 'metres_per_unit': '1000',
+        })
+
+        job = Job.objects.get(task='rebuild_rollups')
+        self.assertRedirects(response, reverse('job', args=[job.id]))
+        self.assertEqual(job.payload, {'normalize': True})
+        # The save itself leaves the distances alone, the job renormalizes them
+        self.assertEqual(Distance.objects.get().normalized_distance, Decimal("4828.03"))
+        jobs.work('test', burst=True)
+        self.assertEqual(Distance.objects.get().normalized_distance, Decimal("3000.00"))
+        self.assertEqual(PersonTotal.objects.get().total, Decimal("3000.00"))
+
+    def test_renaming_unit_queues_no_job(self):
+        self.client.force_login(User.objects.create_user(username='user', password='password'))
+        self.client.post(reverse('unit_edit', args=[self.miles.pk]), {
+            'unit_of_measurement': 'mi', 'metres_per_unit': '1609.344',
+        })
+
+        self.assertFalse(Job.objects.filter(task='rebuild_rollups').exists())
+
+
+class RollupTestCase(TestCase):
+    def setUp(self):
+
+        self.user = User.objects.create_user(username='user', password='password', is_superuser=True)
+        self.client.login(username='user', password='password')
+
+        self.manchester = Office.objects.create(city="Manchester", country="UK")
+        self.cambridge = Office.objects.create(city="Cambridge", country="UK")
+        self.homer = Person.objects.create(
+            first_name="Homer", last_name="Simpson", email="homer@example.com", location=self.manchester
+        )
+        self.marge = Person.objects.create(
+            first_name="Marge", last_name="Simpson", email="marge@example.com", location=self.cambridge
+        )
+        self.km = Unit.objects.create(unit_of_measurement="km", metres_per_unit=1000)
+        self.metres = Unit.objects.create(unit_of_measurement="m")
+
+    def log(self, person, distance, unit, date="2023-09-15"):
+        self.client.post(reverse('log_create'), {
+            'date': date, 'person': person.id, 'distance': distance, 'unit': unit.id
+        })
+        return Distance.objects.latest('id')
+
+    def test_logging_updates_totals(self):
+        self.log(self.homer, 2, self.km)
+        self.log(self.homer, 500, self.metres)
+
+        self.assertEqual(PersonTotal.objects.get(person=self.homer).total, Decimal("2500"))
+        self.assertEqual(OfficeTotal.objects.get(office=self.manchester).entries, 2)
+        self.assertEqual(DailyTotal.objects.get(person=self.homer).total, Decimal("2500"))
+        self.assertEqual(rollups.verify(), [])
+
+    def test_edit_moves_record_between_people_and_units(self):
+        distance = self.log(self.homer, 2, self.km)
+
+        self.client.post(reverse('distance_edit', args=[distance.id]), {
+            'date': '2023-09-16', 'person': self.marge.id, 'distance': 300, 'unit': self.metres.id
+        })
+
+        self.assertEqual(PersonTotal.objects.get(person=self.homer).total, 0)
+        self.assertEqual(OfficeTotal.objects.get(office=self.manchester).total, 0)
+        self.assertEqual(OfficeTotal.objects.get(office=self.cambridge).total, Decimal("300"))
+        self.assertFalse(DailyTotal.objects.filter(person=self.homer).exists())
+        self.assertEqual(rollups.verify(), [])
+
+    def test_delete_removes_record_from_totals(self):
+        distance = self.log(self.marge, 1, self.km)
+        self.client.post(reverse('delete_distance', args=[distance.id]))
+
+        self.assertEqual(PersonTotal.objects.get(person=self.marge).entries, 0)
+        self.assertEqual(rollups.verify(), [])
+
+    def test_cascading_deletes_remove_totals_in_one_pass(self):
+        bart = Person.objects.create(first_name="Bart", last_name="Simpson", email="bart@example.com", location=self.manchester)
+        lisa = Person.objects.create(first_name="Lisa", last_name="Simpson", email="lisa@example.com", location=self.manchester)
+        Distance.objects.create(date="2023-09-01", person=lisa, distance=1, unit=self.km)
+        for _ in range(20):
+            Distance.objects.create(date="2023-09-01", person=bart, distance=100, unit=self.metres)
+        for day in range(1, 21):
+            Distance.objects.create(date=f"2023-09-{day:02}", person=self.homer, distance=1, unit=self.km)
+            Distance.objects.create(date=f"2023-09-{day:02}", person=self.marge, distance=2, unit=self.km)
+
+        # The same number of queries however many distances cascade
+        with CaptureQueriesContext(connection) as one:
+            lisa.delete()
+        with self.assertNumQueries(len(one)):
+            bart.delete()
+        self.assertEqual(OfficeTotal.objects.get(office=self.manchester).total, Decimal("20000"))
+        self.assertEqual(rollups.verify(), [])
+
+        self.metres.delete()
+        self.km.delete()
+        self.assertEqual(PersonTotal.objects.get(person=self.marge).entries, 0)
+        self.assertEqual(rollups.verify(), [])
+
+    def test_office_delete_removes_its_peoples_totals(self):
+        for day in range(1, 11):
+            Distance.objects.create(date=f"2023-09-{day:02}", person=self.homer, distance=1, unit=self.km)
+            Distance.objects.create(date=f"2023-09-{day:02}", person=self.marge, distance=2, unit=self.km)
+
+        Office.objects.filter(pk=self.manchester.pk).delete()
+
+        self.assertEqual(OrgTotal.objects.get(depth=OrgTotal.COUNTRY, country="UK").total, Decimal("20000"))
+        self.assertEqual(rollups.verify(), [])
+
+    def test_person_changing_office_moves_their_total(self):
+        self.log(self.homer, 1, self.km)
+        self.homer.location = self.cambridge
+        self.homer.save()
+
+        self.assertEqual(OfficeTotal.objects.get(office=self.cambridge).total, Decimal("1000"))
+        self.assertEqual(rollups.verify(), [])
+
+    def test_rebuild_command_repairs_rollups(self):
+        self.log(self.homer, 1, self.km)
+        PersonTotal.objects.update(total=5)
+
+        with self.assertRaises(CommandError):
+            call_command('rebuild_rollups', '--check', stdout=StringIO(), stderr=StringIO())
+        call_command('rebuild_rollups', stdout=StringIO())
+        self.assertEqual(PersonTotal.objects.get().total, Decimal("1000"))
+
+
+class LeaderboardTestCase(TestCase):
+    def setUp(self):
+
+        self.user = User.objects.create_user(username='user', password='password', email='homer@example.com')
+        self.client.login(username='user', password='password')
+
+        springfield = Office.objects.create(city="Springfield", country="USA")
+        shelbyville = Office.objects.create(city="Shelbyville", country="USA")
+        self.homer = Person.objects.create(
+            first_name="Homer", last_name="Simpson", email="homer@example.com", location=springfield
+        )
+        self.marge = Person.objects.create(
+            first_name="Marge", last_name="Simpson", email="marge@example.com", location=springfield
+        )
+        self.bob = Person.objects.create(
+            first_name="Bob", last_name="Terwilliger", email="bob@example.com", location=shelbyville
+        )
+        self.km = Unit.objects.create(unit_of_measurement="km", metres_per_unit=1000)
+
+        # Left for top() to compute, so the tests only see refreshes their own writes ask for
+        with self.settings(DISTANCE_LEADERBOARD_REFRESH="schedule"):
+            Distance.objects.create(date="2023-09-04", person=self.homer, distance=3, unit=self.km)
+            Distance.objects.create(date="2023-09-20", person=self.marge, distance=5, unit=self.km)
+            Distance.objects.create(date="2023-10-02", person=self.bob, distance=4, unit=self.km)
+
+    def test_overall_people_board(self):
+        response = self.client.get(reverse('leaderboard', args=['people']))
+
+        rankings = response.context['rankings']
+        self.assertEqual([r.subject_id for r in rankings], [self.marge.id, self.bob.id, self.homer.id])
+        self.assertEqual(response.context['mine'].rank, 3)
+
+    def test_month_and_week_boards(self):
+        month = self.client.get(reverse('leaderboard', args=['offices']), {'period': 'month', 'date': '2023-09-10'})
+        self.assertEqual([r.name for r in month.context['rankings']], ["Springfield"])
+        self.assertEqual(month.context['rankings'][0].total, Decimal("8000"))
+
+        week = self.client.get(reverse('leaderboard', args=['people']), {'period': 'week', 'date': '2023-10-08'})
+        self.assertEqual([r.subject_id for r in week.context['rankings']], [self.bob.id])
+
+    def test_ties_share_a_rank(self):
+        Distance.objects.create(date="2023-10-03", person=self.homer, distance=2, unit=self.km)
+        leaderboards.refresh(Ranking.PEOPLE, Ranking.OVERALL)
+
+        ranks = dict(Ranking.objects.filter(board=Ranking.PEOPLE, period=Ranking.OVERALL).values_list('subject_id', 'rank'))
+        self.assertEqual(ranks, {self.homer.id: 1, self.marge.id: 1, self.bob.id: 3})
+
+    @override_settings(DISTANCE_LEADERBOARD_REFRESH="write")
+    def test_write_refreshes_board_on_commit(self):
+        leaderboards.refresh(Ranking.PEOPLE, Ranking.OVERALL)
+        with self.captureOnCommitCallbacks(execute=True):
+            Distance.objects.create(date="2023-10-03", person=self.bob, distance=10, unit=self.km)
+
+        first = leaderboards.top(Ranking.PEOPLE, Ranking.OVERALL)[0]
+        self.assertEqual((first.subject_id, first.total), (self.bob.id, Decimal("14000")))
+
+    def test_writes_in_one_transaction_queue_one_refresh_job(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Distance.objects.create(date="2023-10-03", person=self.bob, distance=10, unit=self.km)
+            Distance.objects.create(date="2023-11-20", person=self.homer, distance=2, unit=self.km)
+
+        job = Job.objects.get(task="refresh_leaderboards")
+        self.assertEqual(job.payload["dates"], ["2023-10-03", "2023-11-20"])
+        self.assertFalse(job.payload["all"])
+
+    def test_writes_after_a_rolled_back_savepoint_still_queue_a_refresh(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    Distance.objects.create(date="2023-10-03", person=self.bob, distance=10, unit=self.km)
+                    raise IntegrityError
+            except IntegrityError:
+                pass
+            Distance.objects.create(date="2023-11-20", person=self.homer, distance=2, unit=self.km)
+
+        job = Job.objects.get(task="refresh_leaderboards")
+        self.assertIn("2023-11-20", job.payload["dates"])
+
+    def test_no_job_is_queued_when_a_queued_one_covers_the_dates(self):
+        for _ in range(2):
+            with self.captureOnCommitCallbacks(execute=True):
+                Distance.objects.create(date="2023-10-03", person=self.bob, distance=10, unit=self.km)
+
+        self.assertEqual(Job.objects.filter(task="refresh_leaderboards").count(), 1)
+
+    def test_refresh_job_folds_in_other_queued_jobs(self):
+        first = jobs.enqueue("refresh_leaderboards", {"all": False, "dates": ["2023-09-04"], "boards": [Ranking.PEOPLE]})
+        second = jobs.enqueue("refresh_leaderboards", {"all": False, "dates": ["2023-10-02"], "boards": [Ranking.OFFICES]})
+        jobs.run(jobs.claim("test"))
+
+        second.refresh_from_db()
+        self.assertEqual((second.status, second.result), (Job.SUCCEEDED, {"merged_into": first.pk}))
+        self.assertTrue(Ranking.objects.filter(board=Ranking.OFFICES, period=Ranking.MONTH,
+                                               period_start=datetime.date(2023, 10, 1)).exists())
+        self.assertIsNone(jobs.claim("test"))
+
+    def test_failed_refresh_keeps_the_merged_jobs_boards(self):
+        def fail(dates, boards):
+            raise RuntimeError("Database went away")
+        self.addCleanup(setattr, leaderboards, "refresh_dates", leaderboards.refresh_dates)
+        leaderboards.refresh_dates = fail
+
+        first = jobs.enqueue("refresh_leaderboards", {"all": False, "dates": ["2023-09-04"], "boards": [Ranking.PEOPLE]})
+        jobs.enqueue("refresh_leaderboards", {"all": False, "dates": ["2023-10-02"], "boards": [Ranking.OFFICES]})
+        jobs.run(jobs.claim("test"))
+
+        first.refresh_from_db()
+        self.assertEqual(first.status, Job.QUEUED)
+        self.assertEqual(first.payload, {"all": False, "dates": ["2023-09-04", "2023-10-02"],
+                                         "boards": [Ranking.OFFICES, Ranking.PEOPLE]})
+
+    def test_empty_board_is_not_refreshed_on_every_read(self):
+        leaderboards.top(Ranking.PEOPLE, Ranking.WEEK, datetime.date(2020, 1, 1))
+        with self.assertNumQueries(2):
+            self.assertEqual(leaderboards.top(Ranking.PEOPLE, Ranking.WEEK, datetime.date(2020, 1, 1)), [])
+
+    def test_query_count_does_not_grow_with_distances(self):
+        leaderboards.refresh(Ranking.PEOPLE, Ranking.OVERALL)
+        # session, user, "my" person, top of board, my rank, and the challenge widget
+        with self.assertNumQueries(6):
+            self.client.get(reverse('leaderboard', args=['people']))
+
+    def test_out_of_range_id_is_ignored(self):
+        response = self.client.get(reverse('leaderboard', args=['people']), {'id': '9' * 30})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['mine'].subject_id, self.homer.id)
+
+    def test_dates_whose_period_ends_out_of_range_show_the_current_one(self):
+        for board, period, date in [('people', 'week', '9999-12-31'), ('offices', 'month', '9999-12-15')]:
+            response = self.client.get(reverse('leaderboard', args=[board]), {'period': period, 'date': date})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.context['period_start'], leaderboards.period_start(period, timezone.localdate()))
+
+    def test_unknown_board_is_not_found(self):
+        response = self.client.get(reverse('leaderboard', args=['pets']))
+        self.assertEqual(response.status_code, 404)
+
+
+class ImportTestCase(TestCase):
+    def setUp(self):
+
+        self.user = User.objects.create_user(username='user', password='password')
+        self.client.login(username='user', password='password')
+
+        self.manchester = Office.objects.create(city="Manchester", country="UK")
+        self.cambridge = Office.objects.create(city="Cambridge", country="UK")
+        self.ned = Person.objects.create(
+            first_name="Ned", last_name="Flanders", email="ned@example.com", location=self.manchester
+        )
+        # Same email in another office, so rows for it need an office column
+        Person.objects.create(first_name="Ned", last_name="Flanders", email="ned@example.com", location=self.cambridge)
+        self.maude = Person.objects.create(
+            first_name="Maude", last_name="Flanders", email="maude@example.com", location=self.cambridge
+        )
+        Unit.objects.create(unit_of_measurement="km", metres_per_unit=1000)
+
+    def test_csv_upload_imports_valid_rows_and_reports_errors(self):
+        upload = SimpleUploadedFile("distances.csv", (
+            "date,person_email,office,distance,unit\n"
+            "2023-09-15,ned@example.com,Manchester,5,km\n"
+            "2023-09-16,MAUDE@example.com,,2.5,KM\n"
+            "2023-09-17,ned@example.com,,1,km\n"
+            "2023-13-01,maude@example.com,,1,km\n"
+            "2023-09-18,maude@example.com,,1,parsecs\n"
+            "2023-09-19,nobody@example.com,,1,km\n"
+            "2023-09-20,maude@example.com,,1.234,km\n"
+        ).encode())
+
+        job_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, job_dir)
+        with self.settings(DISTANCE_JOB_DIR=job_dir):
+            response = self.client.post(reverse('distance_import'), {'file': upload, 'format': 'csv'})
+            # Nothing is imported until a worker runs the job
+            self.assertEqual(Distance.objects.count(), 0)
+            job = Job.objects.get()
+            self.assertRedirects(response, reverse('job', args=[job.id]))
+            jobs.work("test", burst=True)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.SUCCEEDED)
+        self.assertEqual(job.result['created'], 2)
+        self.assertEqual([line for line, message in job.result['errors']], [4, 5, 6, 7, 8])
+        self.assertEqual((job.progress, job.progress_total), (7, 7))
+        self.assertEqual(os.listdir(job_dir), [])
+        self.assertEqual(PersonTotal.objects.get(person=self.ned).total, Decimal("5000"))
+        self.assertEqual(rollups.verify(), [])
+
+        response = self.client.get(reverse('job', args=[job.id]))
+        self.assertContains(response, "2 distances imported, 5 rows skipped")
+
+    def test_query_count_does_not_grow_with_rows(self):
+        rows = [(n, {'date': '2023-09-15', 'person_id': self.maude.id, 'distance': n, 'unit': 'km'}) for n in range(1, 57)]
+        # The first import creates the rollup rows, later ones only update them
+        import_distances(rows[:1])
+        with CaptureQueriesContext(connection) as fifty:
+            import_distances(rows[1:51])
+        with CaptureQueriesContext(connection) as five:
+            import_distances(rows[51:])
+
+        self.assertEqual(len(fifty), len(five))
+        self.assertEqual(Distance.objects.count(), 56)
+
+    def test_person_id_too_large_for_the_database_is_an_unknown_person(self):
+        result = import_distances([
+            (1, {'date': '2023-09-15', 'person_id': '9' * 23, 'distance': 1, 'unit': 'km'}),
+            (2, {'date': '2023-09-15', 'person_id': self.maude.id, 'distance': 2, 'unit': 'km'}),
+        ])
+
+        self.assertEqual(result.created, 1)
+        self.assertEqual([line for line, message in result.errors], [1])
+        self.assertIn("Unknown person", result.errors[0][1])
+
+    def test_import_command_reads_json_lines(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl', delete=False) as file:
+            file.write('{"date": "2023-09-15", "person_id": %d, "distance": 3, "unit": "km"}\n' % self.maude.id)
+            file.write('not json\n')
+        self.addCleanup(os.remove, file.name)
+
+        stdout, stderr = StringIO(), StringIO()
+        call_command('import_distances', file.name, stdout=stdout, stderr=stderr)
+
+        self.assertIn("1 distances imported, 1 rows skipped", stdout.getvalue())
+        self.assertIn("Line 2", stderr.getvalue())
+
+
+class ExportTestCase(TestCase):
+    def setUp(self):
+
+        self.user = User.objects.create_user(username='user', password='password')
+        self.client.login(username='user', password='password')
+
+        office = Office.objects.create(city="Capital City", country="USA")
+        self.person = Person.objects.create(
+            first_name="Seymour", last_name="Skinner", email="seymour@example.com", location=office
+        )
+        unit = Unit.objects.create(unit_of_measurement="km", metres_per_unit=1000)
+        Distance.objects.create(date="2023-09-15", person=self.person, distance=2, unit=unit)
+        Distance.objects.create(date="2023-10-15", person=self.person, distance=3.5, unit=unit)
+
+    def test_csv_export_streams_joined_rows(self):
+        response = self.client.get(reverse('distance_export'), {'format': 'csv'})
+
+        self.assertTrue(response.streaming)
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0].split(",")[:4], ["id", "date", "person_id", "person_email"])
+        self.assertEqual(len(lines), 3)
+        self.assertIn("seymour@example.com,Seymour,Skinner,Capital City,USA,3.50,km,3500.00", lines[2])
+
+    def test_json_export_filters_by_date(self):
+        response = self.client.get(reverse('distance_export'), {'format': 'json', 'date_from': '2023-10-01'})
+
+        rows = [json.loads(line) for line in b"".join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([row['date'] for row in rows], ["2023-10-15"])
+        self.assertEqual(rows[0]['normalized_distance'], "3500.00")
+
+    def test_export_can_be_imported(self):
+        stdout = StringIO()
+        call_command('export_distances', stdout=stdout)
+        Distance.objects.all().delete()
+
+        result = import_distances(read_rows(StringIO(stdout.getvalue()), 'csv'))
+        self.assertEqual(result.created, 2)
+        self.assertEqual(result.errors, [])
+
+
+@skipUnless(connection.vendor == 'sqlite', "Query plans are checked on SQLite")
+class QueryPlanTestCase(TestCase):
+    def setUp(self):
+
+        self.office = Office.objects.create(city="Ogdenville", country="USA")
+        self.person = Person.objects.create(
+            first_name="Otto", last_name="Mann", email="otto@example.com", location=self.office
+        )
+        self.unit = Unit.objects.create(unit_of_measurement="km", metres_per_unit=1000)
+        Distance.objects.create(date="2023-09-15", person=self.person, distance=1, unit=self.unit)
+
+    def assertUsesIndex(self, queryset, index):
+        plan = queryset.explain()
+        self.assertIn(index, plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+
+    def test_feed_is_read_in_index_order(self):
+        self.assertUsesIndex(Distance.objects.order_by('-date', '-id')[:50], "distance_date_id_idx")
+
+    def test_feed_page_seeks_with_index(self):
+        page = Distance.objects.filter(date__lt="2023-09-15").order_by('-date', '-id')[:50]
+        self.assertUsesIndex(page, "distance_date_id_idx")
+
+    def test_person_history_uses_person_date_index(self):
+        history = Distance.objects.filter(person=self.person, date__gte="2023-01-01").order_by('date')
+        self.assertUsesIndex(history, "distance_person_date_idx")
+
+    def test_unit_lookup_uses_index(self):
+        self.assertNotIn("SCAN distance_distance", Distance.objects.filter(unit=self.unit).explain())
+
+    def test_office_members_use_location_index(self):
+        members = Person.objects.filter(location=self.office).order_by('last_name', 'first_name')
+        self.assertUsesIndex(members, "person_location_name_idx")
+
+    def test_office_member_page_uses_location_index(self):
+        members = Person.objects.filter(location=self.office).select_related('rollup').order_by('last_name', 'first_name', 'id')[:50]
+        self.assertUsesIndex(members, "person_location_name_idx")
+
+    def test_duplicates_are_read_in_fingerprint_index_order(self):
+        rows = Distance.objects.order_by('fingerprint', 'id').values_list('id', 'fingerprint')
+        self.assertUsesIndex(rows, "distance_fingerprint_idx")
+
+
+@skipUnless(connection.vendor == 'sqlite', "Pragmas only apply to SQLite")
+class SQLitePragmaTestCase(TestCase):
+    def cache_size(self):
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA cache_size")
+            return cursor.fetchone()[0]
+
+    @override_settings(SQLITE_PRAGMAS={'cache_size': -12345, 'busy_timeout': 1000})
+    def test_pragmas_are_applied_to_new_connections(self):
+        original = self.cache_size()
+        self.addCleanup(lambda: connection.cursor().execute(f"PRAGMA cache_size = {original}"))
+
+        configure_sqlite(sender=connection.__class__, connection=connection)
+        self.assertEqual(self.cache_size(), -12345)
+
+    @override_settings(SQLITE_PRAGMAS={})
+    def test_development_profile_leaves_defaults(self):
+        original = self.cache_size()
+        configure_sqlite(sender=connection.__class__, connection=connection)
+        self.assertEqual(self.cache_size(), original)
+
+
+@override_settings(DISTANCE_QUERY_STATS=True)
+class QueryStatsMiddlewareTestCase(TestCase):
+    def setUp(self):
+
+        reset_stats()
+        self.addCleanup(reset_stats)
+        self.user = User.objects.create_user(username='admin', password='password', is_superuser=True)
+        self.client.force_login(self.user)
+        Office.objects.create(city="Brockway", country="USA")
+
+    def test_server_timing_header_and_stats(self):
+        response = self.client.get(reverse('offices'))
+
+        self.assertRegex(response['Server-Timing'], r'db;dur=[\d.]+;desc="\d+ queries", render;dur=[\d.]+, total;dur=[\d.]+')
+        stats = get_stats()['offices']
+        self.assertEqual(stats.requests, 1)
+        self.assertGreater(stats.queries, 0)
+        self.assertGreater(stats.render_ms, 0)
+        self.assertEqual(stats.bytes, len(response.content))
+        self.assertEqual(sum(stats.histogram), 1)
+
+    @override_settings(DISTANCE_QUERY_BUDGET=2)
+    def test_requests_over_budget_are_logged(self):
+        with self.assertLogs('distance.middleware', level='WARNING') as logs:
+            self.client.get(reverse('offices'))
+        self.assertIn("over the budget of 2", logs.output[0])
+
+    def test_stats_page_is_for_superusers_only(self):
+        self.client.get(reverse('offices'))
+        response = self.client.get(reverse('query_stats'))
+        self.assertContains(response, "offices")
+
+        User.objects.create_user(username='user', password='password')
+        self.client.login(username='user', password='password')
+        self.assertEqual(self.client.get(reverse('query_stats')).status_code, 302)
+
+
+class GenerateDataTestCase(TestCase):
+    def test_generates_requested_rows_with_consistent_rollups(self):
+        call_command('generate_data', offices=3, people=20, distances=500, batch_size=100, stdout=StringIO())
+
+        self.assertEqual(Office.objects.count(), 3)
+        self.assertEqual(Person.objects.count(), 20)
+        self.assertEqual(Distance.objects.count(), 500)
+        self.assertFalse(Distance.objects.filter(normalized_distance=0).exists())
+        self.assertEqual(rollups.verify(), [])
+
+
+class PersonLookupTestCase(TestCase):
+    def setUp(self):
+
+        self.user = User.objects.create_user(username='user', password='password')
+        self.client.force_login(self.user)
+
+        office = Office.objects.create(city="North Haverbrook", country="USA")
+        for n in range(30):
+            Person.objects.create(first_name=f"Person{n}", last_name="Lovejoy", email=f"p{n}@example.com", location=office)
+        self.helen = Person.objects.create(
+            first_name="Helen", last_name="Lovejoy", email="helen@example.com", location=office
+        )
+        self.unit = Unit.objects.create(unit_of_measurement="km", metres_per_unit=1000)
+
+    def test_log_form_does_not_list_every_person(self):
+        response = self.client.get(reverse('log'))
+
+        self.assertNotContains(response, "p29@example.com")
+        self.assertContains(response, reverse('person_lookup'))
+
+    def test_lookup_matches_name_and_email_prefixes(self):
+        results = self.client.get(reverse('person_lookup'), {'q': 'hel'}).json()['results']
+        self.assertEqual(results, [{'id': self.helen.id, 'label': "Helen Lovejoy (helen@example.com)"}])
+
+        results = self.client.get(reverse('person_lookup'), {'q': 'lovejoy'}).json()['results']
+        self.assertEqual(len(results), 10)
+
+    def test_submitted_id_is_resolved_without_loading_everyone(self):
+        data = {'date': '2023-09-15', 'person': self.helen.id, 'distance': '3', 'unit': self.unit.id}
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('log'), data)
+
+        self.assertRedirects(response, reverse('index'))
+        person_queries = [q['sql'] for q in queries if q['sql'].startswith('SELECT') and 'FROM "distance_person"' in q['sql']]
+        self.assertTrue(all('WHERE' in sql for sql in person_queries))
+
+    def test_unknown_person_is_rejected(self):
+        data = {'date': '2023-09-15', 'person': 999999, 'distance': '3', 'unit': self.unit.id}
+        response = self.client.post(reverse('log'), data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "Select a valid choice")
+
+    def test_edit_form_shows_current_person(self):
+        distance = Distance.objects.create(date='2023-09-15', person=self.helen, distance=1, unit=self.unit)
+        response = self.client.get(reverse('distance_edit', args=[distance.id]))
+        self.assertContains(response, 'value="Helen Lovejoy (helen@example.com)"')
+
+
+class PeopleSearchTestCase(TestCase):
+    def setUp(self):
+
+        self.user = User.objects.create_user(username='user', password='password')
+        self.client.force_login(self.user)
+
+        self.office = Office.objects.create(city="Springfield", country="USA")
+        self.moe = Person.objects.create(
+            first_name="Moe", last_name="Szyslak", email="moe@tavern.com", location=self.office
+        )
+        self.barney = Person.objects.create(
+            first_name="Barney", last_name="Gumble", email="barney@tavern.com", location=self.office
+        )
+        self.carl = Person.objects.create(
+            first_name="Carl", last_name="Carlson", email="carl@plant.com", location=self.office
+        )
+
+    def search(self, query, **params):
+        return self.client.get(reverse('people_search'), {'q': query, **params}).json()
+
+    def test_prefix_search_on_each_field(self):
+        self.assertEqual([p['id'] for p in self.search('szy')['results']], [self.moe.id])
+        self.assertEqual([p['id'] for p in self.search('barn')['results']], [self.barney.id])
+        self.assertEqual({p['id'] for p in self.search('tavern')['results']}, {self.moe.id, self.barney.id})
+        self.assertEqual(len(self.search('springf')['results']), 3)
+
+    def test_every_word_must_match_and_results_are_ranked(self):
+        self.assertEqual([p['id'] for p in self.search('moe tav')['results']], [self.moe.id])
+        # Carl matches "carl" in his first name, last name and email, so ranks first
+        lenny = Person.objects.create(first_name="Lenny", last_name="Carlsen", email="lenny@plant.com", location=self.office)
+        self.assertEqual([p['id'] for p in self.search('carl')['results']], [self.carl.id, lenny.id])
+
+    def test_results_are_paginated(self):
+        first = self.search('springfield', page_size=2)
+        second = self.search('springfield', page_size=2, page=2)
+
+        self.assertTrue(first['has_next'])
+        self.assertFalse(second['has_next'])
+        ids = [p['id'] for p in first['results'] + second['results']]
+        self.assertEqual(sorted(ids), sorted([self.moe.id, self.barney.id, self.carl.id]))
+
+    def test_page_past_the_end_shows_the_last_page(self):
+        for page in ('5', '9' * 30):
+            response = self.search('springfield', page_size=2, page=page)
+            self.assertEqual((response['page'], len(response['results'])), (2, 1))
+
+        people = self.client.get(reverse('people'), {'q': 'gumble', 'page': '9' * 30})
+        self.assertContains(people, "barney@tavern.com")
+
+    def test_index_follows_person_and_office_changes(self):
+        self.moe.last_name = "Syzslak"
+        self.moe.save()
+        self.assertEqual(self.search('szys')['results'], [])
+        self.assertEqual(len(self.search('syzs')['results']), 1)
+
+        self.office.city = "Shelbyville"
+        self.office.save()
+        self.assertEqual(len(self.search('shelby')['results']), 3)
+
+        self.barney.delete()
+        self.assertEqual(self.search('barney')['results'], [])
+
+    def test_people_page_shows_search_results(self):
+        response = self.client.get(reverse('people'), {'q': 'gumble'})
+        self.assertContains(response, "barney@tavern.com")
+        self.assertNotContains(response, "moe@tavern.com")
+
+
+class FragmentCacheTestCase(TestCase):
+    def setUp(self):
+        # Rolled back rows can reuse ids, so start every test with an empty cache
+        cache.clear()
+        caching.reset_counts()
+        self.addCleanup(caching.reset_counts)
+        self.user = User.objects.create_user(username='admin', password='password', is_staff=True, is_superuser=True)
+        self.client.force_login(self.user)
+        self.office = Office.objects.create(city="Scranton", country="USA")
+        self.person = Person.objects.create(first_name="Dwight", last_name="Schrute", email="dwight@dundermifflin.com", location=self.office)
+
+    def test_second_request_is_served_from_the_cache(self):
+        self.client.get(reverse('offices'))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('offices'))
+
+        self.assertContains(response, "Scranton")
+        # Only the session and user are loaded, the offices table isn't queried
+        self.assertFalse(any('distance_office' in query['sql'] for query in queries))
+        self.assertEqual(caching.get_counts()['offices'], (1, 1))
+
+    def test_edit_view_invalidates_list_and_detail(self):
+        self.client.get(reverse('people'))
+        self.client.get(reverse('person', args=[self.person.id]))
+
+        self.client.post(reverse('person_edit', args=[self.person.id]), {
+            'first_name': 'Dwight', 'last_name': 'Schrute', 'email': 'dwight@schrutefarms.com', 'location': self.office.id,
+        })
+
+        self.assertContains(self.client.get(reverse('people')), "dwight@schrutefarms.com")
+        self.assertContains(self.client.get(reverse('person', args=[self.person.id])), "dwight@schrutefarms.com")
+
+    def test_office_rename_invalidates_people(self):
+        self.client.get(reverse('person', args=[self.person.id]))
+        self.client.post(reverse('office_edit', args=[self.office.id]), {'city': 'Stamford', 'country': 'USA'})
+
+        response = self.client.get(reverse('person', args=[self.person.id]))
+        self.assertContains(response, "Stamford")
+
+    def test_admin_save_and_delete_invalidate(self):
+        unit = Unit.objects.create(unit_of_measurement="beets")
+        self.client.get(reverse('units'))
+
+        self.client.post(reverse('admin:distance_unit_change', args=[unit.id]), {
+            'unit_of_measurement': 'bears', 'metres_per_unit': '1',
+        })
+        self.assertContains(self.client.get(reverse('units')), "bears")
+
+        self.client.post(reverse('admin:distance_unit_delete', args=[unit.id]), {'post': 'yes'})
+        # The admin's success message still names it
+        self.assertNotContains(self.client.get(reverse('units')), "bears</a>")
+        self.assertEqual(self.client.get(reverse('unit', args=[unit.id])).status_code, 404)
+
+    def test_bulk_log_invalidates_distance_fragments(self):
+        before = caching.versions(Distance)
+        unit = Unit.objects.create(unit_of_measurement="km", metres_per_unit=1000)
+        Distance.objects.bulk_log([Distance(date="2023-10-01", person=self.person, distance=5, unit=unit)])
+        self.assertNotEqual(caching.versions(Distance), before)
+
+    def test_evicted_version_counter_does_not_return_to_an_old_version(self):
+        seen = caching.versions(Person)
+        caching.bump(Person)
+        seen += caching.versions(Person)
+        cache.delete(caching._version_key(Person))
+        self.assertNotIn(caching.versions(Person)[0], seen)
+
+    def test_user_specific_parts_are_not_cached(self):
+        self.client.get(reverse('office', args=[self.office.id]))
+        self.assertContains(self.client.get(reverse('office', args=[self.office.id])), "Delete")
+
+        User.objects.create_user(username='user', password='password')
+        self.client.login(username='user', password='password')
+        response = self.client.get(reverse('office', args=[self.office.id]))
+        self.assertContains(response, "Scranton")
+        self.assertNotContains(response, "Delete")
+        self.assertEqual(caching.get_counts()['office'], (2, 1))
+
+    def test_counts_are_shown_on_the_stats_page(self):
+        self.client.get(reverse('units'))
+        self.client.get(reverse('units'))
+        self.assertContains(self.client.get(reverse('query_stats')), "<th scope=\"row\">units</th>", html=False)
+
+
+class APITestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='bot', password='password')
+        self.client.force_login(self.user)
+        self.office = Office.objects.create(city="Pawnee", country="USA")
+        self.other_office = Office.objects.create(city="Eagleton", country="USA")
+        self.leslie = Person.objects.create(first_name="Leslie", last_name="Knope", email="leslie@pawnee.gov", location=self.office)
+        self.ron = Person.objects.create(first_name="Ron", last_name="Swanson", email="ron@pawnee.gov", location=self.other_office)
+        self.km = Unit.objects.create(unit_of_measurement="km", metres_per_unit=1000)
+        for day in range(1, 6):
+            Distance.objects.create(date=f"2023-10-0{day}", person=self.leslie, distance=day, unit=self.km)
+        Distance.objects.create(date="2023-10-03", person=self.ron, distance=10, unit=self.km)
+
+    def get(self, name, params=None, args=None, **headers):
+        return self.client.get(reverse(name, args=args), params or {}, **headers)
+
+    def test_lists_distances_newest_first(self):
+        data = self.get('api_distances').json()
+        self.assertEqual([row['date'] for row in data['results']][:2], ['2023-10-05', '2023-10-04'])
+        first = data['results'][0]
+        self.assertEqual(first['person'], self.leslie.id)
+        self.assertEqual(first['office'], self.office.id)
+        self.assertEqual(first['unit_name'], 'km')
+        self.assertEqual(first['normalized_distance'], '5000.00')
+        self.assertIsNone(data['next'])
+
+    def test_field_selection(self):
+        data = self.get('api_distances', {'fields': 'id,distance'}).json()
+        self.assertEqual(set(data['results'][0]), {'id', 'distance'})
+
+        response = self.get('api_distances', {'fields': 'id,salary'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("salary", response.json()['error'])
+
+    def test_filters(self):
+        by_date = self.get('api_distances', {'date_from': '2023-10-02', 'date_to': '2023-10-03'}).json()
+        self.assertEqual(len(by_date['results']), 3)
+        by_person = self.get('api_distances', {'person': self.ron.id}).json()
+        self.assertEqual([row['distance'] for row in by_person['results']], ['10.00'])
+        by_office = self.get('api_distances', {'office': self.office.id}).json()
+        self.assertEqual(len(by_office['results']), 5)
+        people = self.get('api_people', {'office': self.other_office.id}).json()
+        self.assertEqual([row['email'] for row in people['results']], ['ron@pawnee.gov'])
+
+        self.assertEqual(self.get('api_distances', {'date_from': 'yesterday'}).status_code, 400)
+        self.assertEqual(self.get('api_distances', {'person': 'ron'}).status_code, 400)
+
+    def test_keyset_pagination(self):
+        first = self.get('api_distances', {'page_size': 4}).json()
+        second = self.get('api_distances', {'page_size': 4, 'after': first['next']}).json()
+        self.assertEqual(len(first['results']) + len(second['results']), 6)
+        self.assertIsNone(second['next'])
+        back = self.get('api_distances', {'page_size': 4, 'before': second['previous']}).json()
+        self.assertEqual(back['results'], first['results'])
+
+        self.assertEqual(self.get('api_distances', {'after': 'nonsense'}).status_code, 400)
+
+    def test_details(self):
+        data = self.get('api_unit', args=[self.km.id]).json()
+        self.assertEqual(data, {'id': self.km.id, 'unit_of_measurement': 'km', 'metres_per_unit': '1000.0000', 'is_steps': False})
+        data = self.get('api_person', {'fields': 'email'}, args=[self.ron.id]).json()
+        self.assertEqual(data, {'email': 'ron@pawnee.gov'})
+        self.assertEqual(self.get('api_office', args=[999]).status_code, 404)
+
+    def test_ids_too_large_for_the_database(self):
+        huge = '9' * 23
+        self.assertEqual(self.get('api_distances', {'person': huge}).status_code, 400)
+        self.assertEqual(self.get('api_people', {'office': huge}).status_code, 400)
+        self.assertEqual(self.get('api_distance', args=[int(huge)]).status_code, 404)
+
+    def test_conditional_get(self):
+        response = self.get('api_offices')
+        etag = response['ETag']
+
+        with CaptureQueriesContext(connection) as queries:
+            cached = self.get('api_offices', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(cached.status_code, 304)
+        self.assertFalse(any('distance_office' in query['sql'] for query in queries))
+
+        self.office.city = "Pawnee City"
+        self.office.save()
+        changed = self.get('api_offices', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed['ETag'], etag)
+
+    def test_distance_etag_follows_new_distances(self):
+        etag = self.get('api_distances')['ETag']
+        Distance.objects.create(date="2023-10-06", person=self.ron, distance=3, unit=self.km)
+        self.assertEqual(self.get('api_distances', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_authentication(self):
+        self.client.logout()
+        response = self.get('api_units')
+        self.assertEqual(response.status_code, 401)
+        self.assertIn('Basic', response['WWW-Authenticate'])
+
+        credentials = base64.b64encode(b'bot:password').decode()
+        response = self.get('api_units', HTTP_AUTHORIZATION=f'Basic {credentials}')
+        self.assertEqual(response.status_code, 200)
+
+    def test_read_only(self):
+        self.assertEqual(self.client.post(reverse('api_units')).status_code, 405)
+
+
+class AsyncViewTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='async', password='password', email='april@pawnee.gov')
+        self.client.force_login(self.user)
+        self.office = Office.objects.create(city="Pawnee", country="USA")
+        self.april = Person.objects.create(first_name="April", last_name="Ludgate", email="april@pawnee.gov", location=self.office)
+        self.unit = Unit.objects.create(unit_of_measurement="km", metres_per_unit=1000)
+        self.distance = Distance.objects.create(date="2023-10-01", person=self.april, distance=4, unit=self.unit)
+
+    def assertSamePage(self, name, async_name, args=None, params=None):
+        sync = self.client.get(reverse(name, args=args), params or {})
+        asynchronous = self.client.get(reverse(async_name, args=args), params or {})
+        self.assertEqual(asynchronous.status_code, 200)
+        self.assertEqual(asynchronous.content, sync.content)
+
+    def test_async_views_match_the_sync_views(self):
+        self.assertSamePage('index', 'async_index')
+        self.assertSamePage('distance', 'async_distance', args=[self.distance.id])
+        self.assertSamePage('people', 'async_people')
+        self.assertSamePage('people', 'async_people', params={'q': 'april'})
+        self.assertSamePage('person', 'async_person', args=[self.april.id])
+        self.assertSamePage('leaderboard', 'async_leaderboard', args=['people'])
+
+    async def test_served_by_the_asgi_handler(self):
+        client = AsyncClient()
+        await sync_to_async(client.force_login)(self.user)
+        response = await client.get(reverse('async_person', args=[self.april.id]))
+        self.assertContains(response, "Ludgate")
+
+    def test_index_pages_with_cursors(self):
+        for day in range(2, 5):
+            Distance.objects.create(date=f"2023-10-0{day}", person=self.april, distance=day, unit=self.unit)
+        first = self.client.get(reverse('async_index'), {'page_size': 2})
+        second = self.client.get(reverse('async_index'), {'page_size': 2, 'after': first.context['distances'].next_cursor})
+        self.assertEqual([d.date.day for d in second.context['distances']], [2, 1])
+
+        broken = self.client.get(reverse('async_index'), {'page_size': 2, 'after': encode_cursor(["garbage", 1])})
+        self.assertEqual([d.date.day for d in broken.context['distances']], [4, 3])
+
+    def test_login_required_and_missing_records(self):
+        self.assertEqual(self.client.get(reverse('async_distance', args=[999])).status_code, 404)
+        self.assertEqual(self.client.get(reverse('async_person', args=[999])).status_code, 404)
+        self.assertEqual(self.client.get(reverse('async_leaderboard', args=['pets'])).status_code, 404)
+        response = self.client.get(reverse('async_leaderboard', args=['people']), {'period': 'week', 'date': '9999-12-31'})
+        self.assertEqual(response.status_code, 200)
+
+        self.client.logout()
+        response = self.client.get(reverse('async_people'))
+        self.assertRedirects(response, f"{settings.LOGIN_URL}?next={reverse('async_people')}", fetch_redirect_response=False)
+
+
+class BatchLogTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='tom', password='password')
+        self.client.force_login(self.user)
+        office = Office.objects.create(city="Pawnee", country="USA")
+        self.person = Person.objects.create(first_name="Tom", last_name="Haverford", email="tom@pawnee.gov", location=office)
+        self.km = Unit.objects.create(unit_of_measurement="km", metres_per_unit=1000)
+        self.miles = Unit.objects.create(unit_of_measurement="miles", metres_per_unit="1609.344")
+
+    def post(self, entries, person=None, total=7):
+        data = {
+            'person': person or self.person.id,
+            'form-TOTAL_FORMS': total,
+            'form-INITIAL_FORMS': 0,
+            'form-MIN_NUM_FORMS': 1,
+            'form-MAX_NUM_FORMS': 31,
+        }
+        for n, (date, distance, unit) in enumerate(entries):
+            data.update({f'form-{n}-date': date, f'form-{n}-distance': distance, f'form-{n}-unit': unit})
+        return self.client.post(reverse('log_batch'), data)
+
+    def test_get_renders_a_week_of_rows(self):
+        response = self.client.get(reverse('log_batch'))
+        self.assertEqual(len(response.context['formset'].forms), 7)
+
+    def test_logs_every_filled_row_for_the_person(self):
+        week = [(f"2023-10-0{day}", day, self.km.id) for day in range(1, 6)] + [("2023-10-06", 2, self.miles.id)]
+        response = self.post(week)
+
+        self.assertRedirects(response, reverse('index'))
+        self.assertEqual(Distance.objects.filter(person=self.person).count(), 6)
+        self.assertEqual(PersonTotal.objects.get(person=self.person).total, Decimal("18218.69"))
+        self.assertEqual(DailyTotal.objects.filter(person=self.person).count(), 6)
+
+    def test_entries_are_validated_together(self):
+        response = self.post([("2023-10-01", 5, self.km.id), ("2023-10-32", 5, self.km.id), ("2023-10-03", 5, 999)])
+
+        self.assertEqual(response.status_code, 200)
+        errors = response.context['formset'].errors
+        self.assertIn('date', errors[1])
+        self.assertIn('unit', errors[2])
+        # Nothing is saved unless every entry is valid
+        self.assertFalse(Distance.objects.exists())
+
+    def test_needs_a_person_and_an_entry(self):
+        self.assertEqual(self.post([("2023-10-01", 5, self.km.id)], person=999).status_code, 200)
+        response = self.post([])
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(Distance.objects.exists())
+
+    def test_lookups_and_insert_are_not_per_row(self):
+        entries = [(f"2023-10-{day:02d}", day, self.km.id) for day in range(1, 15)]
+        with CaptureQueriesContext(connection) as queries:
+            self.post(entries, total=14)
+
+        sql = [query['sql'] for query in queries]
+        self.assertEqual(len([q for q in sql if q.startswith('SELECT') and 'FROM "distance_unit"' in q]), 1)
+        self.assertEqual(len([q for q in sql if 'WHERE "distance_person"."id" = ' in q]), 1)
+        self.assertEqual(len([q for q in sql if q.startswith('INSERT INTO "distance_distance"')]), 1)
+
+
+class SeriesTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='ann', password='password')
+        self.client.force_login(self.user)
+        self.pawnee = Office.objects.create(city="Pawnee", country="USA")
+        self.eagleton = Office.objects.create(city="Eagleton", country="USA")
+        self.ann = Person.objects.create(first_name="Ann", last_name="Perkins", email="ann@pawnee.gov", location=self.pawnee)
+        self.craig = Person.objects.create(first_name="Craig", last_name="Middlebrooks", email="craig@eagleton.gov", location=self.eagleton)
+        self.km = Unit.objects.create(unit_of_measurement="km", metres_per_unit=1000)
+        # Monday 2 October to Tuesday 10 October 2023
+        self.log(self.ann, "2023-10-02", 1)
+        self.log(self.ann, "2023-10-04", 2)
+        self.log(self.craig, "2023-10-04", 3)
+        self.log(self.craig, "2023-10-10", 4)
+
+    def log(self, person, date, km):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Distance.objects.create(date=date, person=person, distance=km, unit=self.km)
+
+    def test_daily_series_includes_empty_days(self):
+        rows = series.series('day', datetime.date(2023, 10, 2), datetime.date(2023, 10, 5))
+        self.assertEqual([(start.day, total) for start, _, total in rows], [(2, 1000), (3, 0), (4, 5000), (5, 0)])
+
+    def test_weekly_and_monthly_buckets(self):
+        weeks = series.series('week', datetime.date(2023, 10, 4), datetime.date(2023, 10, 10))
+        self.assertEqual([(start, total) for start, _, total in weeks],
+                         [(datetime.date(2023, 10, 2), 6000), (datetime.date(2023, 10, 9), 4000)])
+        months = series.series('month', datetime.date(2023, 9, 15), datetime.date(2023, 10, 15))
+        self.assertEqual([total for _, _, total in months], [0, 10000])
+
+    def test_grouped_by_person_and_office(self):
+        people = series.series('week', datetime.date(2023, 10, 2), datetime.date(2023, 10, 2), group='person')
+        self.assertEqual([(pk, total) for _, pk, total in people], [(self.ann.id, 3000), (self.craig.id, 3000)])
+        offices = series.series('month', datetime.date(2023, 10, 1), datetime.date(2023, 10, 1), group='office')
+        self.assertEqual([(pk, total) for _, pk, total in offices], [(self.pawnee.id, 3000), (self.eagleton.id, 7000)])
+
+    def test_cached_buckets_are_not_recomputed(self):
+        date_from, date_to = datetime.date(2023, 10, 1), datetime.date(2023, 10, 31)
+        series.series('day', date_from, date_to)
+        with CaptureQueriesContext(connection) as queries:
+            series.series('day', date_from, date_to)
+        self.assertEqual(len(queries), 0)
+
+    def test_writes_only_recompute_their_buckets(self):
+        date_from, date_to = datetime.date(2023, 10, 1), datetime.date(2023, 10, 31)
+        series.series('day', date_from, date_to)
+        self.log(self.ann, "2023-10-20", 5)
+
+        with CaptureQueriesContext(connection) as queries:
+            rows = series.series('day', date_from, date_to)
+        self.assertEqual(len(queries), 1)
+        self.assertIn("'2023-10-20'", queries[0]['sql'].replace('"', "'"))
+        self.assertNotIn("'2023-10-01'", queries[0]['sql'].replace('"', "'"))
+        self.assertEqual(dict((start.day, total) for start, _, total in rows)[20], 5000)
+
+    def test_moves_and_rebuilds_invalidate(self):
+        october = datetime.date(2023, 10, 1)
+        series.series('month', october, october, group='office')
+        self.craig.location = self.pawnee
+        with self.captureOnCommitCallbacks(execute=True):
+            self.craig.save()
+        offices = series.series('month', october, october, group='office')
+        self.assertEqual([(pk, total) for _, pk, total in offices], [(self.pawnee.id, 10000)])
+
+        self.km.metres_per_unit = 500
+        self.km.save()
+        jobs.enqueue('rebuild_rollups', {'normalize': True})
+        jobs.work('test', burst=True)
+        self.assertEqual(series.series('month', october, october)[0][2], 5000)
+
+    def test_rejects_bad_parameters(self):
+        october = datetime.date(2023, 10, 1)
+        with self.assertRaises(ValueError):
+            series.series('fortnight', october, october)
+        with self.assertRaises(ValueError):
+            series.series('day', october, october, group='unit')
+        with self.assertRaises(ValueError):
+            series.series('day', datetime.date(2020, 1, 1), october)
+
+    def test_api(self):
+        data = self.client.get(reverse('api_series'), {
+            'interval': 'week', 'group': 'office', 'date_from': '2023-10-01', 'date_to': '2023-10-10',
+        }).json()
+        self.assertEqual(data['interval'], 'week')
+        self.assertEqual([(row['bucket'], row['office'], row['total']) for row in data['results']], [
+            ('2023-10-02', self.pawnee.id, '3000.00'),
+            ('2023-10-02', self.eagleton.id, '3000.00'),
+            ('2023-10-09', self.eagleton.id, '4000.00'),
+        ])
+
+        default = self.client.get(reverse('api_series')).json()
+        self.assertEqual(len(default['results']), 30)
+        self.assertEqual(self.client.get(reverse('api_series'), {'interval': 'year'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('api_series'), {'date_from': 'last week'}).status_code, 400)
+
+    def test_api_rejects_ranges_past_the_supported_dates(self):
+        for params in [
+            {'interval': 'month', 'date_to': '9999-12-31'},
+            {'interval': 'day', 'date_from': '9999-12-30', 'date_to': '9999-12-31'},
+            {'interval': 'day', 'date_from': '0001-01-01', 'date_to': '9999-12-30'},
+            {'date_to': '0001-01-05'},
+        ]:
+            self.assertEqual(self.client.get(reverse('api_series'), params).status_code, 400, params)
+
+
+class ChallengeTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='chris', password='password')
+        self.client.force_login(self.user)
+        office = Office.objects.create(city="Pawnee", country="USA")
+        self.chris = Person.objects.create(first_name="Chris", last_name="Traeger", email="chris@pawnee.gov", location=office)
+        self.km = Unit.objects.create(unit_of_measurement="km", metres_per_unit=1000)
+        # Logged before the challenge is set up, and outside its dates
+        Distance.objects.create(date="2023-01-10", person=self.chris, distance=10, unit=self.km)
+        Distance.objects.create(date="2022-12-31", person=self.chris, distance=50, unit=self.km)
+        self.challenge = Challenge.objects.create(
+            year=2023, target=100, unit=self.km, start_date=datetime.date(2023, 1, 1), end_date=datetime.date(2023, 12, 31)
+        )
+
+    def test_new_challenge_counts_distances_already_logged(self):
+        self.assertEqual(self.challenge.total, Decimal("10000"))
+
+    def test_total_follows_writes_between_the_dates(self):
+        distance = Distance.objects.create(date="2023-01-20", person=self.chris, distance=15, unit=self.km)
+        Distance.objects.bulk_log([Distance(date="2024-01-01", person=self.chris, distance=99, unit=self.km)])
+        self.challenge.refresh_from_db()
+        self.assertEqual(self.challenge.total, Decimal("25000"))
+
+        distance.date = "2024-02-01"
+        distance.save()
+        self.challenge.refresh_from_db()
+        self.assertEqual(self.challenge.total, Decimal("10000"))
+
+        self.assertEqual(rollups.verify(), [])
+
+    def test_changing_dates_recounts(self):
+        self.challenge.start_date = datetime.date(2022, 12, 1)
+        self.challenge.save()
+        self.assertEqual(self.challenge.total, Decimal("60000"))
+
+    def test_rebuild_restores_the_total(self):
+        Challenge.objects.update(total=0)
+        self.assertEqual(len(rollups.verify()), 1)
+        rollups.rebuild()
+        self.challenge.refresh_from_db()
+        self.assertEqual(self.challenge.total, Decimal("10000"))
+
+    def test_progress_and_projection(self):
+        self.assertEqual(self.challenge.total_in_unit, Decimal("10"))
+        self.assertEqual(self.challenge.percentage, Decimal("10"))
+        # 10km in the first 10 days, so the other 90km takes another 90 days
+        self.assertEqual(self.challenge.projected_completion(datetime.date(2023, 1, 10)), datetime.date(2023, 4, 10))
+        self.assertIsNone(self.challenge.projected_completion(datetime.date(2022, 12, 1)))
+
+        self.challenge.target = 5
+        self.assertEqual(self.challenge.percentage, Decimal("100"))
+        self.assertIsNone(self.challenge.projected_completion(datetime.date(2023, 1, 10)))
+
+    def test_widget_is_on_every_page(self):
+        response = self.client.get(reverse('offices'))
+        self.assertContains(response, "2023 challenge")
+        self.assertContains(response, "10 of 100 km (10.0%)")
+
+    def test_widget_is_a_single_query(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('units'))
+        challenge_queries = [query['sql'] for query in queries if 'distance_challenge' in query['sql']]
+        self.assertEqual(len(challenge_queries), 1)
+        self.assertNotIn('distance_distance', challenge_queries[0])
+
+    def test_challenges_page_and_forms(self):
+        response = self.client.get(reverse('challenges'))
+        self.assertContains(response, "100 km")
+
+        response = self.client.post(reverse('challenge_create'), {
+            'year': 2024, 'target': 200, 'unit': self.km.id, 'start_date': '2024-01-01', 'end_date': '2023-12-31',
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(Challenge.objects.filter(year=2024).exists())
+
+        response = self.client.post(reverse('challenge_edit', args=[self.challenge.id]), {
+            'year': 2023, 'target': 150, 'unit': self.km.id, 'start_date': '2023-01-01', 'end_date': '2023-12-31',
+        })
+        self.assertRedirects(response, reverse('challenges'))
+        self.challenge.refresh_from_db()
+        self.assertEqual(self.challenge.target, 150)
+
+
+class JobQueueTestCase(TestCase):
+    def setUp(self):
+
+        self.user = User.objects.create_user(username='user', password='password')
+        self.client.login(username='user', password='password')
+        self.job_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.job_dir)
+
+        office = Office.objects.create(city="North Haverbrook", country="USA")
+        self.person = Person.objects.create(first_name="Lyle", last_name="Lanley", email="lyle@example.com", location=office)
+        self.unit = Unit.objects.create(unit_of_measurement="km", metres_per_unit=1000)
+        Distance.objects.create(date="2023-09-15", person=self.person, distance=2, unit=self.unit)
+
+        self.attempts = []
+        jobs.TASKS["flaky"] = self.flaky
+        self.addCleanup(jobs.TASKS.pop, "flaky")
+
+    def flaky(self, job, fail_times=0):
+        self.attempts.append(job.attempts)
+        if len(self.attempts) <= fail_times:
+            raise RuntimeError("Monorail derailed")
+        return {"attempts": len(self.attempts)}
+
+    def test_a_job_is_only_claimed_once(self):
+        job = jobs.enqueue("flaky")
+
+        self.assertEqual(jobs.claim("first").id, job.id)
+        self.assertIsNone(jobs.claim("second"))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.worker, job.attempts), (Job.RUNNING, "first", 1))
+
+    def test_failures_are_retried_with_a_delay_until_they_run_out_of_attempts(self):
+        job = jobs.enqueue("flaky", {"fail_times": 5}, max_attempts=2)
+
+        with self.assertLogs("distance.jobs", "ERROR"):
+            jobs.run(jobs.claim("worker"))
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.QUEUED)
+        self.assertIn("Monorail derailed", job.error)
+        self.assertGreater(job.run_after, timezone.now())
+        # Not due again until the delay has passed
+        self.assertEqual(jobs.work("worker", burst=True), 0)
+
+        Job.objects.filter(pk=job.pk).update(run_after=timezone.now())
+        with self.assertLogs("distance.jobs", "ERROR"):
+            self.assertEqual(jobs.work("worker", burst=True), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.FAILED, 2))
+        self.assertEqual(self.attempts, [1, 2])
+
+    def test_a_retry_can_succeed(self):
+        job = jobs.enqueue("flaky", {"fail_times": 1})
+        with self.assertLogs("distance.jobs", "ERROR"):
+            jobs.run(jobs.claim("worker"))
+        Job.objects.filter(pk=job.pk).update(run_after=timezone.now())
+        jobs.work("worker", burst=True)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.SUCCEEDED)
+        self.assertEqual(job.result, {"attempts": 2})
+        self.assertEqual(job.error, "")
+
+    def test_jobs_abandoned_by_a_worker_are_queued_again(self):
+        job = jobs.enqueue("flaky")
+        jobs.claim("gone")
+        Job.objects.filter(pk=job.pk).update(heartbeat_at=timezone.now() - datetime.timedelta(hours=2))
+
+        self.assertEqual(jobs.requeue_stale(timeout=3600), 1)
+        self.assertEqual(Job.objects.get(pk=job.pk).status, Job.QUEUED)
+
+    def test_long_running_jobs_with_a_heartbeat_are_left_alone(self):
+        job = jobs.enqueue("flaky")
+        jobs.claim("busy")
+        Job.objects.filter(pk=job.pk).update(started_at=timezone.now() - datetime.timedelta(hours=2))
+        jobs.report(job, 1, 10)
+
+        self.assertEqual(jobs.requeue_stale(timeout=3600), 0)
+        self.assertEqual(Job.objects.get(pk=job.pk).status, Job.RUNNING)
+
+    def test_old_job_files_are_deleted(self):
+        old = time.time() - 8 * 24 * 3600
+        paths = {}
+        for name in ("export.csv", "upload.csv", "new.csv"):
+            paths[name] = os.path.join(self.job_dir, name)
+            with open(paths[name], "w") as file:
+                file.write("date,email,distance,unit\n")
+        os.utime(paths["export.csv"], (old, old))
+        os.utime(paths["upload.csv"], (old, old))
+        # An import still waiting for a worker keeps its upload
+        jobs.enqueue("import_distances", {"path": paths["upload.csv"]})
+
+        with self.settings(DISTANCE_JOB_DIR=self.job_dir):
+            self.assertEqual(jobs.expire_files(), 1)
+        self.assertEqual(sorted(os.listdir(self.job_dir)), ["new.csv", "upload.csv"])
+
+    def test_background_export_can_be_downloaded(self):
+        with self.settings(DISTANCE_JOB_DIR=self.job_dir):
+            response = self.client.get(reverse('distance_export'), {'format': 'csv', 'background': '1'})
+            job = Job.objects.get(task='export_distances')
+            self.assertRedirects(response, reverse('job', args=[job.id]))
+            call_command('run_jobs', burst=True, stdout=StringIO())
+
+        response = self.client.get(reverse('job', args=[job.id]))
+        self.assertContains(response, "1 distances exported")
+        response = self.client.get(reverse('job_download', args=[job.id]))
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertIn("lyle@example.com", lines[1])
+
+    def test_maintenance_jobs_are_for_superusers(self):
+        response = self.client.post(reverse('job_enqueue', args=['rebuild_rollups']))
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(Job.objects.exists())
+
+        User.objects.create_superuser(username='admin', password='password')
+        self.client.login(username='admin', password='password')
+        response = self.client.post(reverse('job_enqueue', args=['rebuild_rollups']))
+        job = Job.objects.get()
+        self.assertRedirects(response, reverse('job', args=[job.id]))
+
+        PersonTotal.objects.all().delete()
+        jobs.work("worker", burst=True)
+        job.refresh_from_db()
+        self.assertEqual(job.result, {"mismatches": []})
+        self.assertEqual(PersonTotal.objects.get(person=self.person).total, Decimal("2000"))
+
+    def test_jobs_are_only_visible_to_whoever_queued_them(self):
+        job = jobs.enqueue("flaky", user=self.user)
+        User.objects.create_user(username='other', password='password')
+        self.client.login(username='other', password='password')
+
+        self.assertEqual(self.client.get(reverse('job', args=[job.id])).status_code, 404)
+        self.assertNotContains(self.client.get(reverse('jobs')), reverse('job', args=[job.id]))
+
+
+class DuplicateTestCase(TestCase):
+    def setUp(self):
+
+        self.user = User.objects.create_user(username='user', password='password')
+        self.client.login(username='user', password='password')
+
+        office = Office.objects.create(city="Shelbyville", country="USA")
+        self.person = Person.objects.create(first_name="Fat", last_name="Tony", email="tony@example.com", location=office)
+        self.km = Unit.objects.create(unit_of_measurement="km", metres_per_unit=1000)
+        self.distance = Distance.objects.create(date="2023-09-15", person=self.person, distance=5, unit=self.km)
+        self.data = {'date': '2023-09-15', 'person': self.person.id, 'distance': '5.00', 'unit': self.km.id}
+
+    def test_identical_distances_share_a_fingerprint(self):
+        [logged] = Distance.objects.bulk_log([Distance(date=datetime.date(2023, 9, 15), person=self.person, distance=Decimal("5.0"), unit=self.km)])
+        other = Distance.objects.create(date="2023-09-16", person=self.person, distance=5, unit=self.km)
+
+        self.assertEqual(len(self.distance.fingerprint), 40)
+        self.assertEqual(logged.fingerprint, self.distance.fingerprint)
+        self.assertNotEqual(other.fingerprint, self.distance.fingerprint)
+
+    def test_logging_a_duplicate_needs_confirming(self):
+        response = self.client.post(reverse('log'), self.data)
+
+        self.assertContains(response, "already been logged for this person on this date")
+        self.assertContains(response, 'type="checkbox" name="allow_duplicate"')
+        self.assertEqual(Distance.objects.count(), 1)
+
+        response = self.client.post(reverse('log'), {**self.data, 'allow_duplicate': 'on'})
+        self.assertRedirects(response, reverse('index'))
+        self.assertEqual(Distance.objects.count(), 2)
+
+    def test_editing_a_distance_is_not_a_duplicate_of_itself(self):
+        response = self.client.post(reverse('distance_edit', args=[self.distance.id]), {**self.data, 'date': '2023-09-15'})
+        self.assertRedirects(response, reverse('distance', args=[self.distance.id]))
+
+    def test_resubmitting_a_form_logs_it_once(self):
+        key = self.client.get(reverse('log')).context['form'].initial['idempotency_key']
+        data = {**self.data, 'date': '2023-09-20', 'idempotency_key': key}
+
+        self.client.post(reverse('log'), data)
+        response = self.client.post(reverse('log'), {**data, 'allow_duplicate': 'on'}, follow=True)
+
+        self.assertContains(response, "This distance has already been logged")
+        self.assertEqual(Distance.objects.filter(date="2023-09-20").count(), 1)
+
+    def test_idempotency_key_header(self):
+        data = {**self.data, 'date': '2023-09-20'}
+        for _ in range(2):
+            self.client.post(reverse('log_create'), data, HTTP_IDEMPOTENCY_KEY="retry-1")
+        self.assertEqual(Distance.objects.get(date="2023-09-20").idempotency_key, "retry-1")
+
+        response = self.client.post(reverse('log_create'), data, HTTP_IDEMPOTENCY_KEY="x" * 41)
+        self.assertEqual(response.status_code, 400)
+
+    def test_batch_rejects_duplicates(self):
+        data = {
+            'person': self.person.id,
+            'idempotency_key': 'batch-1',
+            'form-TOTAL_FORMS': 3, 'form-INITIAL_FORMS': 0, 'form-MIN_NUM_FORMS': 1, 'form-MAX_NUM_FORMS': 31,
+            'form-0-date': '2023-09-15', 'form-0-distance': '5', 'form-0-unit': self.km.id,
+            'form-1-date': '2023-09-16', 'form-1-distance': '3', 'form-1-unit': self.km.id,
+            'form-2-date': '2023-09-16', 'form-2-distance': '3', 'form-2-unit': self.km.id,
+        }
+        response = self.client.post(reverse('log_batch'), data)
+
+        errors = response.context['formset'].errors
+        self.assertEqual([bool(entry) for entry in errors], [True, False, True])
+        self.assertEqual(Distance.objects.count(), 1)
+
+        self.client.post(reverse('log_batch'), {**data, 'allow_duplicate': 'on'})
+        self.client.post(reverse('log_batch'), {**data, 'allow_duplicate': 'on'})
+        self.assertEqual(Distance.objects.count(), 4)
+        self.assertEqual(rollups.verify(), [])
+
+    def test_reimporting_a_file_skips_every_row(self):
+        rows = [(2, {'date': '2023-09-15', 'person_id': self.person.id, 'distance': '5', 'unit': 'km'}),
+                (3, {'date': '2023-09-16', 'person_id': self.person.id, 'distance': '4', 'unit': 'km'}),
+                (4, {'date': '2023-09-16', 'person_id': self.person.id, 'distance': '4', 'unit': 'km'})]
+
+        result = import_distances(rows)
+        self.assertEqual(result.created, 1)
+        self.assertEqual(result.errors, [(2, "Duplicate of a distance already logged"), (4, "Duplicate of a distance already logged")])
+        self.assertEqual(import_distances(rows).created, 0)
+
+    def test_merge_duplicates_keeps_the_first_of_each(self):
+        copies = [Distance(date=datetime.date(2023, 9, 15), person=self.person, distance=5, unit=self.km) for _ in range(3)]
+        copies.append(Distance(date=datetime.date(2023, 9, 16), person=self.person, distance=2, unit=self.km))
+        copies.append(Distance(date=datetime.date(2023, 9, 16), person=self.person, distance=2, unit=self.km))
+        Distance.objects.bulk_log(copies)
+
+        stdout = StringIO()
+        call_command('merge_duplicates', '--dry-run', stdout=stdout)
+        self.assertIn("4 duplicates of 2 distances would be deleted", stdout.getvalue())
+        self.assertEqual(Distance.objects.count(), 6)
+
+        call_command('merge_duplicates', stdout=StringIO())
+        self.assertEqual(Distance.objects.count(), 2)
+        self.assertTrue(Distance.objects.filter(pk=self.distance.pk).exists())
+        self.assertEqual(PersonTotal.objects.get(person=self.person).total, Decimal("7000"))
+        self.assertEqual(rollups.verify(), [])
+
+
+class PersonStatsTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+
+        self.user = User.objects.create_user(username='user', password='password')
+        self.client.login(username='user', password='password')
+
+        office = Office.objects.create(city="Capital City", country="USA")
+        self.person = Person.objects.create(first_name="Homer", last_name="Simpson", email="homer@example.com", location=office)
+        self.rival = Person.objects.create(first_name="Frank", last_name="Grimes", email="frank@example.com", location=office)
+        self.km = Unit.objects.create(unit_of_measurement="km", metres_per_unit=1000)
+        # Runs of 3, 2 and 1 days, the best day being 2023-10-05
+        for day, distance in [(2, 1), (3, 2), (4, 3), (6, 4), (7, 1), (11, 2)]:
+            Distance.objects.create(date=datetime.date(2023, 10, day), person=self.person, distance=distance, unit=self.km)
+        Distance.objects.create(date=datetime.date(2023, 10, 6), person=self.person, distance=1, unit=self.km)
+        Distance.objects.create(date=datetime.date(2023, 10, 3), person=self.rival, distance=20, unit=self.km)
+
+    def test_totals_streaks_and_best_day(self):
+        stats = person_stats(self.person.id, today=datetime.date(2023, 10, 12))
+
+        self.assertEqual(stats['kilometres'], Decimal("14.00"))
+        self.assertEqual((stats['entries'], stats['days']), (7, 6))
+        self.assertEqual(stats['best_day'], {'date': datetime.date(2023, 10, 6), 'kilometres': Decimal("5.00")})
+        self.assertEqual(stats['longest_streak'], (3, datetime.date(2023, 10, 2), datetime.date(2023, 10, 4)))
+        self.assertEqual(stats['current_streak'], 1)
+        self.assertEqual(person_stats(self.person.id, today=datetime.date(2023, 10, 13))['current_streak'], 0)
+
+    def test_weekly_trend(self):
+        stats = person_stats(self.person.id, today=datetime.date(2023, 10, 12))
+
+        self.assertEqual(len(stats['weeks']), 8)
+        self.assertEqual(stats['weeks'][-2], {'start': datetime.date(2023, 10, 2), 'kilometres': Decimal("12.00"), 'width': 100})
+        self.assertEqual(stats['weeks'][-1], {'start': datetime.date(2023, 10, 9), 'kilometres': Decimal("2.00"), 'width': 16})
+        self.assertEqual(stats['trend'], Decimal("-83"))
+
+    def test_ranks(self):
+        # Leaderboards are refreshed once a write commits, which TestCase never does
+        leaderboards.refresh_all()
+        stats = person_stats(self.person.id, today=datetime.date(2023, 10, 12))
+
+        self.assertEqual(stats['rank'].rank, 2)
+        self.assertEqual(stats['month_rank'].rank, 2)
+        self.assertEqual(stats['office_rank'], (2, 2))
+        self.assertEqual(person_stats(self.rival.id)['office_rank'], (1, 2))
+
+    def test_cached_until_their_distances_change(self):
+        today = datetime.date(2023, 10, 12)
+        person_stats(self.person.id, today=today)
+        # Only the ranks are read again
+        with self.assertNumQueries(3):
+            person_stats(self.person.id, today=today)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Distance.objects.create(date=datetime.date(2023, 10, 12), person=self.person, distance=6, unit=self.km)
+        stats = person_stats(self.person.id, today=today)
+        self.assertEqual(stats['kilometres'], Decimal("20.00"))
+        self.assertEqual(stats['current_streak'], 2)
+
+        # Someone else logging doesn't discard them
+        with self.captureOnCommitCallbacks(execute=True):
+            Distance.objects.create(date=datetime.date(2023, 10, 12), person=self.rival, distance=1, unit=self.km)
+        with self.assertNumQueries(3):
+            person_stats(self.person.id, today=today)
+
+    def test_person_page_shows_stats(self):
+        response = self.client.get(reverse('person', args=[self.person.id]))
+
+        self.assertContains(response, "14.00 km from 7 distances over 6 days")
+        self.assertContains(response, "Longest streak: 3 days")
+        self.assertContains(response, "2 of 2 in their office")
+
+        response = self.client.get(reverse('person', args=[Person.objects.create(
+            first_name="Moe", last_name="Szyslak", email="moe@example.com", location=self.person.location).id]))
+        self.assertContains(response, "No distances have been logged yet.")
+
+
+class OfficeStatsTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+
+        self.user = User.objects.create_user(username='user', password='password')
+        self.client.login(username='user', password='password')
+
+        self.office = Office.objects.create(city="Springfield", country="USA")
+        elsewhere = Office.objects.create(city="Shelbyville", country="USA")
+        self.km = Unit.objects.create(unit_of_measurement="km", metres_per_unit=1000)
+        self.people = [
+            Person.objects.create(first_name=name, last_name="Van Houten", email=f"{name.lower()}@example.com", location=self.office)
+            for name in ["Milhouse", "Kirk", "Luann"]
+        ]
+        Distance.objects.create(date="2023-09-15", person=self.people[0], distance=3, unit=self.km)
+        Distance.objects.create(date="2023-09-16", person=self.people[0], distance=2, unit=self.km)
+        Distance.objects.create(date="2023-09-16", person=self.people[1], distance=10, unit=self.km)
+        other = Person.objects.create(first_name="Jimbo", last_name="Jones", email="jimbo@example.com", location=elsewhere)
+        Distance.objects.create(date="2023-09-16", person=other, distance=50, unit=self.km)
+
+    def test_aggregates_and_top_contributors(self):
+        stats = office_stats(self.office.id)
+
+        self.assertEqual((stats['members'], stats['active'], stats['entries']), (3, 2, 3))
+        self.assertEqual(stats['kilometres'], Decimal("15.00"))
+        self.assertEqual(stats['per_capita'], Decimal("5.00"))
+        self.assertEqual(stats['per_active'], Decimal("7.50"))
+        self.assertEqual([rollup.person for rollup in stats['top']], [self.people[1], self.people[0]])
+
+    def test_empty_office(self):
+        stats = office_stats(Office.objects.create(city="Ogdenville", country="USA").id)
+        self.assertEqual((stats['members'], stats['kilometres'], stats['per_capita'], stats['top']), (0, Decimal("0.00"), None, []))
+
+    def test_members_are_paginated_by_name(self):
+        response = self.client.get(reverse('office', args=[self.office.id]), {'page_size': 2})
+
+        self.assertEqual([member.first_name for member in response.context['members']], ["Kirk", "Luann"])
+        self.assertContains(response, "15.00 km from 3 distances")
+        response = self.client.get(reverse('office', args=[self.office.id]), {'page_size': 2, 'after': response.context['members'].next_cursor})
+        self.assertEqual([member.first_name for member in response.context['members']], ["Milhouse"])
+        self.assertContains(response, "<td>5.00</td>", html=True)
+
+    def test_cursor_with_invalid_values_shows_first_page(self):
+        response = self.client.get(reverse('office', args=[self.office.id]), {'after': encode_cursor(["Van Houten", "Kirk", "x"])})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([member.first_name for member in response.context['members']], ["Kirk", "Luann", "Milhouse"])
+
+    def test_query_count_does_not_grow_with_members(self):
+        url = reverse('office', args=[self.office.id])
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as few:
+            self.client.get(url)
+
+        Person.objects.bulk_create([
+            Person(first_name=f"Extra{n}", last_name="Member", email=f"extra{n}@example.com", location=self.office)
+            for n in range(20)
+        ])
+        with CaptureQueriesContext(connection) as many:
+            self.client.get(url)
+
+        # Adding people bumps the people fragment, not the office's
+        self.assertEqual(len(few), len(many))
+
+    def test_people_list_joins_the_offices(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('people'))
+        self.assertFalse([query for query in queries if 'FROM "distance_office"' in query['sql']])
+
+class OrgTreeTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='user', password='password')
+        self.client.login(username='user', password='password')
+
+        self.km = Unit.objects.create(unit_of_measurement="km", metres_per_unit=1000)
+        self.springfield = Office.objects.create(city="Springfield", country="USA")
+        self.plant = Office.objects.create(city="Springfield", country="USA")
+        self.london = Office.objects.create(city="London", country="UK")
+        self.homer = Person.objects.create(first_name="Homer", last_name="Simpson", email="homer@example.com", location=self.plant)
+        self.lisa = Person.objects.create(first_name="Lisa", last_name="Simpson", email="lisa@example.com", location=self.springfield)
+        self.hugh = Person.objects.create(first_name="Hugh", last_name="Parkfield", email="hugh@example.com", location=self.london)
+        Distance.objects.create(date="2023-09-15", person=self.homer, distance=2, unit=self.km)
+        Distance.objects.create(date="2023-09-15", person=self.lisa, distance=6, unit=self.km)
+        Distance.objects.create(date="2023-09-16", person=self.hugh, distance=4, unit=self.km)
+
+    def totals(self):
+        return {
+            (node.depth, node.country, node.city, node.office_id): (node.total, node.entries)
+            for node in OrgTotal.objects.filter(entries__gt=0)
+        }
+
+    def test_writes_update_every_level(self):
+        self.assertEqual(self.totals(), {
+            (OrgTotal.COUNTRY, "USA", "", None): (Decimal("8000.00"), 2),
+            (OrgTotal.CITY, "USA", "Springfield", None): (Decimal("8000.00"), 2),
+            (OrgTotal.OFFICE, "USA", "Springfield", self.plant.id): (Decimal("2000.00"), 1),
+            (OrgTotal.OFFICE, "USA", "Springfield", self.springfield.id): (Decimal("6000.00"), 1),
+            (OrgTotal.COUNTRY, "UK", "", None): (Decimal("4000.00"), 1),
+            (OrgTotal.CITY, "UK", "London", None): (Decimal("4000.00"), 1),
+            (OrgTotal.OFFICE, "UK", "London", self.london.id): (Decimal("4000.00"), 1),
+        })
+        Distance.objects.get(person=self.lisa).delete()
+        self.assertEqual(OrgTotal.objects.get(depth=OrgTotal.COUNTRY, country="USA").total, Decimal("2000.00"))
+        self.assertEqual(rollups.verify(), [])
+
+    def test_people_and_offices_moving(self):
+        self.homer.location = self.london
+        self.homer.save()
+        self.assertEqual(OrgTotal.objects.get(depth=OrgTotal.CITY, city="London").total, Decimal("6000.00"))
+        self.assertEqual(OrgTotal.objects.get(depth=OrgTotal.COUNTRY, country="USA").total, Decimal("6000.00"))
+
+        self.london.city, self.london.country = "Paris", "France"
+        self.london.save()
+        self.assertEqual(OrgTotal.objects.get(depth=OrgTotal.CITY, city="Paris").total, Decimal("6000.00"))
+        self.assertEqual(OrgTotal.objects.get(office=self.london).country, "France")
+        self.assertEqual(OrgTotal.objects.get(depth=OrgTotal.COUNTRY, country="UK").entries, 0)
+        self.assertEqual(rollups.verify(), [])
+
+        self.springfield.delete()
+        self.assertEqual(OrgTotal.objects.get(depth=OrgTotal.COUNTRY, country="USA").entries, 0)
+        self.assertEqual(rollups.verify(), [])
+
+    def test_rebuild_recreates_the_tree(self):
+        expected = self.totals()
+        OrgTotal.objects.all().delete()
+        rollups.rebuild()
+        self.assertEqual(self.totals(), expected)
+
+    def test_whole_tree_is_one_query(self):
+        with self.assertNumQueries(1):
+            tree = org_tree()
+        self.assertEqual([country["node"].country for country in tree], ["UK", "USA"])
+        self.assertEqual([office.office for office in tree[1]["cities"][0]["offices"]], [self.springfield, self.plant])
+
+        response = self.client.get(reverse('api_tree'))
+        self.assertEqual(response.json()["results"][1]["cities"][0]["total"], "8000.00")
+
+    def test_drill_down(self):
+        node = org_node()
+        self.assertEqual((node["kilometres"], node["entries"]), (Decimal("12.00"), 3))
+        self.assertEqual([(child["node"].country, child["share"]) for child in node["children"]], [("USA", 67), ("UK", 33)])
+        node = org_node("USA", "Springfield")
+        self.assertEqual([child["node"].office for child in node["children"]], [self.springfield, self.plant])
+        self.assertIsNone(org_node("France"))
+
+        response = self.client.get(reverse('organisation'), {'country': "USA"})
+        self.assertContains(response, "8.00 km from 2 distances")
+        self.assertEqual(self.client.get(reverse('organisation'), {'country': "France"}).status_code, 404)
+
+    def test_drill_down_query_count_is_constant(self):
+        counts = []
+        for params in [{}, {'country': "USA"}, {'country': "USA", 'city': "Springfield"}]:
+            with CaptureQueriesContext(connection) as queries:
+                self.client.get(reverse('organisation'), params)
+            counts.append(len(queries))
+        self.assertEqual(len(set(counts)), 1)
+
+class ArchiveTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='user', password='password')
+        self.client.login(username='user', password='password')
+
+        self.km = Unit.objects.create(unit_of_measurement="km", metres_per_unit=1000)
+        self.office = Office.objects.create(city="Springfield", country="USA")
+        self.homer = Person.objects.create(first_name="Homer", last_name="Simpson", email="homer@example.com", location=self.office)
+        self.marge = Person.objects.create(first_name="Marge", last_name="Simpson", email="marge@example.com", location=self.office)
+        self.old = [
+            Distance.objects.create(date="2022-03-01", person=self.homer, distance=2, unit=self.km),
+            Distance.objects.create(date="2022-11-30", person=self.marge, distance=5, unit=self.km),
+            Distance.objects.create(date="2022-12-31", person=self.homer, distance=1, unit=self.km),
+        ]
+        self.current = Distance.objects.create(date="2023-01-02", person=self.homer, distance=3, unit=self.km)
+
+    def test_close_year_moves_the_rows_and_keeps_the_totals(self):
+        closed = archive.close_year(2022, batch_size=2, today=datetime.date(2023, 1, 10))
+
+        self.assertEqual(list(Distance.objects.values_list("id", flat=True)), [self.current.id])
+        self.assertEqual(sorted(ArchivedDistance.objects.values_list("id", flat=True)), [d.id for d in self.old])
+        self.assertEqual((closed.distances, closed.total), (3, Decimal("8000.00")))
+        self.assertEqual(PersonTotal.objects.get(person=self.homer).total, Decimal("6000.00"))
+        self.assertEqual(rollups.verify(), [])
+        rollups.rebuild()
+        self.assertEqual(OfficeTotal.objects.get(office=self.office).total, Decimal("11000.00"))
+
+    def test_challenge_dates_choose_the_year(self):
+        Challenge.objects.create(year=2022, target=100, unit=self.km, start_date="2022-01-01", end_date="2022-11-30")
+        with self.assertRaises(ValueError):
+            archive.close_year(2022, today=datetime.date(2022, 11, 30))
+        closed = archive.close_year(2022, today=datetime.date(2022, 12, 1))
+
+        self.assertEqual(closed.distances, 2)
+        self.assertEqual(Distance.objects.filter(date__year=2022).count(), 1)
+        self.assertEqual(rollups.verify(), [])
+
+    def test_closing_again_archives_late_entries(self):
+        archive.close_year(2022, today=datetime.date(2023, 1, 10))
+        Distance.objects.create(date="2022-06-01", person=self.marge, distance=4, unit=self.km)
+        closed = archive.close_year(2022, today=datetime.date(2023, 1, 10))
+
+        self.assertEqual((closed.distances, closed.total), (4, Decimal("12000.00")))
+        self.assertFalse(Distance.objects.filter(date__year=2022).exists())
+
+    def test_deleting_a_person_removes_their_archived_distances_from_the_totals(self):
+        archive.close_year(2022, today=datetime.date(2023, 1, 10))
+        self.marge.delete()
+
+        self.assertEqual(OfficeTotal.objects.get(office=self.office).total, Decimal("6000.00"))
+        self.assertEqual(rollups.verify(), [])
+
+    def test_history_pages(self):
+        call_command("close_year", "2022", stdout=StringIO())
+        response = self.client.get(reverse('archived_year', args=[2022]))
+
+        self.assertEqual([person['first_name'] for person in response.context['totals']['people']], ["Marge", "Homer"])
+        self.assertContains(response, "<td>3.00</td>", html=True)
+        self.assertContains(self.client.get(reverse('archived_years')), "8.00")
+        self.assertEqual(self.client.get(reverse('archived_year', args=[2021])).status_code, 404)
+        stats = person_stats(self.homer.id, today=datetime.date(2023, 1, 10))
+        self.assertEqual(stats['years'], [{"year": 2023, "kilometres": Decimal("3.00")}, {"year": 2022, "kilometres": Decimal("3.00")}])
+
+    def test_unfinished_year_is_refused(self):
+        with self.assertRaises(CommandError):
+            call_command("close_year", str(timezone.localdate().year), stdout=StringIO())
+
+class StaticFilesTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='user', password='password')
+        self.client.login(username='user', password='password')
+
+        static_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, static_root)
+        settings_override = self.settings(STATIC_ROOT=static_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        call_command("collectstatic", interactive=False, verbosity=0)
+        with open(os.path.join(settings.STATICFILES_DIRS[0], "css", "style.css"), "rb") as file:
+            self.stylesheet = file.read()
+
+    def test_layout_links_the_hashed_stylesheet(self):
+        response = self.client.get(reverse('index'))
+
+        self.assertRegex(response.content.decode(), r'href="/static/css/style\.[0-9a-f]{12}\.css"')
+        self.assertNotContains(response, 'style.css?')
+        # Until vendor_bootstrap has been run Bootstrap still comes from the CDN, checked by the same hash
+        self.assertContains(response, assets.BOOTSTRAP_CDN + "css/bootstrap.min.css")
+        self.assertContains(response, assets.BOOTSTRAP_FILES["css"][1])
+
+    def test_vendored_files_are_collected_unchanged(self):
+        vendor_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, vendor_dir)
+        contents = {}
+        for path, sri in assets.BOOTSTRAP_FILES.values():
+            # Like Bootstrap's own files, they name source maps that haven't been downloaded
+            contents[path] = f"/* {path} */\n//# sourceMappingURL={os.path.basename(path)}.map".encode()
+            os.makedirs(os.path.join(vendor_dir, assets.BOOTSTRAP_DIR, os.path.dirname(path)), exist_ok=True)
+            with open(os.path.join(vendor_dir, assets.BOOTSTRAP_DIR, path), "wb") as file:
+                file.write(contents[path])
+
+        with self.settings(STATICFILES_DIRS=[*settings.STATICFILES_DIRS, vendor_dir]):
+            assets.vendored.cache_clear()
+            self.addCleanup(assets.vendored.cache_clear)
+            self.assertTrue(assets.vendored())
+            call_command("collectstatic", interactive=False, verbosity=0)
+            for path, content in contents.items():
+                with staticfiles_storage.open(staticfiles_storage.stored_name(assets.BOOTSTRAP_DIR + path)) as file:
+                    self.assertEqual(file.read(), content)
+
+            css = assets.bootstrap()["css"]
+            self.assertEqual(css["url"], staticfiles_storage.url(assets.BOOTSTRAP_DIR + "css/bootstrap.min.css"))
+            with self.settings(DISTANCE_BOOTSTRAP_CDN=True):
+                self.assertEqual(assets.bootstrap()["css"]["url"], assets.BOOTSTRAP_CDN + "css/bootstrap.min.css")
+
+    def test_hashed_files_are_cached_forever_and_sent_compressed(self):
+        url = staticfiles_storage.url("css/style.css")
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING="br;q=0, gzip")
+
+        self.assertEqual(response["Cache-Control"], "public, max-age=31536000, immutable")
+        self.assertEqual((response["Content-Type"], response["Content-Encoding"]), ("text/css", "gzip"))
+        self.assertEqual(response["Vary"], "Accept-Encoding")
+        self.assertEqual(gzip.decompress(b"".join(response.streaming_content)), self.stylesheet)
+
+        repeat = self.client.get(url, HTTP_ACCEPT_ENCODING="gzip", HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(repeat.status_code, 304)
+
+        plain = self.client.get(url)
+        self.assertFalse(plain.has_header("Content-Encoding"))
+        self.assertEqual(b"".join(plain.streaming_content), self.stylesheet)
+
+    def test_unhashed_names_are_cached_briefly(self):
+        response = self.client.get("/static/css/style.css")
+        self.assertEqual(response["Cache-Control"], "public, max-age=60")
+        self.assertEqual(self.client.get("/static/css/missing.css").status_code, 404)
+
+    def test_integrity_hash(self):
+        self.assertEqual(assets.integrity(b""), "sha384-OLBgp1GsljhM2TJ+sbHjaiH9txEUvgdDTAzHv2P24donTt6/529l+9Ua0vFImLlb")
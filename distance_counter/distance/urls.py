@@ -1,15 +1,18 @@
-from . import views
+from . import api, async_views, views
 from django.urls import path
 
 urlpatterns = [
     path("", views.index, name="index"),
     path("log", views.log, name="log"), 
+    path("log/batch/", views.log_batch, name="log_batch"),
     path("login/", views.sign_in, name="login"),
     path("logout/", views.sign_out, name="logout"),
     path("register/", views.register, name="register"),
     path("<int:distance_id>", views.distance, name="distance"),
     path('office/create/', views.office_create, name='office_create'),
     path('log/create/', views.log_create, name='log_create'),
+    path('log/import/', views.distance_import, name='distance_import'),
+    path('log/export/', views.distance_export, name='distance_export'),
     path('person/create/', views.person_create, name='person_create'),
     path('unit/create/', views.unit_create, name='unit_create'),
     path("<int:distance_id>/edit", views.distance_edit, name="distance_edit"),
@@ -17,14 +20,43 @@ urlpatterns = [
     path("person/<int:person_id>", views.person, name="person"),
     path("people/<int:person_id>/edit/", views.person_edit, name="person_edit"),
     path("people/", views.people, name="people"),
+    path("people/lookup/", views.person_lookup, name="person_lookup"),
+    path("people/search/", views.people_search, name="people_search"),
     path('person/<int:person_id>/delete/', views.delete_person, name='delete_person'),
     path("office/<int:office_id>", views.office, name="office"),
     path("offices/<int:office_id>/edit/", views.office_edit, name="office_edit"),
     path("offices/", views.offices, name="offices"),
+    path("organisation/", views.organisation, name="organisation"),
     path('office/<int:office_id>/delete/', views.delete_office, name='delete_office'),
     path("unit/<int:unit_id>", views.unit, name="unit"),
     path("units/<int:unit_id>/edit/", views.unit_edit, name="unit_edit"),
     path("units/", views.units, name="units"),
     path('unit/<int:unit_id>/delete/', views.delete_unit, name='delete_unit'),
+    path("challenges/", views.challenges, name="challenges"),
+    path("archive/", views.archived_years, name="archived_years"),
+    path("archive/<int:year>/", views.archived_year, name="archived_year"),
+    path("challenge/create/", views.challenge_create, name="challenge_create"),
+    path("challenges/<int:challenge_id>/edit/", views.challenge_edit, name="challenge_edit"),
+    path("leaderboard/<str:board>/", views.leaderboard, name="leaderboard"),
+    path("stats/queries/", views.query_stats, name="query_stats"),
+    path("jobs/", views.job_list, name="jobs"),
+    path("jobs/<int:job_id>/", views.job, name="job"),
+    path("jobs/<int:job_id>/download/", views.job_download, name="job_download"),
+    path("jobs/queue/<str:name>/", views.job_enqueue, name="job_enqueue"),
+    path("async/", async_views.index, name="async_index"),
+    path("async/<int:distance_id>", async_views.distance, name="async_distance"),
+    path("async/people/", async_views.people, name="async_people"),
+    path("async/person/<int:person_id>", async_views.person, name="async_person"),
+    path("async/leaderboard/<str:board>/", async_views.leaderboard, name="async_leaderboard"),
+    path("api/v1/distances/", api.distances, name="api_distances"),
+    path("api/v1/distances/<int:pk>/", api.distance, name="api_distance"),
+    path("api/v1/people/", api.people, name="api_people"),
+    path("api/v1/people/<int:pk>/", api.person, name="api_person"),
+    path("api/v1/offices/", api.offices, name="api_offices"),
+    path("api/v1/offices/<int:pk>/", api.office, name="api_office"),
+    path("api/v1/units/", api.units, name="api_units"),
+    path("api/v1/units/<int:pk>/", api.unit, name="api_unit"),
+    path("api/v1/series/", api.distance_series, name="api_series"),
+    path("api/v1/tree/", api.org_tree, name="api_tree"),
 ]
 
@@ -1,18 +1,64 @@
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import HttpResponse
-from .forms import LoginForm, RegisterForm, LogForm, OfficeForm, PersonForm, UnitForm, LogForm
+from django.template.loader import render_to_string
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse, JsonResponse
+from .forms import LoginForm, RegisterForm, LogForm, OfficeForm, PersonForm, UnitForm, LogForm, ImportForm, person_label
+from .forms import BatchLogForm, BatchEntryFormSet, ChallengeForm, IDEMPOTENCY_KEY_LENGTH, show_duplicate_confirmation
 from django.contrib import messages
 from django.contrib.auth import login, logout, authenticate
 from django.contrib.auth.models import User
-from django.contrib.auth.decorators import login_required
-from .models import Distance, Person, Office, Unit
-from django.core.exceptions import ObjectDoesNotExist
+from django.contrib.auth.decorators import login_required, user_passes_test
+from .models import ArchivedYear, Challenge, Distance, Job, Person, Office, Unit, Ranking
+from . import leaderboards
+from . import exporter
+from . import caching
+from . import jobs
+from . import archive
+from .search import count_people, search_people
+from .stats import office_stats, org_node, person_stats
+from .middleware import BUCKETS, get_stats
+import os
+from django.core.exceptions import BadRequest, ObjectDoesNotExist
+from django.db import IntegrityError, transaction
+from django.conf import settings
+from django.http import Http404
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from .pagination import MAX_INTEGER, InvalidCursor, get_page_size, paginate_keyset
 
 # Create your views here.
 
+def parse_date_param(value):
+    """
+    Parses a YYYY-MM-DD query string value
+
+    Returns:
+        date: The parsed date, or None if the value is missing or not a valid date
+    """
+    try:
+        return parse_date(value or "")
+    except ValueError:
+        return None
+
+
+def parse_id_param(value):
+    """
+    Parses a record id from a query string value
+
+    Returns:
+        int: The id, or None if the value is missing, not a whole number or too large to be an id
+    """
+    value = str(value or "")
+    if not value.isdigit() or int(value) > MAX_INTEGER:
+        return None
+    return int(value)
+
+
 def index(request):
     """
-    Displays all of the distance records for logged-in users
+    Displays the distance records for logged-in users, newest first
+
+    The records are keyset paginated on (date, id) using the 'after' and 'before'
+    cursors in the query string, and the page size can be set with 'page_size'
 
     Args:
         request (HttpRequest): The HTTP request object
@@ -20,8 +66,20 @@ def index(request):
     Returns:
         HttpResponse: The rendered index page.
     """
+    if not request.user.is_authenticated:
+        return render(request, "distance/index.html")
+
+    distances = Distance.objects.select_related("person", "unit")
+    page_size = get_page_size(request)
+    try:
+        page = paginate_keyset(distances, ["-date", "-id"], page_size,
+                               after=request.GET.get("after"), before=request.GET.get("before"))
+    except InvalidCursor:
+        page = paginate_keyset(distances, ["-date", "-id"], page_size)
+
     return render(request, "distance/index.html", {
-        "distances": Distance.objects.all()
+        "distances": page,
+        "page_size": page_size,
     })
 
 
@@ -45,6 +103,39 @@ def distance( request, distance_id):
 
 
 
+def _idempotency_key(request):
+    """
+    Returns the key identifying a POST that logs distances, from the Idempotency-Key
+    header or the form's hidden idempotency_key field, or None if neither was sent
+
+    Raises:
+        BadRequest: If the key is too long
+    """
+    key = request.headers.get('Idempotency-Key') or request.POST.get('idempotency_key') or None
+    if key and len(key) > IDEMPOTENCY_KEY_LENGTH:
+        raise BadRequest(f"Idempotency keys can be at most {IDEMPOTENCY_KEY_LENGTH} characters")
+    return key
+
+def _already_logged(key):
+    """Whether a POST with this idempotency key has already logged its distances"""
+    # Batches suffix the key with each row's position
+    return key is not None and Distance.objects.filter(idempotency_key__in=[key, f"{key}:0"]).exists()
+
+def _save_log_form(request, form):
+    """
+    Saves a valid LogForm with the request's idempotency key
+
+    Returns:
+        bool: False if another request with the same key saved its distance first
+    """
+    form.instance.idempotency_key = _idempotency_key(request)
+    try:
+        with transaction.atomic():
+            form.save()
+    except IntegrityError:
+        return False
+    return True
+
 @login_required
 def log(request):
     """
@@ -65,15 +156,76 @@ def log(request):
         context = {'form': form}
         return render(request, "distance/log.html", context)
     elif request.method == 'POST':
+        if _already_logged(_idempotency_key(request)):
+            messages.info(request, "This distance has already been logged")
+            return redirect('index')
         form = LogForm(request.POST)
         if form.is_valid():
-            form.save()
-            messages.success(request, f"Distance logged successfully!")
+            if _save_log_form(request, form):
+                messages.success(request, f"Distance logged successfully!")
+            else:
+                messages.info(request, "This distance has already been logged")
             return redirect('index')
         else:
             return render(request, "distance/log.html", {'form': form})
 
 
+@login_required
+def log_batch(request):
+    """
+    Handles both GET and POST requests for logging many dated distances for one person at once
+
+    The entries are validated together, with the person and the units each looked up
+    once, and saved with a single bulk insert in one transaction. Entries identical to a
+    distance already logged, or to another entry, are rejected unless allow_duplicate is ticked
+
+    Args:
+        request (HttpRequest): The HTTP request object
+
+    Returns:
+        HttpResponse: The rendered batch logging page or a redirection to the index page on success
+    """
+    units = Unit.objects.order_by('id').in_bulk()
+    if request.method == 'POST':
+        key = _idempotency_key(request)
+        if _already_logged(key):
+            messages.info(request, "These distances have already been logged")
+            return redirect('index')
+        form = BatchLogForm(request.POST)
+        formset = BatchEntryFormSet(request.POST, form_kwargs={'units': units})
+        if form.is_valid() and formset.is_valid():
+            person = form.cleaned_data['person']
+            entries = []
+            for entry in formset:
+                # Rows left blank are skipped
+                if entry.has_changed():
+                    entries.append((entry, Distance(person=person, **entry.cleaned_data)))
+            for position, (entry, distance) in enumerate(entries):
+                distance.fingerprint = distance.make_fingerprint()
+                distance.idempotency_key = key and f"{key}:{position}"
+
+            if not form.cleaned_data['allow_duplicate']:
+                seen = Distance.objects.existing_fingerprints(distance.fingerprint for entry, distance in entries)
+                for entry, distance in entries:
+                    if distance.fingerprint in seen:
+                        entry.add_error(None, "This distance has already been logged")
+                    seen.add(distance.fingerprint)
+
+            if not any(entry.errors for entry, distance in entries):
+                try:
+                    Distance.objects.bulk_log([distance for entry, distance in entries])
+                except IntegrityError:
+                    messages.info(request, "These distances have already been logged")
+                else:
+                    messages.success(request, f"{len(entries)} distances logged successfully!")
+                return redirect('index')
+            show_duplicate_confirmation(form)
+    else:
+        form = BatchLogForm()
+        formset = BatchEntryFormSet(form_kwargs={'units': units})
+    return render(request, "distance/log_batch.html", {'form': form, 'formset': formset})
+
+
 def sign_in(request):
     """
     Handles both GET and POST requests for user login
@@ -224,10 +376,15 @@ def log_create(request):
         HttpResponse: The rendered log creation page or a redirection to the index page on successful creation
     """
     if request.method == 'POST':
+        if _already_logged(_idempotency_key(request)):
+            messages.info(request, 'This distance has already been created')
+            return redirect('index')
         form = LogForm(request.POST)
         if form.is_valid():
-            form.save()
-            messages.success(request, 'Distance created successfully!')
+            if _save_log_form(request, form):
+                messages.success(request, 'Distance created successfully!')
+            else:
+                messages.info(request, 'This distance has already been created')
             return redirect('index')
     else:
         form = LogForm()
@@ -284,7 +441,8 @@ def delete_distance(request, distance_id):
 def people(request):
     """
     Retrieves all person records from the database and renders a page
-    displaying the list of people along with their details
+    displaying the list of people along with their details, or the people
+    matching the search in the 'q' query parameter
 
     Args:
         request (HttpRequest): The HTTP request object
@@ -292,16 +450,93 @@ def people(request):
     Returns:
         HttpResponse: The rendered people list page
     """
-    people = Person.objects.all()
+    if request.GET.get("q"):
+        people, page, has_next = _search_page(request, 50)
+        return render(request, "distance/people.html", {
+            "table": render_to_string("distance/fragments/people_table.html", {"persons": people}),
+            "query": request.GET["q"],
+            "page": page,
+            "has_next": has_next,
+        })
+
+    table = caching.fragment("people", [Person, Office], lambda: render_to_string(
+        "distance/fragments/people_table.html", {"persons": Person.objects.select_related("location")}
+    ))
     return render(request, "distance/people.html", {
-        "persons": people   
+        "table": table
+    })
+
+def _search_page(request, default_page_size):
+    """
+    Runs the people search in the 'q' query parameter for the requested 'page'
+
+    Returns:
+        tuple: (matching people on the page, page number, whether there is a next page)
+    """
+    query = request.GET.get("q", "")
+    page_size = get_page_size(request, default_page_size)
+    try:
+        page = max(1, int(request.GET.get("page", 1)))
+    except ValueError:
+        page = 1
+    people = []
+    if (page - 1) * page_size <= MAX_INTEGER:
+        people = search_people(query, limit=page_size + 1, offset=(page - 1) * page_size)
+    if not people and page > 1:
+        # Past the last page, e.g. from a stale or edited link, so show the last page instead
+        page = max(1, -(-count_people(query) // page_size))
+        people = search_people(query, limit=page_size + 1, offset=(page - 1) * page_size)
+    return people[:page_size], page, len(people) > page_size
+
+@login_required
+def person_lookup(request):
+    """
+    Returns up to 10 people best matching the 'q' query parameter, for the
+    typeahead on the distance logging forms
+
+    Args:
+        request (HttpRequest): The HTTP request object
+
+    Returns:
+        JsonResponse: {"results": [{"id": ..., "label": ...}, ...]}
+    """
+    people = search_people(request.GET.get("q", ""), limit=10)
+    return JsonResponse({
+        "results": [{"id": person.id, "label": person_label(person)} for person in people]
+    })
+
+@login_required
+def people_search(request):
+    """
+    Searches people by the start of their first name, last name, email or office,
+    best matches first
+
+    Args:
+        request (HttpRequest): The HTTP request object, with the search text in 'q'
+                               and optionally 'page' and 'page_size'
+
+    Returns:
+        JsonResponse: The matching people on the requested page, and whether there are more
+    """
+    people, page, has_next = _search_page(request, 20)
+    return JsonResponse({
+        "results": [{
+            "id": person.id,
+            "first_name": person.first_name,
+            "last_name": person.last_name,
+            "email": person.email,
+            "office": str(person.location),
+        } for person in people],
+        "page": page,
+        "has_next": has_next,
     })
 
 @login_required
 def person( request, person_id):
     """
     Retrieves a specific person record from the database based on the provided
-    person_id and renders a page displaying the details of that person
+    person_id and renders a page displaying the details of that person, with their
+    totals, weekly trend, streaks and ranks
 
     Args:
         request (HttpRequest): The HTTP request object
@@ -310,9 +545,14 @@ def person( request, person_id):
     Returns:
         HttpResponse: The rendered person details page
     """
-    person = Person.objects.get(pk=person_id)
+    # Cached until the person or any office changes, so a hit needs no queries
+    details = caching.fragment("person", [(Person, person_id), Office], lambda: render_to_string(
+        "distance/fragments/person.html", {"person": get_object_or_404(Person, pk=person_id)}
+    ), key=person_id)
     return render(request, "distance/person.html", {
-        "person": person
+        "details": details,
+        "person_id": person_id,
+        "stats": person_stats(person_id),
     })
 
 @login_required
@@ -374,16 +614,22 @@ def offices(request):
     Returns:
         HttpResponse: The rendered offices list page
     """
-    offices = Office.objects.all()
+    table = caching.fragment("offices", [Office], lambda: render_to_string(
+        "distance/fragments/offices_table.html", {"offices": Office.objects.all()}
+    ))
     return render(request, "distance/offices.html", {
-        "offices": offices  
+        "table": table
     })
 
 @login_required
 def office( request, office_id):
     """
     Retrieves a specific office record from the database based on the provided
-    office_id and renders a page displaying the name and location of that office
+    office_id and renders a page displaying the name and location of that office,
+    its statistics and top contributors, and a page of its members
+
+    The members are keyset paginated by name using the 'after' and 'before' cursors
+    in the query string, and the page size can be set with 'page_size'
 
     Args:
         request (HttpRequest): The HTTP request object
@@ -392,9 +638,54 @@ def office( request, office_id):
     Returns:
         HttpResponse: The rendered office details page
     """
-    office = Office.objects.get(pk=office_id)
+    details = caching.fragment("office", [(Office, office_id)], lambda: render_to_string(
+        "distance/fragments/office.html", {"office": get_object_or_404(Office, pk=office_id)}
+    ), key=office_id)
+
+    members = Person.objects.filter(location_id=office_id).select_related("rollup")
+    ordering = ["last_name", "first_name", "id"]
+    page_size = get_page_size(request)
+    try:
+        page = paginate_keyset(members, ordering, page_size,
+                               after=request.GET.get("after"), before=request.GET.get("before"))
+    except InvalidCursor:
+        page = paginate_keyset(members, ordering, page_size)
+
     return render(request, "distance/office.html", {
-        "office": office
+        "details": details,
+        "office_id": office_id,
+        "stats": office_stats(office_id),
+        "members": page,
+        "page_size": page_size,
+    })
+
+@login_required
+def organisation(request):
+    """
+    Displays the total of a country, a city or the whole organisation, and of each
+    of the places in it, with one query whichever level is shown
+
+    The 'country' and 'city' query string parameters choose the node to drill down
+    into, the offices in a city link to their office pages and so on to their people
+
+    Args:
+        request (HttpRequest): The HTTP request object
+
+    Returns:
+        HttpResponse: The rendered organisation page
+
+    Raises:
+        Http404: If nobody in the country or city has logged a distance
+    """
+    country = request.GET.get("country") or None
+    city = (request.GET.get("city") or None) if country else None
+    node = org_node(country, city)
+    if node is None:
+        raise Http404("Nothing has been logged there")
+    return render(request, "distance/organisation.html", {
+        "node": node,
+        "country": country,
+        "city": city,
     })
 
 @login_required
@@ -456,9 +747,11 @@ def units(request):
     Returns:
         HttpResponse: The rendered units list page
     """
-    units = Unit.objects.all()
+    table = caching.fragment("units", [Unit], lambda: render_to_string(
+        "distance/fragments/units_table.html", {"units": Unit.objects.all()}
+    ))
     return render(request, "distance/units.html", {
-        "units": units  
+        "table": table
     })
 
 @login_required
@@ -474,9 +767,12 @@ def unit( request, unit_id):
     Returns:
         HttpResponse: The rendered unit details page
     """
-    unit = Unit.objects.get(pk=unit_id)
+    details = caching.fragment("unit", [(Unit, unit_id)], lambda: render_to_string(
+        "distance/fragments/unit.html", {"unit": get_object_or_404(Unit, pk=unit_id)}
+    ), key=unit_id)
     return render(request, "distance/unit.html", {
-        "unit": unit
+        "details": details,
+        "unit_id": unit_id,
     })
 
 @login_required
@@ -484,6 +780,9 @@ def unit_edit(request, unit_id):
     """
     Handles both GET and POST requests for editing a unit of measurement
 
+    Changing how many metres the unit is worth queues a job renormalizing the logged
+    distances, and redirects to its progress page
+
     Args:
         request (HttpRequest): The HTTP request object
         unit_id (int): The ID of the unit record to edit
@@ -496,8 +795,12 @@ def unit_edit(request, unit_id):
     if request.method == 'POST':
         form = UnitForm(request.POST, instance=unit)
         if form.is_valid():
-            form.save()
+            unit = form.save()
             messages.success(request, 'Unit edited successfully!')
+            if unit.factor_changed:
+                # Every distance logged in the unit has to be renormalized and the totals rebuilt
+                job = jobs.enqueue('rebuild_rollups', {'normalize': True}, user=request.user)
+                return redirect('job', job_id=job.id)
             return redirect('unit', unit_id=unit_id)
 
     else:
@@ -524,4 +827,326 @@ def delete_unit(request, unit_id):
         unit.delete()
         messages.success(request, 'Unit deleted successfully!')
         return redirect('units') 
-    return redirect('unit', unit_id=unit_id) 
\ No newline at end of file
+    return redirect('unit', unit_id=unit_id) 
+
+@login_required
+def challenges(request):
+    """
+    Displays the progress of every challenge, newest first
+
+    Args:
+        request (HttpRequest): The HTTP request object
+
+    Returns:
+        HttpResponse: The rendered challenges page
+    """
+    challenges = Challenge.objects.select_related("unit").order_by("-start_date")
+    return render(request, "distance/challenges.html", {
+        "challenges": challenges
+    })
+
+@login_required
+def archived_years(request):
+    """
+    Lists the years that have been closed, newest first
+
+    Args:
+        request (HttpRequest): The HTTP request object
+
+    Returns:
+        HttpResponse: The rendered past years page
+    """
+    return render(request, "distance/archived_years.html", {
+        "years": ArchivedYear.objects.order_by("-year")
+    })
+
+@login_required
+def archived_year(request, year):
+    """
+    Displays the totals of every office and the top people of a closed year,
+    read from the daily running totals rather than the archived distances
+
+    Args:
+        request (HttpRequest): The HTTP request object
+        year (int): The closed year to display
+
+    Returns:
+        HttpResponse: The rendered past year page
+    """
+    closed = get_object_or_404(ArchivedYear, year=year)
+    return render(request, "distance/archived_year.html", {
+        "year": closed,
+        "totals": archive.year_totals(closed),
+    })
+
+@login_required
+def challenge_create(request):
+    """
+    Handles both GET and POST requests for creating a new challenge
+
+    Args:
+        request (HttpRequest): The HTTP request object
+
+    Returns:
+        HttpResponse: The rendered challenge creation page or a redirection to the challenges page on successful creation
+    """
+    if request.method == 'POST':
+        form = ChallengeForm(request.POST)
+        if form.is_valid():
+            form.save()
+            messages.success(request, 'Challenge created successfully!')
+            return redirect('challenges')
+    else:
+        form = ChallengeForm()
+    return render(request, 'distance/create.html', {'form': form})
+
+@login_required
+def challenge_edit(request, challenge_id):
+    """
+    Handles both GET and POST requests for editing a challenge
+
+    Args:
+        request (HttpRequest): The HTTP request object
+        challenge_id (int): The ID of the challenge to edit
+
+    Returns:
+        HttpResponse: The rendered challenge editing page or a redirection to the challenges page on successful edit
+    """
+    challenge = get_object_or_404(Challenge, pk=challenge_id)
+
+    if request.method == 'POST':
+        form = ChallengeForm(request.POST, instance=challenge)
+        if form.is_valid():
+            form.save()
+            messages.success(request, 'Challenge edited successfully!')
+            return redirect('challenges')
+
+    else:
+        form = ChallengeForm(instance=challenge)
+
+    return render(request, 'distance/edit.html', {'form': form})
+
+@login_required
+def leaderboard(request, board):
+    """
+    Displays the top of a people or offices leaderboard, and the rank of one entrant on it
+
+    The 'period' query parameter chooses the overall, month or week board, and 'date'
+    picks which month or week (defaulting to the current one). The highlighted entrant
+    is the person or office given by 'id', or for the people board the person whose
+    email matches the logged-in user
+
+    Args:
+        request (HttpRequest): The HTTP request object
+        board (str): Either 'people' or 'offices'
+
+    Returns:
+        HttpResponse: The rendered leaderboard page
+    """
+    if board not in (Ranking.PEOPLE, Ranking.OFFICES):
+        raise Http404("No such leaderboard")
+
+    period = request.GET.get("period", Ranking.OVERALL)
+    if period not in (Ranking.OVERALL, Ranking.MONTH, Ranking.WEEK):
+        period = Ranking.OVERALL
+    date = parse_date_param(request.GET.get("date"))
+    if date is None or not leaderboards.in_range(period, date):
+        date = timezone.localdate()
+    start = leaderboards.period_start(period, date)
+
+    subject_id = parse_id_param(request.GET.get("id"))
+    if subject_id is None and board == Ranking.PEOPLE and request.user.email:
+        subject_id = Person.objects.filter(email__iexact=request.user.email).values_list("id", flat=True).first()
+
+    rankings = leaderboards.top(board, period, start, settings.DISTANCE_LEADERBOARD_SIZE)
+    mine = leaderboards.position(board, period, subject_id, start) if subject_id is not None else None
+
+    return render(request, "distance/leaderboard.html", {
+        "board": board,
+        "period": period,
+        "period_start": start,
+        "rankings": rankings,
+        "mine": mine,
+    })
+
+@login_required
+def distance_import(request):
+    """
+    Handles both GET and POST requests for bulk importing distances from a CSV or JSON Lines file
+
+    The file is saved and imported by a background job, so large files never hold up the request
+
+    Args:
+        request (HttpRequest): The HTTP request object
+
+    Returns:
+        HttpResponse: The rendered import page or a redirection to the import job's progress page
+    """
+    if request.method == 'POST':
+        form = ImportForm(request.POST, request.FILES)
+        if form.is_valid():
+            path = jobs.save_upload(form.cleaned_data['file'])
+            # Each chunk of an import is committed as it goes, so a retry would import them twice
+            job = jobs.enqueue('import_distances', {'path': path, 'format': form.cleaned_data['format']},
+                               user=request.user, max_attempts=1)
+            messages.success(request, 'Import queued, the distances will be added shortly')
+            return redirect('job', job_id=job.id)
+    else:
+        form = ImportForm()
+    return render(request, 'distance/import.html', {'form': form})
+
+@login_required
+def distance_export(request):
+    """
+    Streams the distance records as a CSV or JSON Lines download
+
+    The 'format' query parameter chooses 'csv' (the default) or 'json', and
+    'date_from' and 'date_to' optionally limit the dates exported. With 'background'
+    set, the file is written by a background job instead, to be downloaded from its page
+
+    Args:
+        request (HttpRequest): The HTTP request object
+
+    Returns:
+        StreamingHttpResponse: The exported distances, sent as they are read from the database,
+                               or a redirection to the export job's progress page
+    """
+    format = request.GET.get('format', 'csv')
+    if format not in exporter.FORMATS:
+        return HttpResponse(f"Unsupported format: {format}", status=400)
+
+    distances = Distance.objects.all()
+    date_from = parse_date_param(request.GET.get('date_from'))
+    date_to = parse_date_param(request.GET.get('date_to'))
+    if request.GET.get('background'):
+        job = jobs.enqueue('export_distances', {
+            'format': format,
+            'date_from': date_from and date_from.isoformat(),
+            'date_to': date_to and date_to.isoformat(),
+        }, user=request.user)
+        return redirect('job', job_id=job.id)
+    if date_from:
+        distances = distances.filter(date__gte=date_from)
+    if date_to:
+        distances = distances.filter(date__lte=date_to)
+
+    extension = 'jsonl' if format == 'json' else 'csv'
+    response = StreamingHttpResponse(
+        exporter.encode(exporter.export_rows(distances), format),
+        content_type=exporter.FORMATS[format],
+    )
+    response['Content-Disposition'] = f'attachment; filename="distances.{extension}"'
+    return response
+
+# Jobs superusers can queue from the jobs page: (label, task, payload)
+MAINTENANCE_JOBS = {
+    'rebuild_rollups': ("Rebuild running totals", 'rebuild_rollups', {}),
+    'normalize_distances': ("Renormalize distances and rebuild running totals", 'rebuild_rollups', {'normalize': True}),
+    'refresh_leaderboards': ("Refresh every leaderboard", 'refresh_leaderboards', {'all': True}),
+}
+
+def _visible_jobs(user):
+    """Superusers can see every job, other users only the jobs they queued"""
+    queryset = Job.objects.select_related("created_by")
+    return queryset if user.is_superuser else queryset.filter(created_by=user)
+
+@login_required
+def job_list(request):
+    """
+    Lists the most recent background jobs, and lets superusers queue maintenance jobs
+
+    Args:
+        request (HttpRequest): The HTTP request object
+
+    Returns:
+        HttpResponse: The rendered jobs page
+    """
+    return render(request, "distance/jobs.html", {
+        "jobs": _visible_jobs(request.user).order_by("-id")[:50],
+        "maintenance": MAINTENANCE_JOBS,
+    })
+
+@login_required
+def job(request, job_id):
+    """
+    Displays a background job's status, progress and result
+
+    Args:
+        request (HttpRequest): The HTTP request object
+        job_id (int): The ID of the job
+
+    Returns:
+        HttpResponse: The rendered job page, or its status as JSON when 'format' is 'json'
+    """
+    job = get_object_or_404(_visible_jobs(request.user), pk=job_id)
+    if request.GET.get('format') == 'json':
+        return JsonResponse({
+            "id": job.id,
+            "task": job.task,
+            "status": job.status,
+            "progress": job.progress,
+            "progress_total": job.progress_total,
+            "percentage": job.percentage,
+            "error": job.error,
+        })
+    return render(request, "distance/job.html", {"job": job})
+
+@login_required
+def job_download(request, job_id):
+    """
+    Sends the file written by a finished export job
+
+    Args:
+        request (HttpRequest): The HTTP request object
+        job_id (int): The ID of the export job
+
+    Returns:
+        FileResponse: The exported distances
+    """
+    job = get_object_or_404(_visible_jobs(request.user), pk=job_id, task='export_distances', status=Job.SUCCEEDED)
+    if not os.path.exists(job.result['path']):
+        raise Http404("The exported file has been removed")
+    extension = 'jsonl' if job.result['format'] == 'json' else 'csv'
+    return FileResponse(
+        open(job.result['path'], 'rb'), as_attachment=True,
+        filename=f"distances.{extension}", content_type=exporter.FORMATS[job.result['format']],
+    )
+
+@user_passes_test(lambda user: user.is_superuser)
+def job_enqueue(request, name):
+    """
+    Queues one of the maintenance jobs, for superusers
+
+    Args:
+        request (HttpRequest): The HTTP request object, which must be a POST
+        name (str): A key of MAINTENANCE_JOBS
+
+    Returns:
+        HttpResponse: A redirection to the job's progress page
+    """
+    if request.method != 'POST' or name not in MAINTENANCE_JOBS:
+        raise Http404("Unknown job")
+    label, task, payload = MAINTENANCE_JOBS[name]
+    job = jobs.enqueue(task, payload, user=request.user)
+    messages.success(request, f"{label} queued")
+    return redirect('job', job_id=job.id)
+
+@user_passes_test(lambda user: user.is_superuser)
+def query_stats(request):
+    """
+    Displays the per-view query counts and timings collected by QueryStatsMiddleware,
+    and the fragment cache hits and misses, in this process, for superusers
+
+    Args:
+        request (HttpRequest): The HTTP request object
+
+    Returns:
+        HttpResponse: The rendered stats page
+    """
+    return render(request, "distance/query_stats.html", {
+        "enabled": settings.DISTANCE_QUERY_STATS,
+        "budget": settings.DISTANCE_QUERY_BUDGET,
+        "buckets": BUCKETS,
+        "stats": get_stats(),
+        "fragments": caching.get_counts(),
+    })
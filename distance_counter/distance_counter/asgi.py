@@ -12,5 +12,6 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'distance_counter.settings')
+os.environ.setdefault('DISTANCE_SERVER', 'asgi')
 
 application = get_asgi_application()
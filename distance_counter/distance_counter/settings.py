@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -42,7 +43,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'distance.middleware.QueryStatsMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'distance.middleware.StaticFilesMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -64,6 +67,8 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'distance.context_processors.challenge',
+                'distance.context_processors.static_assets',
             ],
         },
     },
@@ -75,13 +80,69 @@ WSGI_APPLICATION = 'distance_counter.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
+# DISTANCE_DB_PROFILE chooses how SQLite is tuned:
+#   "development" - SQLite's defaults, and a new connection for each request
+#   "production"  - WAL journaling and the pragmas below, with connections kept open
+#                   between requests so concurrent writers don't serialize on the lock
+DATABASE_PROFILE = os.environ.get('DISTANCE_DB_PROFILE', 'development')
+
+# Set to "asgi" by asgi.py. Connections aren't kept open under ASGI, where queries run
+# in sync_to_async threads that Django's end of request cleanup never reaches
+SERVER_INTERFACE = os.environ.get('DISTANCE_SERVER', 'wsgi')
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'NAME': os.environ.get('DISTANCE_DB_NAME', BASE_DIR / 'db.sqlite3'),
+        'CONN_MAX_AGE': 600 if DATABASE_PROFILE == 'production' and SERVER_INTERFACE == 'wsgi' else 0,
+        'CONN_HEALTH_CHECKS': DATABASE_PROFILE == 'production',
+        'OPTIONS': {
+            # Seconds to wait for a lock before raising "database is locked"
+            'timeout': 20,
+        },
     }
 }
 
+# Pragmas run on every new SQLite connection, see distance/db.py
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -64000,  # negative values are KiB, so 64MB
+    'mmap_size': 268435456,  # 256MB
+    'busy_timeout': 20000,
+    'temp_store': 'MEMORY',
+} if DATABASE_PROFILE == 'production' else {}
+
+
+# Caches
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+#
+# DISTANCE_CACHE chooses the backend used for rendered page fragments:
+#   "locmem" - in each process's memory, only suitable for a single server process
+#   "file"   - files in DISTANCE_CACHE_DIR, shared by every process on the machine
+#   "dummy"  - no caching
+
+CACHE_BACKENDS = {
+    'locmem': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'OPTIONS': {'MAX_ENTRIES': 5000},
+    },
+    'file': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('DISTANCE_CACHE_DIR', BASE_DIR / 'cache'),
+    },
+    'dummy': {
+        'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+    },
+}
+
+CACHES = {
+    'default': CACHE_BACKENDS[os.environ.get('DISTANCE_CACHE', 'locmem')],
+}
+
+# Seconds a rendered fragment is kept, they are also invalidated whenever what they show changes
+DISTANCE_FRAGMENT_TIMEOUT = 3600
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -124,7 +185,56 @@ STATICFILES_DIRS = [
     BASE_DIR / "static",
 ]
 
+# `python manage.py collectstatic` copies the static files here, under hashed names with
+# precompressed copies (see distance/storage.py), and distance.middleware.StaticFilesMiddleware
+# serves them. Files without a hash in their name are cached for DISTANCE_STATIC_MAX_AGE seconds
+STATIC_ROOT = os.environ.get('DISTANCE_STATIC_ROOT', BASE_DIR / 'staticfiles')
+DISTANCE_STATIC_MAX_AGE = 60
+
+# Bootstrap is served from the copy `python manage.py vendor_bootstrap` downloads into the static
+# files, or from the jsDelivr CDN until it has been run. Set this to always use the CDN
+DISTANCE_BOOTSTRAP_CDN = os.environ.get('DISTANCE_BOOTSTRAP_CDN', '') == '1'
+
+STORAGES = {
+    "default": {
+        "BACKEND": "django.core.files.storage.FileSystemStorage",
+    },
+    "staticfiles": {
+        "BACKEND": "distance.storage.CompressedManifestStorage",
+    },
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Distance app settings
+
+# Number of records shown per page on paginated lists, and the most a client may request
+DISTANCE_PAGE_SIZE = 50
+DISTANCE_MAX_PAGE_SIZE = 500
+
+# Length of one step in metres, used to convert distances logged in steps
+DISTANCE_STRIDE_LENGTH = 0.762
+
+# When leaderboards are recomputed: "job" queues a background job refreshing the boards a
+# transaction touched, "write" refreshes them as it commits (only for small installations),
+# "schedule" leaves it to a periodic `python manage.py refresh_leaderboards`
+DISTANCE_LEADERBOARD_REFRESH = "job"
+DISTANCE_LEADERBOARD_SIZE = 10
+
+# Per-request query and timing instrumentation, see distance/middleware.py. Requests making
+# more than DISTANCE_QUERY_BUDGET queries are logged
+DISTANCE_QUERY_STATS = os.environ.get('DISTANCE_QUERY_STATS', '') == '1'
+DISTANCE_QUERY_BUDGET = 50
+
+# Background jobs, see distance/jobs.py. Uploaded and exported files are kept in DISTANCE_JOB_DIR
+# for DISTANCE_JOB_RETENTION seconds. Workers record a heartbeat on the job they are running every
+# DISTANCE_JOB_HEARTBEAT seconds, and jobs without one for DISTANCE_JOB_TIMEOUT seconds are assumed
+# to have lost their worker
+DISTANCE_JOB_DIR = os.environ.get('DISTANCE_JOB_DIR', BASE_DIR / 'jobs')
+DISTANCE_JOB_RETENTION = 7 * 24 * 3600
+DISTANCE_JOB_HEARTBEAT = 30
+DISTANCE_JOB_TIMEOUT = 300
@@ -0,0 +1,37 @@
+// Typeahead for PersonLookupWidget: suggests people matching what has been typed so far
+// and copies the chosen person's id into the hidden input that is submitted
+document.addEventListener("DOMContentLoaded", function () {
+    document.querySelectorAll("[data-person-lookup]").forEach(function (input) {
+        const hidden = input.previousElementSibling;
+        const options = document.getElementById(input.getAttribute("list"));
+        let timer = null;
+
+        input.addEventListener("input", function () {
+            const match = Array.from(options.options).find(function (option) {
+                return option.value === input.value;
+            });
+            hidden.value = match ? match.dataset.id : "";
+            if (match) {
+                return;
+            }
+
+            clearTimeout(timer);
+            timer = setTimeout(function () {
+                const query = input.value.trim();
+                if (query.length < 2) {
+                    return;
+                }
+                fetch(input.dataset.personLookup + "?q=" + encodeURIComponent(query), {credentials: "same-origin"})
+                    .then(function (response) { return response.json(); })
+                    .then(function (data) {
+                        options.replaceChildren(...data.results.map(function (person) {
+                            const option = document.createElement("option");
+                            option.value = person.label;
+                            option.dataset.id = person.id;
+                            return option;
+                        }));
+                    });
+            }, 200);
+        });
+    });
+});